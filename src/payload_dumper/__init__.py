@@ -1,17 +1,110 @@
 #!/usr/bin/env python3
 import argparse
+import logging
 import os
-from multiprocessing import cpu_count
+import signal
+import sys
 
-from . import http_file
-from .dumper import Dumper
+from . import tracing
 from . import mtio
+from . import progress
+from . import shard
+
+# the dumper, HTTP client and metrics are imported in main() once the arguments
+# show they are needed, keeping --help and metadata-only runs fast
+
+# embedded (see api.py) nothing is printed, main() shows the messages
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class PrintHandler(logging.Handler):
+    """logged messages printed like the others, to whatever sys.stdout is at the time"""
+
+    def emit(self, record):
+        print(self.format(record))
+
+
+def show_log():
+    logger = logging.getLogger(__name__)
+    logger.addHandler(PrintHandler())
+    logger.setLevel(logging.INFO)
+
+
+def stop_now():
+    # workers blocked in reads never see the interrupt, the process has to go
+    if sys.platform == 'win32':
+        os.kill(os.getpid(), signal.CTRL_BREAK_EVENT)
+    else:
+        os.kill(os.getpid(), signal.SIGKILL)
+    sys.exit(1)
+
+
+def shard_arg(spec: str):
+    try:
+        return shard.parse_shard(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def readahead_arg(value: str):
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a size in MiB or auto, got {value!r}")
+
 
 def main():
+    show_log()
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from . import batch
+        return batch.main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "diff":
+        from . import diff
+        return diff.main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(description="OTA payload dumper")
-    parser.add_argument("payloadfile", help="payload file name")
+    parser.add_argument("payloadfile", help="payload file name, URL, s3://bucket/key, or '-' to read it once from stdin")
     parser.add_argument(
-        "--out", default="output", help="output directory (default: 'output')"
+        "--out",
+        default="output",
+        help="output directory, s3://bucket/prefix to upload the images, or '-' to "
+        "stream to stdout (default: 'output')",
+    )
+    parser.add_argument(
+        "--tar",
+        action="store_true",
+        help="stream partitions as a tar archive (to stdout with --out -, "
+        "otherwise to partitions.tar in the output directory)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["raw", "sparse", "zst"],
+        default="raw",
+        help="output image format, sparse writes Android sparse images, "
+        "zst writes seekable zstd compressed images (default: raw)",
+    )
+    parser.add_argument(
+        "--super",
+        action="store_true",
+        help="write the dynamic partitions into a flashable super.img using the "
+        "payload's dynamic partition metadata",
+    )
+    parser.add_argument(
+        "--super-size",
+        type=int,
+        help="size of super.img in bytes (default: smallest size fitting the partitions)",
+    )
+    parser.add_argument(
+        "--slot-suffix",
+        default="",
+        help="suffix appended to partition and group names in super.img, e.g. _a",
+    )
+    parser.add_argument(
+        "--export-payload",
+        metavar="FILE",
+        help="write a payload containing only the selected partitions to FILE",
     )
     parser.add_argument(
         "--diff",
@@ -30,37 +123,262 @@ def main():
     )
     parser.add_argument(
         "--workers",
-        default=cpu_count(),
+        default=os.cpu_count(),
         type=int,
-        help="number of workers (default: CPU count - %d)" % cpu_count(),
+        help="number of workers (default: CPU count - %d)" % os.cpu_count(),
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="adjust fetch and decode concurrency while running, from the download "
+        "rate, latency, memory and CPU use; --workers bounds the decode threads",
+    )
+    parser.add_argument(
+        "--max-fetch",
+        default=64,
+        type=int,
+        help="upper bound of concurrent range reads with --autotune (default: 64)",
+    )
+    parser.add_argument(
+        "--memory-mib",
+        default=1024,
+        type=int,
+        help="memory budget of fetched and decoding data with --autotune in MiB (default: 1024)",
+    )
+    parser.add_argument(
+        "--no-progress",
+        action="store_true",
+        help="don't draw progress bars (they are never drawn when stdout is not a terminal)",
     )
     parser.add_argument(
         "--list",
         action="store_true",
         help="list partitions in the payload file",
     )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="estimate download size, requests and wall time of the selected partitions "
+        "from the manifest, without fetching any operation data",
+    )
+    parser.add_argument(
+        "--calibration",
+        metavar="REPORT",
+        help="calibrate --estimate with the JSON written by --report on a previous run",
+    )
     parser.add_argument(
         "--metadata",
         action="store_true",
         help="extract and display metadata file from the payload",
     )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="record per-operation and HTTP spans to FILE as Chrome trace JSON "
+        "(open in Perfetto or chrome://tracing)",
+    )
+    parser.add_argument(
+        "--report",
+        metavar="FILE",
+        help="write a JSON performance report (per partition and op type) to FILE",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="FILE",
+        help="write the run metrics to FILE in the Prometheus textfile format",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="I/N",
+        type=shard_arg,
+        help="apply only the I-th of N byte-balanced slices of the operations, "
+        "N processes with the same arguments fill the images together",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check the images in the output directory (and shard markers) "
+        "against the partition hashes in the manifest",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="update existing images in the output directory in place, skipping "
+        "partitions and operations whose output is unchanged",
+    )
+    parser.add_argument(
+        "--verity",
+        choices=["write", "verify"],
+        help="compute the dm-verity hash tree and FEC of partitions that have them "
+        "while extracting and write them into the images, or check the ones there; "
+        "with --verify, check the images in the output directory",
+    )
+    parser.add_argument(
+        "--no-fec",
+        action="store_true",
+        help="with --verity, leave out the Reed-Solomon FEC data",
+    )
+    parser.add_argument(
+        "--io-policy",
+        choices=["default", "sync", "dontneed", "direct"],
+        default="default",
+        help="how raw images are written back on Linux: sync starts writeback every "
+        "--dirty-mib MiB of a file and waits for the previous one, dontneed also drops "
+        "the written pages from the page cache, direct writes with O_DIRECT (default: default)",
+    )
+    parser.add_argument(
+        "--dirty-mib",
+        default=64,
+        type=int,
+        metavar="MIB",
+        help="with --io-policy sync or dontneed, MiB written to an image between "
+        "writebacks (default: 64)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="don't read or write the manifest cache (default location: "
+        "$PAYLOAD_DUMPER_CACHE or ~/.cache/payload_dumper)",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threads", "async"],
+        default="threads",
+        help="HTTP fetch engine: blocking requests on the worker threads, or an "
+        "asyncio engine downloading ahead of the workers (default: threads)",
+    )
+    parser.add_argument(
+        "--connections",
+        default=32,
+        type=int,
+        help="maximum HTTP connections of the async engine (default: 32)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        default=128,
+        type=int,
+        help="maximum range requests in flight with the async engine (default: 128)",
+    )
+    parser.add_argument(
+        "--no-http2",
+        action="store_true",
+        help="don't negotiate HTTP/2 with the async engine",
+    )
+    parser.add_argument(
+        "--readahead",
+        default="auto",
+        type=readahead_arg,
+        metavar="MIB",
+        help="read a local payload sequentially ahead of the workers with a window "
+        "of MIB MiB, 0 to let every worker read its own ops; auto uses a 64 MiB "
+        "window on network filesystems and spinning disks only (default: auto)",
+    )
+    parser.add_argument(
+        "--mirror",
+        action="append",
+        metavar="URL",
+        help="another URL serving the same payload, may be repeated; reads go to "
+        "the fastest URL and fail over to the others on errors",
+    )
+    parser.add_argument(
+        "--retries",
+        default=10,
+        type=int,
+        help="attempts without progress before a range read fails (default: 10)",
+    )
     parser.add_argument("--header", action="append", nargs=2)
     args = parser.parse_args()
 
-    # Check for --out directory exists
-    if not os.path.exists(args.out):
+    from .dumper import Dumper
+
+    if args.trace:
+        tracing.enable()
+    metrics = None
+    if args.report or args.prometheus:
+        from .metrics import Metrics
+        metrics = tracing.install(Metrics())
+
+    stream = None
+    if args.out == "-":
+        # keep stdout for image data, messages and progress go to stderr
+        stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
+    elif args.out.startswith("s3://"):
+        # images are uploaded as s3://bucket/prefix/name.img
+        if args.tar:
+            print("--tar can't be written to an s3:// output")
+            sys.exit(1)
+    elif not os.path.exists(args.out):
+        # Check for --out directory exists
         os.makedirs(args.out)
+    if args.tar and stream is None:
+        # only created once partitions are extracted into it, --estimate,
+        # --verify or --export-payload leave an existing one alone
+        from .streamio import LazyFile
+        stream = LazyFile(os.path.join(args.out, "partitions.tar"))
 
     payload_file = args.payloadfile
-    if payload_file.startswith("http://") or payload_file.startswith("https://"):
+    remote = payload_file.startswith("http://") or payload_file.startswith("https://")
+    if payload_file.startswith("s3://"):
+        from . import s3
+        payload_file = s3.S3RangeFile(payload_file, max_retry=args.retries)
+        remote = True
+    elif remote:
+        from . import http_file
         headers = None
         if args.header is not None:
             headers = {}
             for k, v in args.header:
                 headers[k] = v
-        payload_file = http_file.HttpRangeFileMTIO(payload_file, headers=headers)
+        if args.engine == "async":
+            from . import async_http
+            if not args.no_http2 and not async_http.http2_available():
+                print("h2 is not installed, using HTTP/1.1 (pip install httpx[http2])")
+            payload_file = async_http.AsyncHttpRangeFile(
+                payload_file,
+                headers=headers,
+                max_connections=args.connections,
+                concurrency=args.concurrency,
+                http2=not args.no_http2,
+                max_retry=args.retries,
+                mirrors=args.mirror or (),
+            )
+        else:
+            payload_file = http_file.HttpRangeFileMTIO(
+                payload_file, max_retry=args.retries, headers=headers, mirrors=args.mirror or ()
+            )
+    elif payload_file == "-":
+        from .streaminput import StreamPayload
+        payload_file = StreamPayload(sys.stdin.buffer)
     else:
         payload_file = mtio.MTFile(payload_file, "r")
+    piped = args.payloadfile == "-"
+
+    readahead = 0
+    if piped:
+        # the stream always goes through the read-ahead thread, this sizes its window
+        if args.readahead != "auto":
+            readahead = args.readahead << 20
+    elif not remote and not (args.list or args.metadata):
+        if args.readahead == "auto":
+            from . import readahead as readahead_engine
+            if readahead_engine.worthwhile(args.payloadfile):
+                readahead = readahead_engine.DEFAULT_WINDOW
+        else:
+            readahead = args.readahead << 20
+
+    payload_cache = None
+    if not args.no_cache and not piped:
+        from . import cache
+        payload_cache = cache.for_payload(args.payloadfile, payload_file)
+
+    tuner = None
+    if args.autotune:
+        from .tuner import Autotuner
+        tuner = Autotuner(
+            payload_file, max_fetch=args.max_fetch, max_decode=args.workers, memory_budget=args.memory_mib << 20
+        )
+
     dumper = Dumper(
         payload_file,
         args.out,
@@ -70,9 +388,51 @@ def main():
         workers=args.workers,
         list_partitions=args.list,
         extract_metadata=args.metadata,
+        stream=stream,
+        tar=args.tar,
+        out_format=args.format,
+        super_image=args.super,
+        super_size=args.super_size,
+        slot_suffix=args.slot_suffix,
+        export_payload=args.export_payload,
+        estimate=args.estimate,
+        calibration=args.calibration,
+        cache=payload_cache,
+        shard=args.shard,
+        verify=args.verify,
+        update=args.update,
+        verity=args.verity,
+        fec=not args.no_fec,
+        io_policy=args.io_policy,
+        dirty_limit=args.dirty_mib << 20,
+        tuner=tuner,
+        manager=progress.NullManager() if args.no_progress else None,
+        readahead=readahead,
     )
 
-    dumper.run()
+    try:
+        code = dumper.run()
+    except KeyboardInterrupt:
+        stop_now()
+    finally:
+        if args.trace:
+            tracing.get_tracer().save(args.trace)
+
+    network_bytes = None
+    if remote:
+        network_bytes = payload_file.transferred_bytes
+        print("\ntotal bytes read from network:", network_bytes)
+
+    if metrics is not None:
+        report = metrics.report(network_bytes)
+        if args.report:
+            metrics.save_json(args.report, report)
+        if args.prometheus:
+            metrics.save_prometheus(args.prometheus, report)
+        print(
+            f"{report['ops']} ops, {report['decompressed_bytes']} bytes in {report['wall_s']:.2f}s "
+            f"({report['throughput_mib_s']:.2f} MiB/s), peak RSS {report['peak_rss_kib']} KiB"
+        )
 
-    if isinstance(payload_file, http_file.HttpRangeFileMTIO):
-        print("\ntotal bytes read from network:", payload_file.transferred_bytes)
+    if code:
+        sys.exit(code)
@@ -0,0 +1,293 @@
+"""
+Library interface for embedding the dumper: open a payload, look at its
+manifest and partitions, and stream the decoded images into your own sinks
+instead of files.
+
+    from payload_dumper.api import Payload
+
+    with Payload.open("ota.zip") as p:
+        for block in p.iter_blocks("boot"):
+            sink.write(block)
+
+Nothing here prints, exits or signals the process. Retries, skipped mirrors
+and verity results go to the `payload_dumper` logger, which has no handler
+but a NullHandler unless the application adds one. Closing an iter_blocks()
+generator or cancelling an async call stops the extraction; errors are raised
+in the caller.
+"""
+import asyncio
+from collections import deque
+from threading import Condition, Event, Lock, Thread
+
+from . import mtio
+from . import progress
+from . import streamio
+from .dumper import Dumper
+
+DEFAULT_MAX_QUEUED = 64 << 20
+
+
+class Cancelled(Exception):
+    """raised in the workers of an extraction whose consumer went away"""
+
+
+class BlockQueue:
+    """the sequential sink iter_blocks() reads from, bounded by `max_queued` bytes"""
+
+    def __init__(self, max_queued: int = DEFAULT_MAX_QUEUED):
+        self.max_queued = max_queued
+        self.blocks = deque()
+        self.queued = 0
+        self.finished = False
+        self.error = None
+        self.cancelled = False
+        self.cond = Condition()
+
+    def write(self, data):
+        with self.cond:
+            # a block larger than the bound still goes through alone
+            while not self.cancelled and self.queued > 0 and self.queued + len(data) > self.max_queued:
+                self.cond.wait()
+            if self.cancelled:
+                raise Cancelled()
+            self.blocks.append(data)
+            self.queued += len(data)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.finished = True
+            self.error = error
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.blocks.clear()
+            self.cond.notify_all()
+
+    def get(self):
+        """the next block, None at the end; raises what failed the extraction"""
+        with self.cond:
+            while not self.blocks and not self.finished and not self.cancelled:
+                self.cond.wait()
+            if self.blocks:
+                data = self.blocks.popleft()
+                self.queued -= len(data)
+                self.cond.notify_all()
+                return data
+            if self.error is not None and not self.cancelled:
+                raise self.error
+            return None
+
+
+class BufferIO(mtio.MTIOBase):
+    """positional writes into a caller's writable buffer"""
+
+    def __init__(self, buf, size: int):
+        self.view = memoryview(buf).cast("B")
+        if len(self.view) < size:
+            raise ValueError(f"buffer of {len(self.view)} bytes, the image needs {size}")
+        self.size = size
+        self.cancelled = Event()
+        self.is_closed = False
+
+    def write(self, off: int, content: bytes) -> int:
+        if self.cancelled.is_set():
+            raise Cancelled()
+        self.view[off:off + len(content)] = content
+        return len(content)
+
+    def zero(self, off: int, size: int):
+        self.view[off:off + size] = bytes(size)
+
+    def get_size(self) -> int:
+        return self.size
+
+    def readable(self) -> bool:
+        return False
+
+    def writable(self) -> bool:
+        return True
+
+    def close(self):
+        self.is_closed = True
+
+    def closed(self) -> bool:
+        return self.is_closed
+
+
+def open_payload_file(source, headers=None, engine: str = "threads", max_retry: int = 10, mirrors=()) -> mtio.MTIOBase:
+    if isinstance(source, mtio.MTIOBase):
+        return source
+    if source.startswith("s3://"):
+        from . import s3
+        return s3.S3RangeFile(source, max_retry=max_retry)
+    if source.startswith("http://") or source.startswith("https://"):
+        if engine == "async":
+            from . import async_http
+            return async_http.AsyncHttpRangeFile(source, headers=headers, max_retry=max_retry, mirrors=mirrors)
+        from . import http_file
+        return http_file.HttpRangeFileMTIO(source, max_retry=max_retry, headers=headers, mirrors=mirrors)
+    return mtio.MTFile(source, "r")
+
+
+class Payload:
+    """
+    an opened payload. `old` is the directory with the images a differential
+    payload applies to; `workers` decode in parallel, `readahead` is the
+    window in bytes of a sequential read-ahead of a local payload (see
+    readahead.py), 0 for none
+    """
+
+    def __init__(self, payload_file: mtio.MTIOBase, old=None, workers=None, readahead: int = 0, owns_file=True):
+        self.file = payload_file
+        self.owns_file = owns_file
+        kwargs = {} if workers is None else {"workers": workers}
+        self.dumper = Dumper(
+            payload_file, None, diff=old is not None, old=old, manager=progress.NullManager(),
+            readahead=readahead, **kwargs
+        )
+        # the dumper holds per-run state, extractions take turns
+        self.busy = Lock()
+
+    @classmethod
+    def open(cls, source, old=None, workers=None, readahead: int = 0, headers=None, engine: str = "threads",
+             max_retry: int = 10, mirrors=()):
+        """open a path, an http(s) or s3:// URL or a mtio.MTIOBase (which the caller keeps and closes)"""
+        payload_file = open_payload_file(source, headers, engine, max_retry, mirrors)
+        try:
+            return cls(payload_file, old, workers, readahead, owns_file=payload_file is not source)
+        except BaseException:
+            if payload_file is not source:
+                payload_file.close()
+            raise
+
+    @property
+    def manifest(self):
+        """the parsed DeltaArchiveManifest"""
+        return self.dumper.dam
+
+    @property
+    def block_size(self) -> int:
+        return self.dumper.block_size
+
+    @property
+    def partitions(self):
+        return list(self.dumper.dam.partitions)
+
+    def partition(self, name):
+        """the PartitionUpdate called `name`, a PartitionUpdate is passed through"""
+        if not isinstance(name, str):
+            return name
+        for partition in self.dumper.dam.partitions:
+            if partition.partition_name == name:
+                return partition
+        raise KeyError(f"partition {name} not found in payload")
+
+    def partition_size(self, partition) -> int:
+        return self.dumper.partition_size(self.partition(partition))
+
+    def extract(self, partition, out_file: mtio.MTIOBase):
+        """apply the ops of `partition` to `out_file`, blocks until done"""
+        partition = self.partition(partition)
+        if not self.busy.acquire(blocking=False):
+            raise ValueError("another extraction is running on this payload")
+        try:
+            self.dumper.multiprocess_partitions([{
+                "partition": partition,
+                "operations": [self.dumper.op_entry(op) for op in partition.operations],
+                "out_file": out_file,
+            }])
+        finally:
+            self.busy.release()
+
+    def iter_blocks(self, partition, max_queued: int = DEFAULT_MAX_QUEUED):
+        """
+        the image of `partition` as consecutive blocks of bytes, from offset 0
+        to partition_size(); at most `max_queued` decoded bytes wait for the
+        consumer. Closing the generator early cancels the extraction.
+        """
+        blocks = self.start_blocks(partition, max_queued)
+        try:
+            while True:
+                block = blocks.get()
+                if block is None:
+                    return
+                yield block
+        finally:
+            self.stop_blocks(blocks)
+
+    def start_blocks(self, partition, max_queued: int) -> BlockQueue:
+        partition = self.partition(partition)
+        blocks = BlockQueue(max_queued)
+        out_file = streamio.OrderedWriter(blocks, self.partition_size(partition), self.dumper.zero_extents(partition))
+
+        def run():
+            try:
+                self.extract(partition, out_file)
+            except BaseException as e:
+                blocks.finish(e)
+            else:
+                blocks.finish()
+
+        blocks.thread = Thread(target=run, name="iter-blocks", daemon=True)
+        blocks.thread.start()
+        return blocks
+
+    def stop_blocks(self, blocks: BlockQueue):
+        blocks.cancel()
+        blocks.thread.join()
+
+    def readinto(self, partition, buf) -> int:
+        """decode the image of `partition` into the writable buffer `buf`, returns its size"""
+        partition = self.partition(partition)
+        out_file = BufferIO(buf, self.partition_size(partition))
+        self.readinto_file(partition, out_file)
+        return out_file.size
+
+    def readinto_file(self, partition, out_file: BufferIO):
+        for off, size in self.dumper.zero_extents(partition):
+            out_file.zero(off, size)
+        self.extract(partition, out_file)
+
+    async def aiter_blocks(self, partition, max_queued: int = DEFAULT_MAX_QUEUED):
+        """iter_blocks() for asyncio, decoding runs on threads and doesn't block the loop"""
+        loop = asyncio.get_running_loop()
+        blocks = self.start_blocks(partition, max_queued)
+        try:
+            while True:
+                block = await loop.run_in_executor(None, blocks.get)
+                if block is None:
+                    return
+                yield block
+        finally:
+            # cancel() wakes a pending get(), the executor thread returns
+            await loop.run_in_executor(None, self.stop_blocks, blocks)
+
+    async def areadinto(self, partition, buf) -> int:
+        """readinto() for asyncio; cancelling the task stops the workers before it returns"""
+        loop = asyncio.get_running_loop()
+        partition = self.partition(partition)
+        out_file = BufferIO(buf, self.partition_size(partition))
+        task = loop.run_in_executor(None, self.readinto_file, partition, out_file)
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            out_file.cancelled.set()
+            try:
+                await task
+            except Cancelled:
+                pass
+            raise
+        return out_file.size
+
+    def close(self):
+        if self.owns_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
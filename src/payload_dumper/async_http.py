@@ -0,0 +1,253 @@
+"""
+asyncio fetch engine: one event loop thread drives every range request over
+an httpx.AsyncClient (HTTP/2 multiplexed when the h2 package is installed and
+the server negotiates it), so the number of requests in flight no longer
+depends on --workers. The dumper calls fetch() for upcoming ops and hands each
+completed buffer to its CPU pool; fetched but not yet consumed bytes are
+bounded by `max_buffered`.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import Future
+from threading import Condition, Thread
+
+import httpx
+
+from . import mtio
+from . import retry
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class AsyncLimiter:
+    """bounds the requests in flight, set_limit() may be called from any thread (see tuner.py)"""
+
+    def __init__(self, loop, limit: int):
+        self.loop = loop
+        self.limit = limit
+        self.active = 0
+        self.waits = 0
+        self.cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.cond:
+            if self.active >= self.limit:
+                self.waits += 1
+                await self.cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    async def notify_all(self):
+        async with self.cond:
+            self.cond.notify_all()
+
+    def set_limit(self, limit: int):
+        self.limit = limit
+        asyncio.run_coroutine_threadsafe(self.notify_all(), self.loop)
+
+
+class AsyncHttpRangeFile(mtio.MTIOBase):
+    def __init__(self, url: str, headers=None, max_connections: int = 32, concurrency: int = 128,
+                 http2: bool = True, max_buffered: int = 256 << 20, max_retry: int = 10, mirrors=()):
+        self.url = url
+        self.mirror_urls = list(mirrors)
+        self.headers = dict(headers or {})
+        self.backoff = retry.Backoff(max_retry)
+        self.http2 = http2 and http2_available()
+        self.max_connections = max_connections
+        self.concurrency = concurrency
+        self.max_buffered = max_buffered
+        self.buffered = 0
+        self.cond = Condition()
+        self.transferred_bytes = 0
+        self.is_closed = False
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name="fetch-loop", daemon=True)
+        self.thread.start()
+        try:
+            self.call(self.open())
+        except BaseException:
+            self.stop_loop()
+            raise
+
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def open(self):
+        # created on the loop, the client and its semaphore belong to it
+        self.client = httpx.AsyncClient(
+            http2=self.http2,
+            headers=self.headers or None,
+            limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+        )
+        self.slots = AsyncLimiter(self.loop, self.concurrency)
+        h = await self.head(self.url)
+        size = int(h.headers.get("Content-Length", 0))
+        if size == 0:
+            raise ValueError(f"Remote has no length: {self.url}")
+        self.size = size
+        self.etag = h.headers.get("ETag")
+        self.last_modified = h.headers.get("Last-Modified")
+
+        urls = [self.url]
+        for mirror in self.mirror_urls:
+            try:
+                mirror_size = int((await self.head(mirror)).headers.get("Content-Length", 0))
+            except (ValueError, *retry.TRANSIENT_ERRORS) as e:
+                log.warning(f"Skipping mirror {mirror}: {e}")
+                continue
+            if mirror_size != size:
+                log.warning(f"Skipping mirror {mirror}: {mirror_size} bytes, expected {size}")
+                continue
+            urls.append(mirror)
+        self.mirrors = retry.Mirrors(urls)
+
+    async def head(self, url: str):
+        retry_count = 0
+        while True:
+            try:
+                with tracing.span("HEAD", "http"):
+                    h = await self.client.head(url)
+                if h.status_code in retry.RETRY_STATUS:
+                    raise retry.TransientError(f"HTTP {h.status_code} from {url}")
+                break
+            except retry.TRANSIENT_ERRORS:
+                retry_count += 1
+                if retry_count > self.backoff.max_retry:
+                    raise
+                await asyncio.sleep(self.backoff.delay(retry_count))
+        if h.status_code >= 400:
+            # e.g. a missing object, as http_file.HttpRangeFileMTIO.head()
+            raise ValueError(f"HTTP {h.status_code} from {url}")
+        if h.headers.get("Accept-Ranges", "none") != "bytes":
+            raise ValueError(f"Remote does not support ranges: {url} {h.status_code} {h.request.headers}")
+        return h
+
+    async def get(self, off: int, size: int) -> bytearray:
+        end_pos = min(off + size, self.size) - 1
+        expected_size = end_pos - off + 1
+        buf = bytearray(expected_size)
+        received = 0
+        retry_count = 0
+        async with self.slots:
+            while received < expected_size:
+                url = self.mirrors.choose()
+                start = off + received
+                headers = {"Range": f"bytes={start}-{end_pos}"}
+                got = 0
+                t0 = time.perf_counter()
+                try:
+                    with tracing.span("GET", "http", off=start, size=expected_size - received, retry=retry_count) as s:
+                        async with self.client.stream("GET", url, headers=headers) as r:
+                            s.set(status=r.status_code, http_version=r.http_version)
+                            length = retry.check_range_response(r, url, start, end_pos, self.size)
+                            async for chunk in r.aiter_bytes():
+                                n = min(len(chunk), length - got)
+                                buf[received:received + n] = chunk[:n]
+                                received += n
+                                got += n
+                                self.transferred_bytes += len(chunk)
+                            if got < length:
+                                raise retry.TransientError(f"short body from {url}: {got} of {length} bytes")
+                    self.mirrors.record(url, got, time.perf_counter() - t0)
+                except retry.TRANSIENT_ERRORS as e:
+                    self.mirrors.record(url, got, time.perf_counter() - t0, failed=True)
+                    retry_count = retry_count + 1 if got == 0 else 1
+                    if retry_count > self.backoff.max_retry:
+                        raise
+                    delay = self.backoff.delay(retry_count)
+                    log.warning(f"{type(e).__name__}: {e}, resuming at byte {off + received} in {delay:.1f}s ({retry_count=})")
+                    await asyncio.sleep(delay)
+        return buf
+
+    @property
+    def window(self) -> int:
+        return self.max_buffered
+
+    def fetch(self, off: int, size: int) -> Future:
+        """
+        start reading `size` bytes at `off`, blocks while `max_buffered` bytes
+        are fetched or in flight; call release(size) once the data is consumed
+        """
+        return self.fetch_batch([(off, size)])[0]
+
+    def fetch_batch(self, reads):
+        """fetch() of all the (off, size) `reads` of one task, their bytes are reserved together"""
+        if self.is_closed:
+            raise ValueError('closed!')
+        total = sum(size for _, size in reads)
+        with self.cond:
+            # a batch larger than the bound still goes through alone, it
+            # never waits on the bytes of its own reads
+            while self.buffered > 0 and self.buffered + total > self.max_buffered:
+                self.cond.wait()
+            self.buffered += total
+        return [asyncio.run_coroutine_threadsafe(self.get(off, size), self.loop) for off, size in reads]
+
+    def release(self, size: int):
+        with self.cond:
+            self.buffered -= size
+            self.cond.notify_all()
+
+    def read(self, off: int, size: int) -> bytes:
+        if self.is_closed:
+            raise ValueError('closed!')
+        if size == 0:
+            return b''
+        return asyncio.run_coroutine_threadsafe(self.get(off, size), self.loop).result()
+
+    def readinto(self, off: int, size: int, ba) -> int:
+        data = self.read(off, size)
+        ba[:len(data)] = data
+        return len(data)
+
+    def get_size(self) -> int:
+        return self.size
+
+    def set_size(self, size: int):
+        raise NotImplementedError()
+
+    def write(self, off: int, content: bytes) -> int:
+        raise NotImplementedError()
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    def stop_loop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.call(self.client.aclose())
+        self.stop_loop()
+
+    def closed(self) -> bool:
+        return self.is_closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,184 @@
+"""
+Batch mode: payload_dumper batch jobs.json
+
+Runs many extractions in one process. All jobs share one worker pool that
+schedules their ops fairly under a memory budget (see scheduler.py), one HTTP
+connection pool limited per host, and one set of progress bars. A failing job
+doesn't stop the others, the per-job results are printed at the end and can
+be written as JSON.
+
+The jobs file is a JSON list of objects:
+
+    [
+        {"payload": "https://example.com/a.zip", "out": "out/a", "partitions": ["boot", "vendor_boot"]},
+        {"payload": "b.zip", "out": "out/b", "old": "old/b", "format": "sparse"}
+    ]
+
+`partitions` is a list or a comma separated string (all partitions when
+omitted), `old` enables differential OTA with the old images in that
+directory, `format` is one of raw, sparse and zst, and `"update": true`
+rewrites only what changed in the images already in `out` (see
+incremental.py). `"verity": "write"` or `"verify"` does what --verity does
+for the job's raw images.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import mtio
+from . import progress
+from .scheduler import Scheduler
+
+FORMATS = ("raw", "sparse", "zst")
+VERITY_MODES = ("write", "verify")
+
+
+def load_jobs(path: str):
+    with open(path) as f:
+        specs = json.load(f)
+    if not isinstance(specs, list):
+        raise ValueError(f"{path}: expected a list of jobs")
+    jobs = []
+    for i, spec in enumerate(specs):
+        if "payload" not in spec or "out" not in spec:
+            raise ValueError(f"{path}: job {i} needs payload and out")
+        partitions = spec.get("partitions", "")
+        if isinstance(partitions, list):
+            partitions = ",".join(partitions)
+        out_format = spec.get("format", "raw")
+        if out_format not in FORMATS:
+            raise ValueError(f"{path}: job {i} has unknown format {out_format!r}")
+        verity_mode = spec.get("verity")
+        if verity_mode is not None and verity_mode not in VERITY_MODES:
+            raise ValueError(f"{path}: job {i} has unknown verity mode {verity_mode!r}")
+        jobs.append({
+            "name": spec.get("name", f"job{i}"),
+            "payload": spec["payload"],
+            "out": spec["out"],
+            "partitions": partitions,
+            "old": spec.get("old"),
+            "format": out_format,
+            "update": bool(spec.get("update", False)),
+            "verity": verity_mode,
+        })
+    return jobs
+
+
+def run_job(spec, scheduler, pool, manager, headers=None, use_cache=True):
+    from .dumper import Dumper
+
+    result = {k: spec[k] for k in ("name", "payload", "out", "partitions")}
+    job = scheduler.job(spec["name"])
+    payload_file = None
+    start = time.perf_counter()
+    try:
+        if not spec["out"].startswith("s3://"):
+            os.makedirs(spec["out"], exist_ok=True)
+        remote = spec["payload"].startswith("http://") or spec["payload"].startswith("https://")
+        if spec["payload"].startswith("s3://"):
+            from . import s3
+            payload_file = s3.S3RangeFile(spec["payload"])
+        elif remote:
+            from . import http_file
+            payload_file = http_file.HttpRangeFileMTIO(spec["payload"], headers=headers, pool=pool)
+        else:
+            payload_file = mtio.MTFile(spec["payload"], "r")
+        payload_cache = None
+        if use_cache:
+            from . import cache
+            payload_cache = cache.for_payload(spec["payload"], payload_file)
+        dumper = Dumper(
+            payload_file,
+            spec["out"],
+            diff=spec["old"] is not None,
+            old=spec["old"],
+            images=spec["partitions"],
+            out_format=spec["format"],
+            update=spec["update"],
+            verity=spec["verity"],
+            cache=payload_cache,
+            job=job,
+            manager=manager,
+        )
+        code = dumper.run()
+        result["ok"] = not code
+    except (Exception, SystemExit) as e:
+        job.cancel_pending()
+        result["ok"] = False
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        # not every Dumper.run() path closes it, closing again is harmless
+        if payload_file is not None:
+            payload_file.close()
+    result["wall_s"] = round(time.perf_counter() - start, 3)
+    if payload_file is not None and hasattr(payload_file, "transferred_bytes"):
+        result["network_bytes"] = payload_file.transferred_bytes
+    return result
+
+
+def run(jobs, workers: int, concurrent_jobs: int, per_host: int, memory_budget: int, headers=None, use_cache=True,
+        show_progress=True):
+    scheduler = Scheduler(workers, memory_budget)
+    pool = None
+    if any(j["payload"].startswith(("http://", "https://")) for j in jobs):
+        from . import http_file
+        pool = http_file.ConnectionPool(per_host)
+    manager = progress.get_manager(stream=sys.stdout, enabled=show_progress)
+    try:
+        # job threads only parse manifests and wait, the ops run on the scheduler
+        with ThreadPoolExecutor(max_workers=concurrent_jobs, thread_name_prefix="job") as executor:
+            return list(executor.map(lambda j: run_job(j, scheduler, pool, manager, headers, use_cache), jobs))
+    finally:
+        manager.stop()
+        scheduler.shutdown()
+        if pool is not None:
+            pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="payload_dumper batch", description="extract many payloads with shared workers")
+    parser.add_argument("jobs", help="JSON file with the list of jobs")
+    parser.add_argument("--workers", default=os.cpu_count(), type=int, help="number of workers shared by all jobs")
+    parser.add_argument("--jobs", dest="concurrent_jobs", default=4, type=int, help="number of jobs running at the same time (default: 4)")
+    parser.add_argument("--per-host", default=8, type=int, help="concurrent HTTP requests per host (default: 8)")
+    parser.add_argument("--memory-mib", default=1024, type=int, help="memory budget of running operations in MiB, 0 for none (default: 1024)")
+    parser.add_argument("--report", metavar="FILE", help="write the per-job results as JSON to FILE")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the manifest cache")
+    parser.add_argument("--no-progress", action="store_true", help="don't draw progress bars")
+    parser.add_argument("--header", action="append", nargs=2)
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = load_jobs(args.jobs)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(2)
+    headers = dict(args.header) if args.header is not None else None
+
+    start = time.perf_counter()
+    results = run(
+        jobs,
+        workers=args.workers,
+        concurrent_jobs=args.concurrent_jobs,
+        per_host=args.per_host,
+        memory_budget=args.memory_mib << 20,
+        headers=headers,
+        use_cache=not args.no_cache,
+        show_progress=not args.no_progress,
+    )
+    wall = time.perf_counter() - start
+
+    print()
+    for r in results:
+        status = "ok" if r["ok"] else "FAILED " + r.get("error", "")
+        print(f"{r['name']}: {status} in {r['wall_s']:.2f}s ({r['payload']} -> {r['out']})")
+    failed = sum(not r["ok"] for r in results)
+    print(f"{len(results) - failed}/{len(results)} jobs succeeded in {wall:.2f}s")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"wall_s": round(wall, 3), "jobs": results}, f, indent=2)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmarks: python -m payload_dumper.bench --spec default
+
+`--spec small-ops` generates a payload of many one or two block operations,
+where the per-op overhead (reported as us/op) dominates.
+
+A synthetic payload is generated from a spec (see synth.py), then extracted by
+the real command line in a child process for each scenario: a local payload,
+a local zip, the payload served by a local range server with injected
+latency, and s3 reading the zip from a local S3 stand-in and uploading the
+images back to it (see s3server.py). Throughput, peak RSS and request counts are reported and can be
+written as JSON to track them across versions.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+from .. import update_metadata_pb2 as um
+from .s3server import S3Server
+from .server import RangeServer
+from .synth import build_payload, load_spec
+
+S3_BUCKET = "bench"
+# a deadlocked read-ahead fails its scenario instead of hanging the bench
+READAHEAD_TIMEOUT = 300
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def prepare(spec, workdir: str):
+    """generate payload.bin and payload.zip for `spec` in `workdir`, reusing them if the spec didn't change"""
+    spec = load_spec(spec)
+    os.makedirs(workdir, exist_ok=True)
+    spec_path = os.path.join(workdir, "spec.json")
+    hashes_path = os.path.join(workdir, "hashes.json")
+    if os.path.exists(spec_path) and os.path.exists(hashes_path):
+        with open(spec_path) as f:
+            if json.load(f) == spec:
+                with open(hashes_path) as f2:
+                    return spec, json.load(f2)
+    old_dir = os.path.join(workdir, "old")
+    hashes = build_payload({**spec, "zip": False, "zip64": False}, os.path.join(workdir, "payload.bin"), old_dir)
+    build_payload({**spec, "zip": True}, os.path.join(workdir, "payload.zip"), old_dir)
+    with open(hashes_path, "w") as f:
+        json.dump(hashes, f)
+    with open(spec_path, "w") as f:
+        json.dump(spec, f)
+    return spec, hashes
+
+
+def stage_s3_object(workdir: str, server, name: str) -> str:
+    """put `name` of `workdir` in the bucket of the S3 stand-in, returns its s3:// URL"""
+    path = os.path.join(server.root, S3_BUCKET, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a payload generated again is a new file
+    if os.path.exists(path):
+        os.unlink(path)
+    try:
+        os.link(os.path.join(workdir, name), path)
+    except OSError:
+        shutil.copyfile(os.path.join(workdir, name), path)
+    return f"s3://{S3_BUCKET}/{name}"
+
+
+def count_ops(path: str) -> int:
+    with open(path, "rb") as f:
+        header = f.read(24)
+        dam = um.DeltaArchiveManifest()
+        dam.ParseFromString(f.read(int.from_bytes(header[12:20], "big")))
+    return sum(len(p.operations) for p in dam.partitions)
+
+
+# ru_maxrss of a child includes the parent's pages at fork time, so the child
+# reports the high water mark of its own address space at exit instead
+RSS_BOOTSTRAP = """
+import atexit, os, runpy, sys
+def report_rss():
+    rss = 0
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    rss = int(line.split()[1])
+    except OSError:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(os.environ['PAYLOAD_DUMPER_BENCH_RSS'], 'w') as f:
+        f.write(str(rss))
+atexit.register(report_rss)
+sys.argv[0] = 'payload_dumper'
+runpy.run_module('payload_dumper', run_name='__main__', alter_sys=True)
+"""
+
+
+def run_dumper(args, workdir: str, name: str = "run", clear_cache: bool = True, extra_env=None, stdin_path=None,
+               timeout=None):
+    """
+    run the command line in a child process, returns (wall seconds, peak rss
+    KiB, returncode, stderr); `stdin_path` is piped in, a run past `timeout`
+    seconds is killed and fails
+    """
+    rss_path = os.path.join(workdir, f"rss-{name}.txt")
+    cmd = [sys.executable, "-c", RSS_BOOTSTRAP, *args]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [PACKAGE_ROOT, env.get("PYTHONPATH")]))
+    env["PAYLOAD_DUMPER_BENCH_RSS"] = rss_path
+    env.update(extra_env or {})
+    # every run starts cold, without the manifest cache of the previous one
+    cache_dir = os.path.join(workdir, "cache")
+    if clear_cache:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    env["PAYLOAD_DUMPER_CACHE"] = cache_dir
+    start = time.perf_counter()
+    stdin = open(stdin_path, "rb") if stdin_path is not None else subprocess.DEVNULL
+    try:
+        p = subprocess.run(cmd, env=env, stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        code, stderr = p.returncode, p.stderr
+    except subprocess.TimeoutExpired as e:
+        code, stderr = -1, (e.stderr or b"") + f"\ntimed out after {timeout}s".encode()
+    finally:
+        if stdin_path is not None:
+            stdin.close()
+    wall = time.perf_counter() - start
+    try:
+        with open(rss_path) as f:
+            rss = int(f.read())
+        os.unlink(rss_path)
+    except (OSError, ValueError):
+        rss = 0
+    return wall, rss, code, stderr.decode(errors="replace")
+
+
+class MemInfoSampler:
+    """
+    samples /proc/meminfo while a run goes: the peak of Dirty + Writeback and
+    how much Cached grew, what an extraction costs the other jobs of a machine
+    (see --io-policy). Zeros where there is no /proc/meminfo.
+    """
+
+    INTERVAL = 0.02
+
+    def __init__(self):
+        self.peak_dirty = 0
+        self.cache_growth = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def meminfo():
+        """(dirty + writeback, cached) in KiB"""
+        values = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                values[key] = int(value.split()[0])
+        return values["Dirty"] + values["Writeback"], values["Cached"]
+
+    def sample(self):
+        while not self.stopped.wait(self.INTERVAL):
+            self.peak_dirty = max(self.peak_dirty, self.meminfo()[0])
+
+    def start(self):
+        if os.path.exists("/proc/meminfo"):
+            self.start_dirty, self.start_cached = self.meminfo()
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        dirty, cached = self.meminfo()
+        self.peak_dirty = max(0, max(self.peak_dirty, dirty) - self.start_dirty)
+        self.cache_growth = cached - self.start_cached
+
+
+def verify(out_dir: str, hashes) -> bool:
+    for name, expected in hashes.items():
+        path = os.path.join(out_dir, f"{name}.img")
+        if not os.path.exists(path):
+            return False
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        if h.hexdigest() != expected:
+            return False
+    return True
+
+
+def evict(path: str):
+    """drop `path` from the page cache, the next run reads it from storage"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def run_scenario(name, source, workdir, spec, hashes, workers, extra_args, server=None, shards=1, ops=0, cold=False,
+                 s3_server=None, stdin_path=None, timeout=None):
+    out_dir = os.path.join(workdir, "out-" + name)
+    out = out_dir
+    extra_env = None
+    if s3_server is not None:
+        # uploaded to the stand-in, checked where it stores the objects
+        out = f"s3://{S3_BUCKET}/out-{name}"
+        out_dir = os.path.join(s3_server.root, S3_BUCKET, "out-" + name)
+        extra_env = s3_server.env()
+        server = s3_server
+    shutil.rmtree(out_dir, ignore_errors=True)
+    shutil.rmtree(os.path.join(workdir, "cache"), ignore_errors=True)
+    args = [source, "--out", out, "--workers", str(workers), *extra_args]
+    if any(p["delta"] > 0 for p in spec["partitions"]):
+        args += ["--diff", "--old", os.path.join(workdir, "old")]
+    if server is not None:
+        server.reset_counters()
+    if cold:
+        evict(os.path.join(workdir, os.path.basename(source)))
+    sampler = MemInfoSampler()
+    sampler.start()
+    if shards > 1:
+        # the shards run concurrently as separate processes, then --verify checks the result
+        with ThreadPoolExecutor(max_workers=shards) as executor:
+            start = time.perf_counter()
+            runs = list(executor.map(
+                lambda i: run_dumper([*args, "--shard", f"{i}/{shards}"], workdir, f"shard{i}", clear_cache=False),
+                range(1, shards + 1)
+            ))
+            wall = time.perf_counter() - start
+        rss = max(r[1] for r in runs)
+        code = max(r[2] for r in runs)
+        stderr = "".join(r[3] for r in runs)
+        sampler.stop()
+        if code == 0:
+            code = run_dumper([*args, "--verify"], workdir, clear_cache=False)[2]
+    else:
+        wall, rss, code, stderr = run_dumper(args, workdir, extra_env=extra_env, stdin_path=stdin_path, timeout=timeout)
+        sampler.stop()
+    out_bytes = sum(
+        os.path.getsize(os.path.join(out_dir, f))
+        for f in os.listdir(out_dir) if f.endswith(".img")
+    ) if os.path.isdir(out_dir) else 0
+    result = {
+        "scenario": name,
+        "workers": workers,
+        "shards": shards,
+        "wall_s": round(wall, 4),
+        "bytes_out": out_bytes,
+        "throughput_mib_s": round(out_bytes / wall / (1 << 20), 2),
+        # wall time per operation, the figure to watch on payloads of many tiny ops
+        "us_per_op": round(wall * 1e6 / ops, 2) if ops else 0.0,
+        "peak_rss_kib": rss,
+        # of the whole machine, run on an otherwise idle one
+        "peak_dirty_mib": round(sampler.peak_dirty / 1024, 1),
+        "cache_growth_mib": round(sampler.cache_growth / 1024, 1),
+        "returncode": code,
+        "ok": code == 0 and verify(out_dir, hashes),
+    }
+    if server is not None:
+        result["requests"] = server.requests
+        result["bytes_transferred"] = server.bytes_sent
+        result["latency_s"] = server.latency
+    if s3_server is not None:
+        result["bytes_uploaded"] = s3_server.bytes_received
+    if code != 0:
+        result["stderr"] = stderr[-2000:]
+    shutil.rmtree(out_dir, ignore_errors=True)
+    return result
+
+
+def run(spec="default", workdir="bench-work", workers=cpu_count(), latencies=(0.0, 0.02),
+        scenarios=("local", "zip", "http"), extra_args=(), repeat=1, shards=2, fail_rate=0.0, cut_rate=0.0,
+        cold=False, io_policies=()):
+    spec, hashes = prepare(spec, workdir)
+    payload_size = os.path.getsize(os.path.join(workdir, "payload.bin"))
+    ops = count_ops(os.path.join(workdir, "payload.bin"))
+    results = []
+    for _ in range(repeat):
+        if "local" in scenarios:
+            # with --io-policies, once per policy
+            for policy in io_policies or [None]:
+                name, policy_args = ("local", []) if policy is None else (f"local-{policy}", ["--io-policy", policy])
+                results.append(run_scenario(
+                    name, os.path.join(workdir, "payload.bin"), workdir, spec, hashes, workers,
+                    [*extra_args, *policy_args], ops=ops, cold=cold
+                ))
+        if "shard" in scenarios:
+            results.append(run_scenario(
+                f"shard-{shards}", os.path.join(workdir, "payload.bin"), workdir, spec, hashes,
+                max(1, workers // shards), extra_args, shards=shards, ops=ops, cold=cold
+            ))
+        if "readahead" in scenarios:
+            # a window smaller than a batch, from a file and from a pipe; a
+            # fetch waiting on bytes its own batch holds would never return
+            for name, source, stdin_path in (
+                ("readahead-1m", os.path.join(workdir, "payload.bin"), None),
+                ("stdin-1m", "-", os.path.join(workdir, "payload.bin")),
+            ):
+                results.append(run_scenario(
+                    name, source, workdir, spec, hashes, workers, [*extra_args, "--readahead", "1"],
+                    ops=ops, cold=cold, stdin_path=stdin_path, timeout=READAHEAD_TIMEOUT
+                ))
+        if "zip" in scenarios:
+            results.append(run_scenario(
+                "zip", os.path.join(workdir, "payload.zip"), workdir, spec, hashes, workers, extra_args,
+                ops=ops, cold=cold
+            ))
+        if "http" in scenarios:
+            for latency in latencies:
+                with RangeServer(workdir, latency=latency, fail_rate=fail_rate, cut_rate=cut_rate) as server:
+                    results.append(run_scenario(
+                        f"http-{int(latency * 1000)}ms", server.url + "/payload.zip",
+                        workdir, spec, hashes, workers, extra_args, server, ops=ops, cold=cold
+                    ))
+        if "s3" in scenarios:
+            with S3Server(os.path.join(workdir, "s3")) as server:
+                results.append(run_scenario(
+                    "s3", stage_s3_object(workdir, server, "payload.zip"), workdir, spec, hashes, workers, extra_args,
+                    ops=ops, cold=cold, s3_server=server
+                ))
+    return {
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": cpu_count(),
+        "payload_bytes": payload_size,
+        "ops": ops,
+        "spec": spec,
+        "results": results,
+    }
+
+
+def print_results(report):
+    print(f"payload: {report['payload_bytes']} bytes, {report['ops']} ops")
+    print(
+        f"{'scenario':<16}{'wall s':>10}{'MiB/s':>10}{'us/op':>10}{'rss KiB':>10}"
+        f"{'dirty MiB':>11}{'cache MiB':>11}{'requests':>10}  ok"
+    )
+    for r in report["results"]:
+        print(
+            f"{r['scenario']:<16}{r['wall_s']:>10.3f}{r['throughput_mib_s']:>10.2f}{r['us_per_op']:>10.1f}"
+            f"{r['peak_rss_kib']:>10}{r.get('peak_dirty_mib', ''):>11}{r.get('cache_growth_mib', ''):>11}"
+            f"{r.get('requests', ''):>10}  {r['ok']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="payload_dumper benchmarks")
+    parser.add_argument("--spec", default="default", help="preset name or json spec file (default: default)")
+    parser.add_argument("--workdir", default="bench-work", help="directory for generated payloads (default: bench-work)")
+    parser.add_argument("--workers", default=cpu_count(), type=int, help="number of workers")
+    parser.add_argument("--latency", default="0,0.02", help="comma separated latencies in seconds for http scenarios")
+    parser.add_argument("--scenarios", default="local,zip,http", help="comma separated scenarios (local, shard, readahead, zip, http, s3)")
+    parser.add_argument("--shards", default=2, type=int, help="number of --shard processes in the shard scenario")
+    parser.add_argument("--fail-rate", default=0.0, type=float, help="fraction of HTTP requests answered with 503")
+    parser.add_argument("--cut-rate", default=0.0, type=float, help="fraction of HTTP responses cut off part way")
+    parser.add_argument("--cold", action="store_true", help="drop the payload from the page cache before every run")
+    parser.add_argument(
+        "--io-policies", default="",
+        help="comma separated --io-policy values, the local scenario runs once with each (e.g. default,sync,dontneed,direct)"
+    )
+    parser.add_argument("--args", default="", help="extra arguments passed to payload_dumper")
+    parser.add_argument("--repeat", default=1, type=int, help="run every scenario this many times")
+    parser.add_argument("--json", help="write machine-readable results to this file")
+    args = parser.parse_args()
+
+    report = run(
+        spec=args.spec,
+        workdir=args.workdir,
+        workers=args.workers,
+        latencies=[float(x) for x in args.latency.split(",") if x],
+        scenarios=args.scenarios.split(","),
+        extra_args=shlex.split(args.args),
+        repeat=args.repeat,
+        shards=args.shards,
+        fail_rate=args.fail_rate,
+        cut_rate=args.cut_rate,
+        cold=args.cold,
+        io_policies=[x for x in args.io_policies.split(",") if x],
+    )
+    print_results(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if not all(r["ok"] for r in report["results"]):
+        sys.exit(1)
@@ -0,0 +1,176 @@
+"""
+A local stand-in for an S3-compatible object store, enough for s3://
+payloads and outputs: HEAD and ranged GET of objects, PUT, and multipart
+uploads (create, upload part, complete, abort). Buckets are directories of
+`root`, objects files under them. Every request must carry a valid SigV4
+signature for the server's credentials, parts but the last must be at least
+5 MiB, as S3 enforces.
+
+Use it with AWS_ENDPOINT_URL=server.url and the credentials in server.env().
+"""
+import hashlib
+import os
+import shutil
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, unquote, urlsplit
+from xml.etree import ElementTree
+
+from .. import s3
+from .server import RangeRequestHandler, RangeServer
+
+ACCESS_KEY = "bench"
+SECRET_KEY = "bench-secret"
+
+
+class S3RequestHandler(RangeRequestHandler):
+    def reply(self, status: int, body: bytes = b"", headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, status: int, code: str):
+        self.reply(status, f"<Error><Code>{code}</Code></Error>".encode(), {"Content-Type": "application/xml"})
+
+    def authorized(self, body: bytes = b"") -> bool:
+        """check the signature by signing the same request again"""
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith("AWS4-HMAC-SHA256 "):
+            return False
+        fields = dict(item.strip().split("=", 1) for item in auth[len("AWS4-HMAC-SHA256 "):].split(","))
+        payload_hash = self.headers.get("x-amz-content-sha256", "")
+        if payload_hash != hashlib.sha256(body).hexdigest():
+            return False
+        signed = {
+            name: self.headers.get(name, "") for name in fields.get("SignedHeaders", "").split(";")
+            if name not in ("host", "x-amz-date", "x-amz-content-sha256", "x-amz-security-token")
+        }
+        try:
+            now = datetime.strptime(self.headers.get("x-amz-date", ""), "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        except ValueError:
+            return False
+        url = f"http://{self.headers.get('Host', '')}{self.path}"
+        expected = s3.sign(self.command, url, signed, self.server.credentials, self.server.region, payload_hash, now)
+        return expected["Authorization"] == auth
+
+    def target(self):
+        """(object path, query dict)"""
+        parts = urlsplit(self.path)
+        return os.path.join(self.server.root, unquote(parts.path).lstrip("/")), dict(parse_qsl(parts.query, True))
+
+    def resolve(self):
+        if not self.authorized():
+            self.error(403, "SignatureDoesNotMatch")
+            return None
+        path, _ = self.target()
+        if not os.path.isfile(path):
+            self.error(404, "NoSuchKey")
+            return None
+        return path
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        self.server.count(0)
+        self.server.received(len(body))
+        return body
+
+    def upload_dir(self, upload_id: str) -> str:
+        return os.path.join(self.server.uploads, os.path.basename(upload_id))
+
+    def do_PUT(self):
+        body = self.read_body()
+        if not self.authorized(body):
+            return self.error(403, "SignatureDoesNotMatch")
+        path, query = self.target()
+        if "uploadId" in query:
+            part_dir = self.upload_dir(query["uploadId"])
+            if not os.path.isdir(part_dir):
+                return self.error(404, "NoSuchUpload")
+            path = os.path.join(part_dir, "%05d" % int(query["partNumber"]))
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(body)
+        self.reply(200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+    def do_POST(self):
+        body = self.read_body()
+        if not self.authorized(body):
+            return self.error(403, "SignatureDoesNotMatch")
+        path, query = self.target()
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(self.upload_dir(upload_id))
+            return self.reply(200, (
+                "<InitiateMultipartUploadResult xmlns=\"http://s3.amazonaws.com/doc/2006-03-01/\">"
+                f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+            ).encode())
+        part_dir = self.upload_dir(query.get("uploadId", ""))
+        if not os.path.isdir(part_dir):
+            return self.error(404, "NoSuchUpload")
+        parts = []
+        for part in ElementTree.fromstring(body).iter("Part"):
+            number, etag = int(part.findtext("PartNumber")), part.findtext("ETag")
+            part_path = os.path.join(part_dir, "%05d" % number)
+            if not os.path.exists(part_path):
+                return self.error(400, "InvalidPart")
+            with open(part_path, "rb") as f:
+                data = f.read()
+            if f'"{hashlib.md5(data).hexdigest()}"' != etag:
+                return self.error(400, "InvalidPart")
+            parts.append(data)
+        if any(len(data) < s3.MIN_PART_SIZE for data in parts[:-1]):
+            return self.error(400, "EntityTooSmall")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            for data in parts:
+                f.write(data)
+        shutil.rmtree(part_dir)
+        self.server.completed += 1
+        self.reply(200, b"<CompleteMultipartUploadResult></CompleteMultipartUploadResult>")
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return self.error(403, "SignatureDoesNotMatch")
+        self.server.count(0)
+        _, query = self.target()
+        shutil.rmtree(self.upload_dir(query.get("uploadId", "")), ignore_errors=True)
+        self.server.aborted += 1
+        self.reply(204)
+
+
+class S3Server(RangeServer):
+    def __init__(self, root: str, latency: float = 0.0, port: int = 0, region: str = "us-east-1"):
+        super().__init__(root, latency=latency, port=port, handler=S3RequestHandler)
+        self.credentials = s3.Credentials(ACCESS_KEY, SECRET_KEY)
+        self.region = region
+        # in-progress multipart uploads, outside of every bucket
+        self.uploads = os.path.join(root, ".uploads")
+        os.makedirs(self.uploads, exist_ok=True)
+        self.bytes_received = 0
+        self.completed = 0
+        self.aborted = 0
+
+    def received(self, nbytes: int):
+        with self.lock:
+            self.bytes_received += nbytes
+
+    def reset_counters(self):
+        super().reset_counters()
+        with self.lock:
+            self.bytes_received = 0
+            self.completed = 0
+            self.aborted = 0
+
+    def env(self):
+        """environment of a client of this server"""
+        return {
+            "AWS_ENDPOINT_URL": self.url,
+            "AWS_ACCESS_KEY_ID": ACCESS_KEY,
+            "AWS_SECRET_ACCESS_KEY": SECRET_KEY,
+            "AWS_REGION": self.region,
+        }
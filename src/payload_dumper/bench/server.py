@@ -0,0 +1,143 @@
+"""
+A local stand-in for a CDN serving files with HTTP range requests.
+
+Every request can be delayed by a fixed latency (plus jitter), a fraction of
+requests can fail or be cut off, and the server counts requests and bytes, so
+network behaviour can be benchmarked without depending on a real OTA host.
+"""
+import os
+import random
+import re
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+range_re = re.compile(r"bytes=(\d+)-(\d*)$")
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def resolve(self):
+        path = os.path.join(self.server.root, self.path.lstrip("/").split("?")[0])
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        return path
+
+    def delay(self):
+        latency = self.server.latency
+        if latency > 0:
+            time.sleep(latency + random.uniform(0, self.server.jitter))
+
+    def send_validators(self, path: str):
+        st = os.stat(path)
+        self.send_header("ETag", f'"{st.st_size:x}-{st.st_mtime_ns:x}"')
+        self.send_header("Last-Modified", formatdate(st.st_mtime, usegmt=True))
+
+    def do_HEAD(self):
+        self.server.count(0)
+        self.delay()
+        path = self.resolve()
+        if path is None:
+            return
+        self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.send_validators(path)
+        self.end_headers()
+
+    def do_GET(self):
+        self.delay()
+        path = self.resolve()
+        if path is None:
+            self.server.count(0)
+            return
+        if random.random() < self.server.fail_rate:
+            self.server.count(0)
+            self.send_error(503)
+            return
+        size = os.path.getsize(path)
+        m = range_re.match(self.headers.get("Range", ""))
+        if m is None:
+            start, end = 0, size - 1
+            self.send_response(200)
+        else:
+            start = int(m.group(1))
+            end = min(int(m.group(2)) if m.group(2) else size - 1, size - 1)
+            if start > end:
+                self.server.count(0)
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        length = end - start + 1
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_validators(path)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        if random.random() < self.server.cut_rate:
+            # drop the connection part way through the body
+            length = random.randrange(length)
+            self.close_connection = True
+        with open(path, "rb") as f:
+            f.seek(start)
+            remain = length
+            while remain > 0:
+                chunk = f.read(min(remain, 1 << 20))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remain -= len(chunk)
+        self.server.count(length)
+
+
+class RangeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root: str, latency: float = 0.0, jitter: float = 0.0, port: int = 0, handler=RangeRequestHandler,
+                 fail_rate: float = 0.0, cut_rate: float = 0.0):
+        super().__init__(("127.0.0.1", port), handler)
+        self.root = root
+        self.latency = latency
+        self.jitter = jitter
+        # fraction of GET requests answered with 503, or cut off part way through the body
+        self.fail_rate = fail_rate
+        self.cut_rate = cut_rate
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = Lock()
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, nbytes: int):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += nbytes
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+
+    def start(self):
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Startup budget: python -m payload_dumper.bench.startup
+
+Runs `payload_dumper --list` on a synthetic local payload with -X importtime
+and checks that the import time on top of a bare interpreter stays within a
+budget and that no codec, HTTP or progress UI module is imported for it.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from . import PACKAGE_ROOT, prepare
+
+# modules a metadata-only run on a local file must not import
+LAZY_MODULES = ("httpx", "enlighten", "bsdiff4", "brotli", "zstd", "lzma", "bz2")
+
+
+def run_python(args, cache_dir=None):
+    env = dict(os.environ)
+    if cache_dir is not None:
+        env["PAYLOAD_DUMPER_CACHE"] = cache_dir
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [PACKAGE_ROOT, env.get("PYTHONPATH")]))
+    start = time.perf_counter()
+    p = subprocess.run([sys.executable, "-X", "importtime", *args], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall = time.perf_counter() - start
+    return wall, p.returncode, p.stderr.decode(errors="replace")
+
+
+def parse_importtime(stderr: str):
+    """{module: cumulative us} of the top level imports, and the set of all imported modules"""
+    top = {}
+    imported = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        imported.add(name.strip())
+        if not name[1:].startswith(" "):
+            top[name.strip()] = int(cumulative)
+    return top, imported
+
+
+def measure(payload: str, out: str, repeat: int):
+    bare_top, bare_imported = parse_importtime(run_python(["-c", "pass"])[2])
+    walls = []
+    import_us = []
+    imported = set()
+    for _ in range(repeat):
+        # warm manifest cache: the first run fills it and is measured like the others
+        wall, code, stderr = run_python(["-m", "payload_dumper", "--list", "--out", out, payload], os.path.join(out, "cache"))
+        if code != 0:
+            raise RuntimeError(f"payload_dumper --list failed:\n{stderr[-2000:]}")
+        top, imported = parse_importtime(stderr)
+        walls.append(wall)
+        import_us.append(sum(us for name, us in top.items() if name not in bare_top))
+        bare_wall = run_python(["-c", "pass"])[0]
+        walls[-1] -= bare_wall
+    return {
+        "list_wall_ms": round(statistics.median(walls) * 1000, 1),
+        "import_ms": round(statistics.median(import_us) / 1000, 1),
+        "lazy_imported": sorted(
+            m for m in imported - bare_imported
+            if m.split(".")[0] in LAZY_MODULES
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="payload_dumper startup budget")
+    parser.add_argument("--workdir", default="bench-work", help="directory for generated payloads (default: bench-work)")
+    parser.add_argument("--budget-ms", default=150.0, type=float, help="import time budget on top of the interpreter (default: 150)")
+    parser.add_argument("--repeat", default=5, type=int, help="number of runs, the median is reported (default: 5)")
+    parser.add_argument("--json", help="write machine-readable results to this file")
+    args = parser.parse_args()
+
+    prepare("small-ops", args.workdir)
+    result = measure(os.path.join(args.workdir, "payload.bin"), os.path.join(args.workdir, "out-startup"), args.repeat)
+    result["budget_ms"] = args.budget_ms
+    result["ok"] = result["import_ms"] <= args.budget_ms and not result["lazy_imported"]
+
+    print(f"--list: {result['list_wall_ms']:.1f} ms over a bare interpreter, imports {result['import_ms']:.1f} ms "
+          f"(budget {args.budget_ms:.0f} ms)")
+    if result["lazy_imported"]:
+        print("imported but not needed: " + ", ".join(result["lazy_imported"]))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if not result["ok"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Synthetic payload generator.
+
+Builds valid CrAU payloads (optionally wrapped in a stored zip, or a zip64)
+from a spec, so performance changes can be measured on reproducible inputs:
+
+    {
+        "seed": 1,
+        "block_size": 4096,
+        "zip": false,
+        "zip64": false,
+        "xz_preset": 1,
+        "partitions": [
+            {
+                "name": "system",
+                "size": "64M",
+                "op_blocks": [1, 256],
+                "ops": {"REPLACE_XZ": 4, "ZSTD": 1, "REPLACE": 1, "REPLACE_BZ": 1},
+                "compress_ratio": 0.5,
+                "sparsity": 0.1,
+                "discard": 0.0,
+                "delta": 0.0
+            }
+        ]
+    }
+
+`ops` weights the operation types used for data extents, `compress_ratio` is
+the fraction of each data block that is compressible, `sparsity` the fraction
+of blocks written by ZERO operations (and `discard` by DISCARD ones). With
+`delta` > 0 a synthetic old image is generated too, the given fraction of
+blocks is changed and encoded as SOURCE_BSDIFF/BROTLI_BSDIFF, the rest as
+SOURCE_COPY.
+"""
+import bz2
+import hashlib
+import io
+import lzma
+import os
+import random
+import struct
+import zlib
+
+import brotli
+import bsdiff4.core
+from zstd import ZSTD_compress
+
+from .. import payload
+from .. import update_metadata_pb2 as um
+from ..update_metadata_pb2 import InstallOperation
+from ..ziputil import (
+    zip_cdfh_magic,
+    zip_cdfh_struct,
+    zip_eocd_magic,
+    zip_eocd_struct,
+    zip_fh_magic,
+    zip_fh_struct,
+    zip64_eocd_locator_magic,
+    zip64_eocd_locator_struct,
+    zip64_eocd_magic,
+    zip64_eocd_struct,
+)
+
+DEFAULT_PARTITION = {
+    "size": "16M",
+    "op_blocks": [1, 256],
+    "ops": {"REPLACE_XZ": 4, "ZSTD": 1, "REPLACE": 1, "REPLACE_BZ": 1},
+    "compress_ratio": 0.5,
+    "sparsity": 0.1,
+    "discard": 0.0,
+    "delta": 0.0,
+}
+
+PRESETS = {
+    "default": {
+        "partitions": [
+            {"name": "system", "size": "96M"},
+            {"name": "vendor", "size": "32M"},
+            {"name": "boot", "size": "8M", "ops": {"REPLACE": 1}},
+        ],
+    },
+    "small-ops": {
+        "partitions": [
+            {"name": "system", "size": "64M", "op_blocks": [1, 2], "ops": {"REPLACE": 1, "ZSTD": 1}},
+        ],
+    },
+    "delta": {
+        "partitions": [
+            {"name": "system", "size": "32M", "delta": 0.2, "op_blocks": [16, 128]},
+        ],
+    },
+}
+
+
+def parse_size(size) -> int:
+    if isinstance(size, int):
+        return size
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def load_spec(spec):
+    """accepts a spec dict, a preset name or a path to a json spec"""
+    if isinstance(spec, str):
+        if spec in PRESETS:
+            spec = PRESETS[spec]
+        else:
+            import json
+            with open(spec) as f:
+                spec = json.load(f)
+    spec = dict(spec)
+    spec.setdefault("seed", 1)
+    spec.setdefault("block_size", 4096)
+    spec.setdefault("zip", False)
+    spec.setdefault("zip64", False)
+    spec.setdefault("xz_preset", 1)
+    spec["partitions"] = [{**DEFAULT_PARTITION, **p} for p in spec["partitions"]]
+    return spec
+
+
+def block_data(rnd: random.Random, n: int, block_size: int, compress_ratio: float) -> bytes:
+    # the compressible part of each block is a repeated pattern
+    random_len = block_size - int(block_size * compress_ratio)
+    pattern = rnd.randbytes(64) * (block_size // 64)
+    out = bytearray()
+    for _ in range(n):
+        out += rnd.randbytes(random_len)
+        out += pattern[:block_size - random_len]
+    return bytes(out)
+
+
+def encode_replace(op_type, data: bytes, xz_preset: int) -> bytes:
+    if op_type == InstallOperation.REPLACE:
+        return data
+    elif op_type == InstallOperation.REPLACE_XZ:
+        return lzma.compress(data, preset=xz_preset)
+    elif op_type == InstallOperation.REPLACE_BZ:
+        return bz2.compress(data)
+    elif op_type == InstallOperation.ZSTD:
+        return ZSTD_compress(data)
+    raise ValueError(f"not a replace operation: {op_type}")
+
+
+def encode_bsdiff(op_type, old: bytes, new: bytes) -> bytes:
+    tcontrol, bdiff, bextra = bsdiff4.core.diff(old, new)
+    control = b"".join(bsdiff4.core.encode_int64(x) for c in tcontrol for x in c)
+    if op_type == InstallOperation.SOURCE_BSDIFF:
+        magic = bsdiff4.format.MAGIC
+        compress = bz2.compress
+    else:
+        magic = b"BSDF2\x02\x02\x02"
+        compress = brotli.compress
+    control, bdiff, bextra = compress(control), compress(bdiff), compress(bextra)
+    return (
+        magic
+        + bsdiff4.core.encode_int64(len(control))
+        + bsdiff4.core.encode_int64(len(bdiff))
+        + bsdiff4.core.encode_int64(len(new))
+        + control + bdiff + bextra
+    )
+
+
+def build_partition(dam, spec, pspec, rnd: random.Random, blob: bytearray):
+    block_size = spec["block_size"]
+    total_blocks = parse_size(pspec["size"]) // block_size
+    min_blocks, max_blocks = pspec["op_blocks"]
+    op_types = [getattr(InstallOperation, name) for name in pspec["ops"]]
+    op_weights = list(pspec["ops"].values())
+    delta = pspec["delta"]
+
+    part = dam.partitions.add()
+    part.partition_name = pspec["name"]
+    new_image = bytearray(total_blocks * block_size)
+    old_image = None
+    if delta > 0:
+        old_image = block_data(rnd, total_blocks, block_size, pspec["compress_ratio"])
+
+    b = 0
+    while b < total_blocks:
+        n = min(rnd.randint(min_blocks, max_blocks), total_blocks - b)
+        start, end = b * block_size, (b + n) * block_size
+        op = part.operations.add()
+        ext = op.dst_extents.add()
+        ext.start_block = b
+        ext.num_blocks = n
+        r = rnd.random()
+        if r < pspec["sparsity"]:
+            op.type = InstallOperation.ZERO
+        elif r < pspec["sparsity"] + pspec["discard"]:
+            op.type = InstallOperation.DISCARD
+        elif old_image is not None:
+            src = op.src_extents.add()
+            src.start_block = b
+            src.num_blocks = n
+            old = old_image[start:end]
+            if rnd.random() < delta:
+                new = bytearray(old)
+                # touch a few spots so the patch stays small
+                for _ in range(max(1, n // 4)):
+                    pos = rnd.randrange(len(new) - 16)
+                    new[pos:pos + 16] = rnd.randbytes(16)
+                new = bytes(new)
+                op.type = rnd.choice([InstallOperation.SOURCE_BSDIFF, InstallOperation.BROTLI_BSDIFF])
+                data = encode_bsdiff(op.type, old, new)
+            else:
+                new = old
+                op.type = InstallOperation.SOURCE_COPY
+                data = b""
+            new_image[start:end] = new
+            if data:
+                op.data_offset = len(blob)
+                op.data_length = len(data)
+                op.data_sha256_hash = hashlib.sha256(data).digest()
+                blob += data
+            op.src_sha256_hash = hashlib.sha256(old).digest()
+        else:
+            op.type = rnd.choices(op_types, op_weights)[0]
+            new = block_data(rnd, n, block_size, pspec["compress_ratio"])
+            new_image[start:end] = new
+            data = encode_replace(op.type, new, spec["xz_preset"])
+            op.data_offset = len(blob)
+            op.data_length = len(data)
+            op.data_sha256_hash = hashlib.sha256(data).digest()
+            blob += data
+        b += n
+
+    part.new_partition_info.size = len(new_image)
+    part.new_partition_info.hash = hashlib.sha256(new_image).digest()
+    if old_image is not None:
+        part.old_partition_info.size = len(old_image)
+        part.old_partition_info.hash = hashlib.sha256(old_image).digest()
+    return bytes(new_image), old_image
+
+
+def zip_stored(entries, zip64: bool) -> bytes:
+    """a minimal stored zip of [(name, data)], with zip64 records if `zip64` is set"""
+    out = io.BytesIO()
+    central = b""
+    for name, data in entries:
+        name = name.encode("utf-8")
+        crc = zlib.crc32(data)
+        lfh_off = out.tell()
+        out.write(struct.pack(zip_fh_struct, zip_fh_magic, 20, 0, 0, 0, 0, crc, len(data), len(data), len(name), 0))
+        out.write(name)
+        out.write(data)
+        if zip64:
+            extra = struct.pack("<HH3Q", 1, 24, len(data), len(data), lfh_off)
+            size32 = off32 = 0xFFFFFFFF
+        else:
+            extra = b""
+            size32, off32 = len(data), lfh_off
+        central += struct.pack(
+            zip_cdfh_struct, zip_cdfh_magic, 45 if zip64 else 20, 45 if zip64 else 20, 0, 0, 0, 0,
+            crc, size32, size32, len(name), len(extra), 0, 0, 0, 0, off32
+        ) + name + extra
+    cd_off = out.tell()
+    out.write(central)
+    if zip64:
+        eocd64_off = out.tell()
+        out.write(struct.pack(
+            zip64_eocd_struct, zip64_eocd_magic, struct.calcsize(zip64_eocd_struct) - 12,
+            45, 45, 0, 0, len(entries), len(entries), len(central), cd_off
+        ))
+        out.write(struct.pack(zip64_eocd_locator_struct, zip64_eocd_locator_magic, 0, eocd64_off, 1))
+        out.write(struct.pack(zip_eocd_struct, zip_eocd_magic, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0))
+    else:
+        out.write(struct.pack(zip_eocd_struct, zip_eocd_magic, 0, 0, len(entries), len(entries), len(central), cd_off, 0))
+    return out.getvalue()
+
+
+def build_payload(spec, path: str, old_dir: str = None):
+    """
+    write the payload described by `spec` to `path`, old images of delta
+    partitions go to `old_dir`, returns {partition_name: sha256 of the new image}
+    """
+    spec = load_spec(spec)
+    rnd = random.Random(spec["seed"])
+    dam = um.DeltaArchiveManifest()
+    dam.block_size = spec["block_size"]
+    blob = bytearray()
+    hashes = {}
+    for pspec in spec["partitions"]:
+        new_image, old_image = build_partition(dam, spec, pspec, rnd, blob)
+        hashes[pspec["name"]] = hashlib.sha256(new_image).hexdigest()
+        if old_image is not None:
+            dam.minor_version = 8
+            if old_dir is None:
+                old_dir = os.path.join(os.path.dirname(path) or ".", "old")
+            os.makedirs(old_dir, exist_ok=True)
+            with open(os.path.join(old_dir, f"{pspec['name']}.img"), "wb") as f:
+                f.write(old_image)
+
+    manifest = dam.SerializeToString()
+    data = payload.payload_header(len(manifest)) + manifest + bytes(blob)
+    if spec["zip"] or spec["zip64"]:
+        metadata = b"ota-type=AB\npost-build=synthetic\n"
+        data = zip_stored([
+            ("META-INF/com/android/metadata", metadata),
+            ("payload.bin", data),
+        ], spec["zip64"])
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashes
@@ -0,0 +1,205 @@
+"""
+Local cache of what every invocation on the same payload would otherwise
+fetch and parse again: the payload offset inside the zip, the serialized
+manifest and metadata signature, a per-partition op index and the OTA
+metadata file. Entries are keyed by the payload identity (path, size and
+mtime of a local file, URL, size and ETag/Last-Modified of a remote one), a
+changed payload gets a new key instead of invalidating the old entry.
+
+Saving a manifest prunes the directory: entries of local payloads that
+changed or are gone are dropped, then the least recently used ones until at
+most MAX_ENTRIES entries and MAX_BYTES are left.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+CACHE_VERSION = 1
+MAX_ENTRIES = 32
+MAX_BYTES = 256 << 20
+# leftovers of writers that died before renaming
+STALE_TMP_S = 3600
+
+
+def default_dir() -> str:
+    path = os.environ.get("PAYLOAD_DUMPER_CACHE")
+    if path:
+        return path
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "payload_dumper")
+
+
+def file_identity(path: str) -> str:
+    st = os.stat(path)
+    return f"file:{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def url_identity(url: str, size: int, etag=None, last_modified=None):
+    # without a validator a changed remote file would look the same
+    if not etag and not last_modified:
+        return None
+    return f"url:{url}:{size}:{etag or ''}:{last_modified or ''}"
+
+
+def for_payload(name: str, payload_file):
+    """PayloadCache in the default directory for a payload opened from `name`, None if it can't be identified"""
+    if name.startswith("http://") or name.startswith("https://") or name.startswith("s3://"):
+        identity = url_identity(name, payload_file.size, payload_file.etag, payload_file.last_modified)
+    else:
+        identity = file_identity(name)
+    if identity is None:
+        return None
+    return PayloadCache(default_dir(), identity)
+
+
+def build_index(dam):
+    """per partition op count, written blocks and the payload data range its ops read"""
+    index = {}
+    for partition in dam.partitions:
+        data_start = data_end = 0
+        ops_with_data = [op for op in partition.operations if op.data_length > 0]
+        if ops_with_data:
+            data_start = min(op.data_offset for op in ops_with_data)
+            data_end = max(op.data_offset + op.data_length for op in ops_with_data)
+        index[partition.partition_name] = {
+            "ops": len(partition.operations),
+            "size_in_blocks": sum(ext.num_blocks for op in partition.operations for ext in op.dst_extents),
+            "data_start": data_start,
+            "data_end": data_end,
+        }
+    return index
+
+
+def write_atomic(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def stale(identity: str) -> bool:
+    """True for the entry of a local payload that changed or is gone since"""
+    if not identity.startswith("file:"):
+        return False
+    path = identity[len("file:"):].rsplit(":", 2)[0]
+    try:
+        return file_identity(path) != identity
+    except OSError:
+        return True
+
+
+def prune(directory: str, keep: str = None):
+    """drop stale entries, then the least recently used beyond the limits; `keep` is the prefix just written"""
+    entries = {}
+    now = time.time()
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if name.endswith(".tmp"):
+            if now - st.st_mtime > STALE_TMP_S:
+                remove(path)
+            continue
+        prefix, ext = os.path.splitext(name)
+        if ext not in (".json", ".manifest", ".metadata"):
+            continue
+        entry = entries.setdefault(prefix, {"size": 0, "used": 0.0, "stale": False, "paths": []})
+        entry["size"] += st.st_size
+        entry["used"] = max(entry["used"], st.st_mtime)
+        entry["paths"].append(path)
+        if ext == ".json" and prefix != keep:
+            try:
+                with open(path) as f:
+                    entry["stale"] = stale(json.load(f).get("identity", ""))
+            except (OSError, ValueError, AttributeError):
+                entry["stale"] = True
+    # stale ones first, then the least recently used
+    order = sorted((p for p in entries if p != keep), key=lambda p: (not entries[p]["stale"], entries[p]["used"]))
+    count = len(entries)
+    total = sum(e["size"] for e in entries.values())
+    for prefix in order:
+        entry = entries[prefix]
+        if not entry["stale"] and count <= MAX_ENTRIES and total <= MAX_BYTES:
+            break
+        for path in entry["paths"]:
+            remove(path)
+        count -= 1
+        total -= entry["size"]
+
+
+def remove(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class PayloadCache:
+    def __init__(self, directory: str, identity: str):
+        self.directory = directory
+        self.identity = identity
+        self.prefix = os.path.join(directory, hashlib.sha256(identity.encode()).hexdigest()[:32])
+
+    def load_manifest(self):
+        """the saved entry with `manifest` and `metadata_signature` bytes, or None"""
+        try:
+            with open(self.prefix + ".json") as f:
+                entry = json.load(f)
+            if entry.get("version") != CACHE_VERSION or entry.get("identity") != self.identity:
+                return None
+            with open(self.prefix + ".manifest", "rb") as f:
+                blob = f.read()
+        except (OSError, ValueError):
+            return None
+        if len(blob) != entry["manifest_size"] + entry["metadata_signature_size"]:
+            return None
+        try:
+            # the mtime of the entry is when it was last used, see prune()
+            os.utime(self.prefix + ".json")
+        except OSError:
+            pass
+        entry["manifest"] = blob[:entry["manifest_size"]]
+        entry["metadata_signature"] = blob[entry["manifest_size"]:]
+        return entry
+
+    def save_manifest(self, base_off: int, data_offset: int, manifest: bytes, metadata_signature: bytes, index):
+        entry = {
+            "version": CACHE_VERSION,
+            "identity": self.identity,
+            "base_off": base_off,
+            "data_offset": data_offset,
+            "manifest_size": len(manifest),
+            "metadata_signature_size": len(metadata_signature),
+            "index": index,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # blob first, an entry never points at a missing or shorter blob
+            write_atomic(self.prefix + ".manifest", bytes(manifest) + bytes(metadata_signature))
+            write_atomic(self.prefix + ".json", json.dumps(entry).encode())
+        except OSError as e:
+            print(f"Failed to write manifest cache: {e}")
+            return
+        prune(self.directory, os.path.basename(self.prefix))
+
+    def load_metadata(self):
+        try:
+            with open(self.prefix + ".metadata", "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def save_metadata(self, data: bytes):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_atomic(self.prefix + ".metadata", bytes(data))
+        except OSError as e:
+            print(f"Failed to write metadata cache: {e}")
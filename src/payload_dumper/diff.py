@@ -0,0 +1,181 @@
+"""
+Manifest diff: payload_dumper diff OLD NEW
+
+Compares two payloads without extracting either, only their headers and
+manifests are read (a few small range requests for a remote payload, nothing
+with a warm manifest cache). For every partition it reports the size and hash
+change, the dst blocks whose content comes from a different source in NEW,
+and the op data NEW has to download to update images extracted from OLD with
+--update (the ops whose incremental.op_key OLD doesn't have).
+
+Two dst blocks are produced the same way when they are written by ops of the
+same type with the same data and source hashes, at the same position of the
+op's output.
+"""
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import incremental
+from . import progress
+from .update_metadata_pb2 import InstallOperation
+
+
+def open_manifest(source: str, headers=None, use_cache=True):
+    """a Dumper that has read the manifest of `source` and nothing else"""
+    from .api import open_payload_file
+    from .dumper import Dumper
+
+    payload_file = open_payload_file(source, headers)
+    try:
+        payload_cache = None
+        if use_cache:
+            from . import cache
+            payload_cache = cache.for_payload(source, payload_file)
+        return Dumper(payload_file, None, cache=payload_cache, manager=progress.NullManager())
+    finally:
+        payload_file.close()
+
+
+def producers(partition):
+    """
+    sorted (start, end, key, pos) dst block ranges: key identifies the op
+    writing them, pos is the block of the op's output written at `start`
+    """
+    ranges = []
+    for op in partition.operations:
+        if op.type == InstallOperation.DISCARD:
+            # undefined content, nothing to compare
+            continue
+        key = (op.type, op.data_sha256_hash, op.src_sha256_hash)
+        pos = 0
+        for ext in op.dst_extents:
+            ranges.append((ext.start_block, ext.start_block + ext.num_blocks, key, pos))
+            pos += ext.num_blocks
+    ranges.sort(key=lambda r: r[0])
+    return ranges
+
+
+def changed_blocks(old_ranges, new_ranges) -> int:
+    """blocks of `new_ranges` not produced the same way in `old_ranges`"""
+    changed = 0
+    i = 0
+    for start, end, key, pos in new_ranges:
+        # the old ranges are sorted too, skip the ones ending before this
+        while i < len(old_ranges) and old_ranges[i][1] <= start:
+            i += 1
+        same = 0
+        j = i
+        while j < len(old_ranges) and old_ranges[j][0] < end:
+            o_start, o_end, o_key, o_pos = old_ranges[j]
+            lo, hi = max(start, o_start), min(end, o_end)
+            if lo < hi and o_key == key and o_pos + (lo - o_start) == pos + (lo - start):
+                same += hi - lo
+            j += 1
+        changed += end - start - same
+    return changed
+
+
+def diff_partition(old, new):
+    name = (new or old).partition_name
+    result = {"partition_name": name}
+    if new is None:
+        result["status"] = "removed"
+        result["old_size"] = old.new_partition_info.size
+        return result
+    new_keys = [incremental.op_key(op) for op in new.operations]
+    if old is None:
+        result.update(
+            status="added",
+            new_size=new.new_partition_info.size,
+            changed_blocks=sum(ext.num_blocks for op in new.operations for ext in op.dst_extents),
+            download_ops=len(new.operations),
+            download_bytes=sum(op.data_length for op in new.operations),
+        )
+        return result
+
+    old_keys = {incremental.op_key(op) for op in old.operations}
+    # what --update fetches: ops whose output isn't identified by an op of the old build
+    download = [op for op, key in zip(new.operations, new_keys) if key is None or key not in old_keys]
+    same_hash = bool(new.new_partition_info.hash) and old.new_partition_info.hash == new.new_partition_info.hash
+    result.update(
+        old_size=old.new_partition_info.size,
+        new_size=new.new_partition_info.size,
+        hash_changed=not same_hash,
+        changed_blocks=changed_blocks(producers(old), producers(new)),
+        download_ops=len(download),
+        download_bytes=sum(op.data_length for op in download),
+    )
+    if same_hash and old.new_partition_info.size == new.new_partition_info.size:
+        result["status"] = "unchanged"
+    else:
+        result["status"] = "changed"
+    return result
+
+
+def diff_manifests(old_dam, new_dam, names=None):
+    old_parts = {p.partition_name: p for p in old_dam.partitions}
+    new_parts = {p.partition_name: p for p in new_dam.partitions}
+    order = [p.partition_name for p in new_dam.partitions]
+    order += [name for name in old_parts if name not in new_parts]
+    if names:
+        order = [name for name in order if name in names]
+    return [diff_partition(old_parts.get(name), new_parts.get(name)) for name in order]
+
+
+def format_result(r, block_size: int) -> str:
+    from .dumper import format_size
+
+    name = r["partition_name"]
+    if r["status"] == "removed":
+        return f"{name}: removed ({format_size(r['old_size'])})"
+    download = f"download {format_size(r['download_bytes'])} in {r['download_ops']} ops"
+    if r["status"] == "added":
+        return f"{name}: added ({format_size(r['new_size'])}), {download}"
+    size = format_size(r["new_size"])
+    if r["old_size"] != r["new_size"]:
+        size = f"{format_size(r['old_size'])} -> {size}"
+    if r["status"] == "unchanged":
+        return f"{name}: unchanged ({size})"
+    changed = r["changed_blocks"] * block_size
+    return (
+        f"{name}: {size}, hash {'changed' if r['hash_changed'] else 'same'}, "
+        f"{format_size(changed)} of blocks produced differently, {download}"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="payload_dumper diff", description="compare the manifests of two payloads")
+    parser.add_argument("old", help="payload file name or URL of the old build")
+    parser.add_argument("new", help="payload file name or URL of the new build")
+    parser.add_argument("--partitions", default="", help="comma separated partition names (default: all)")
+    parser.add_argument("--json", metavar="FILE", help="write the per-partition results as JSON to FILE")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the manifest cache")
+    parser.add_argument("--header", action="append", nargs=2)
+    args = parser.parse_args(argv)
+    headers = dict(args.header) if args.header is not None else None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        old, new = executor.map(lambda s: open_manifest(s, headers, not args.no_cache), (args.old, args.new))
+    names = {name.strip() for name in args.partitions.split(",") if name.strip()}
+    results = diff_manifests(old.dam, new.dam, names)
+    wall = time.perf_counter() - start
+
+    from .dumper import format_size
+
+    for r in results:
+        print(format_result(r, new.block_size))
+    changed = [r for r in results if r["status"] != "unchanged"]
+    print(
+        f"\n{len(changed)} of {len(results)} partitions differ, "
+        f"download {format_size(sum(r.get('download_bytes', 0) for r in results))} to update, "
+        f"compared in {wall:.2f}s"
+    )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"old": args.old, "new": args.new, "block_size": new.block_size, "partitions": results}, f, indent=2)
+    if changed:
+        sys.exit(1)
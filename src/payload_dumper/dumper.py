@@ -1,29 +1,34 @@
 #!/usr/bin/env python
-import bz2
 import io
 import json
-import lzma
+import logging
 import os
 import struct
 import sys
-from zstd import ZSTD_uncompress
 from concurrent.futures import ThreadPoolExecutor
 from concurrent import futures
-from multiprocessing import cpu_count
 from functools import partial
-import signal
-
-import bsdiff4.core
-from enlighten import get_manager
 
 import hashlib
-import brotli
+from contextlib import nullcontext
 
+from . import cache
+from . import estimate
+from . import incremental
 from . import mtio
+from . import payload
+from . import progress
+from . import shard
+from . import sparse
+from . import streamio
+from . import tracing
 from . import update_metadata_pb2 as um
+from . import verity
+from . import writeback
 from .update_metadata_pb2 import InstallOperation
-from .ziputil import get_zip_stored_entry_offset
-from .future_util import CombinedFuture, wait_interruptible
+from .streaminput import StreamPayload
+from .ziputil import get_zip_stored_entry_offset, get_zip_stored_entry_offset_sequential
+from .future_util import CombinedFuture, gather, submit_after, wait_interruptible
 
 
 def u32(x):
@@ -33,14 +38,26 @@ def u32(x):
 def u64(x):
     return struct.unpack(">Q", x)[0]
 
+log = logging.getLogger(__name__)
+
 BSDF2_MAGIC = b'BSDF2'
 
+# largest single read when copying operation data for --export-payload
+EXPORT_MAX_REQUEST = 16 << 20
+
+# consecutive ops are queued as one task of up to this cost (see shard.op_cost),
+# a partition is split into at least this many tasks per worker
+MAX_BATCH_COST = 8 << 20
+BATCHES_PER_WORKER = 4
+
 def bsdf2_decompress(alg, data):
     if alg == 0:
         return data
     elif alg == 1:
+        import bz2
         return bz2.decompress(data)
     elif alg == 2:
+        import brotli
         return brotli.decompress(data)
     else:
         raise ValueError(f'unknown algorithm {alg}')
@@ -50,6 +67,8 @@ def bsdf2_decompress(alg, data):
 def bsdf2_read_patch(fi):
     """read a bsdiff/BSDF2-format patch from stream 'fi'
     """
+    import bsdiff4.core
+    import bsdiff4.format
     magic = fi.read(8)
     if magic == bsdiff4.format.MAGIC:
         # bsdiff4 uses bzip2 (algorithm 1)
@@ -79,38 +98,126 @@ def bsdf2_read_patch(fi):
     return len_dst, tcontrol, bdiff, bextra
 
 
+def format_size(size_in_bytes: int) -> str:
+    if size_in_bytes >= 1024**3:
+        return f"{size_in_bytes / 1024**3:.1f}GB"
+    elif size_in_bytes >= 1024**2:
+        return f"{size_in_bytes / 1024**2:.1f}MB"
+    return f"{size_in_bytes / 1024:.1f}KB"
+
+
 class Dumper:
     def __init__(
-        self, payloadfile, out, diff=None, old=None, images="", workers=cpu_count(), list_partitions=False, extract_metadata=False
+        self, payloadfile, out, diff=None, old=None, images="", workers=os.cpu_count(), list_partitions=False, extract_metadata=False,
+        stream=None, tar=False, out_format="raw", super_image=False, super_size=None, slot_suffix="",
+        export_payload=None, estimate=False, calibration=None, cache=None, shard=None, verify=False,
+        job=None, manager=None, update=False, tuner=None, readahead=0, verity=None, fec=True,
+        io_policy="default", dirty_limit=writeback.DEFAULT_DIRTY_LIMIT
     ):
         self.payloadfile: mtio.MTIOBase = payloadfile
-        self.manager = get_manager()
-        self.out = out
+        # created on first use, --list/--metadata/--estimate never draw progress
+        self._manager = manager
+        self.own_manager = manager is None
+        # a scheduler.Job when running as part of a batch, ops go to its shared pool
+        self.job = job
+        # a tuner.Autotuner adjusting fetch and decode concurrency while ops run
+        self.tuner = tuner
+        # window in bytes of the sequential read-ahead of a local payload, 0 for none
+        self.readahead = readahead
+        # what ops fetch their data from ahead of the workers, see new_fetcher()
+        self.fetcher = None
+        # images are uploaded to s3://bucket/prefix instead, see s3.py
+        self.s3_out = isinstance(out, str) and out.startswith("s3://")
+        self.out = out.rstrip("/") if self.s3_out else out
+        self.s3_client = None
+        self.uploads = []
+        # when set, partitions are written sequentially to this binary stream
+        # instead of files under `out`, as a tar archive if `tar` is set
+        self.stream = stream
+        self.tar = streamio.TarStream(stream) if tar and stream is not None else None
+        # raw: plain images, sparse: Android sparse images, zst: seekable zstd compressed images
+        self.out_format = out_format
+        # lay out the dynamic partitions in a single super.img instead of separate images
+        self.super_image = super_image
+        self.super_size = super_size
+        self.slot_suffix = slot_suffix
+        self.super = None
+        # write a payload containing only the selected partitions to this path
+        self.export_payload = export_payload
+        # only report what extracting the selected partitions would cost
+        self.estimate = estimate
+        self.calibration = calibration
+        # PayloadCache of the zip offset, manifest and OTA metadata, or None
+        self.cache = cache
+        self.index = None
+        # (index, count): apply only this slice of the operations, see shard.py
+        self.shard = shard
+        # check the images in `out` against the manifest hashes instead of extracting
+        self.verify = verify
+        # rewrite only what changed in existing images, see incremental.py
+        self.update = update
+        # partition name -> {op key: digest of its output} for the digest sidecars
+        self.digests = {}
+        # "write" or "verify" the dm-verity hash tree and FEC of the images, see verity.py
+        self.verity = verity
+        self.fec = fec
+        self.verity_problems = 0
+        # how raw images are written back to disk, see writeback.py
+        self.io_policy = writeback.Policy(io_policy, dirty_limit)
         self.diff = diff
         self.old = old
         self.images = images
         self.workers = workers
         self.list_partitions = list_partitions
         self.extract_metadata = extract_metadata
+        # a payload piped in can only be read forward, see streaminput.py
+        self.streamed = isinstance(self.payloadfile, StreamPayload)
+        self.zip_entry_offset = get_zip_stored_entry_offset_sequential if self.streamed else get_zip_stored_entry_offset
 
         if self.extract_metadata:
             self.extract_and_display_metadata()
         else:
-            try:
-                off, size = get_zip_stored_entry_offset(self.payloadfile, 'payload.bin')
-                #print(f'payload.bin in zip {off=} {size=}')
-                self.base_off = off
-            except:
-                #from traceback import print_exc
-                #print_exc()
-                #print('not a zip')
-                self.base_off = 0
+            if not self.load_cached_metadata():
+                try:
+                    off, size = self.zip_entry_offset(self.payloadfile, 'payload.bin')
+                    #print(f'payload.bin in zip {off=} {size=}')
+                    self.base_off = off
+                except:
+                    #from traceback import print_exc
+                    #print_exc()
+                    #print('not a zip')
+                    self.base_off = 0
 
-            self.parse_metadata()
+                self.parse_metadata()
 
             if self.list_partitions:
                 self.list_partitions_info()
 
+    @property
+    def manager(self):
+        if self._manager is None:
+            self._manager = progress.get_manager(stream=sys.stdout)
+        return self._manager
+
+    def stop_manager(self):
+        if self._manager is not None and self.own_manager:
+            self._manager.stop()
+
+    def new_executor(self, workers=None):
+        if self.job is not None:
+            return self.job
+        return ThreadPoolExecutor(max_workers=workers or self.workers)
+
+    def fetch_slot(self, size: int):
+        if self.tuner is None:
+            return nullcontext()
+        return self.tuner.fetch_slot(size)
+
+    def decode_slot(self, size: int):
+        if self.tuner is None:
+            return nullcontext()
+        return self.tuner.decode_slot(size)
+
     def run(self):
         if self.list_partitions or self.extract_metadata:
             return
@@ -134,17 +241,89 @@ class Dumper:
             print("Not operating on any partitions")
             return 0
 
+        if self.estimate:
+            self.estimate_partitions(partitions)
+            return 0
+
+        if self.streamed and (
+            self.export_payload is not None or self.stream is not None or self.out_format != "raw" or self.s3_out
+        ):
+            # those read the payload out of order or consume ops in dst order
+            print("A payload read from stdin can only be extracted to raw image files")
+            return 0
+
+        if self.export_payload is not None:
+            self.export_partitions(partitions)
+            self.stop_manager()
+            self.payloadfile.close()
+            return 0
+
+        if self.s3_out and (
+            self.verify or self.shard is not None or self.update or self.verity is not None
+            or self.super_image
+        ):
+            # those read back or rewrite parts of image files
+            print("An s3:// output only takes whole images, without --verify, --shard, --update, --verity or --super")
+            return 0
+
+        if self.verify:
+            return self.verify_partitions(partitions)
+
+        if self.shard is not None and (self.stream is not None or self.out_format != "raw" or self.super_image):
+            # shards write into the same preallocated files
+            print("--shard can only write raw image files")
+            return 0
+
+        if self.verity is not None and (self.shard is not None or self.stream is not None or self.out_format != "raw"):
+            # the data is read back from the image once the ops landed
+            print("--verity needs whole raw image files")
+            return 0
+
+        if self.update and (self.shard is not None or self.stream is not None or self.out_format != "raw" or self.super_image):
+            print("--update can only rewrite raw image files")
+            return 0
+
+        if self.stream is not None and self.tar is None and len(partitions) > 1:
+            print("Streaming more than one partition requires --tar")
+            return 0
+
+        if self.tar is not None and self.out_format == "zst":
+            # tar headers need the entry size before the data
+            print("Compressed output can't be written to a tar archive")
+            return 0
+
+        if self.super_image:
+            if self.stream is not None or self.out_format != "raw":
+                print("super.img can only be written as a raw image file")
+                return 0
+            self.super = self.open_super(partitions)
+            if self.super is None:
+                return 0
+
+        owners = None
+        if self.shard is not None:
+            owners = shard.assign(partitions, self.block_size, self.shard[1])
+
+        if self.update:
+            partitions = self.plan_update(partitions)
+
+        if self.streamed:
+            # the stream is consumed once, partition after partition
+            partitions = sorted(partitions, key=self.first_data_offset)
+
         partitions_with_ops = []
         for partition in partitions:
             operations = []
-            for operation in partition.operations:
-                operations.append(
-                    {
-                        "operation": operation,
-                        "offset": self.data_offset + operation.data_offset,
-                        "length": operation.data_length,
-                    }
-                )
+            kept = self.digests.get(partition.partition_name)
+            for i, operation in enumerate(partition.operations):
+                if owners is not None and owners[partition.partition_name][i] != self.shard[0]:
+                    continue
+                key = None
+                if kept is not None:
+                    key = incremental.op_key(operation)
+                    if key in kept:
+                        continue
+                operations.append(self.op_entry(operation, key))
             partitions_with_ops.append(
                 {
                     "partition": partition,
@@ -152,65 +331,430 @@ class Dumper:
                 }
             )
 
-        self.multiprocess_partitions(partitions_with_ops)
-        self.manager.stop()
+        try:
+            self.multiprocess_partitions(partitions_with_ops)
+        except BaseException:
+            # no image that didn't get all of its data appears in the bucket
+            for upload in self.uploads:
+                upload.abort()
+            raise
+        if self.shard is not None:
+            shard.write_marker(
+                self.out, *self.shard, self.dam, partitions,
+                sum(len(p["operations"]) for p in partitions_with_ops)
+            )
+        if self.super is not None:
+            self.super.close()
+        if self.tar is not None:
+            self.tar.close()
+        elif self.stream is not None:
+            self.stream.flush()
+        self.stop_manager()
         self.payloadfile.close()
         # make progressbar not overlaid by shell prompt
         print()
+        if self.verity_problems:
+            print(f"--verity {self.verity}: {self.verity_problems} problems")
+            return 1
+
+    def op_entry(self, operation: InstallOperation, key=None):
+        return {
+            "operation": operation,
+            "offset": self.data_offset + operation.data_offset,
+            "length": operation.data_length,
+            "key": key,
+        }
+
+    def first_data_offset(self, partition) -> int:
+        return min((op.data_offset for op in partition.operations if op.data_length > 0), default=0)
+
+    def new_fetcher(self):
+        if hasattr(self.payloadfile, "fetch"):
+            return self.payloadfile
+        if self.streamed:
+            from .readahead import DEFAULT_WINDOW, ReadAhead
+            return ReadAhead(self.payloadfile, self.readahead or DEFAULT_WINDOW)
+        if self.readahead > 0 and isinstance(self.payloadfile, mtio.MTFile):
+            from .readahead import ReadAhead
+            return ReadAhead(self.payloadfile, self.readahead)
+        return None
 
     def multiprocess_partitions(self, partitions):
-        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+        self.fetcher = self.new_fetcher()
+        if self.tuner is not None:
+            self.tuner.start(self.manager)
+        try:
+            self.apply_partitions(partitions)
+        finally:
+            if self.tuner is not None:
+                self.tuner.stop()
+            if self.fetcher is not None and self.fetcher is not self.payloadfile:
+                self.fetcher.close()
+
+    def apply_partitions(self, partitions):
+        with self.new_executor(self.tuner.workers if self.tuner is not None else None) as executor:
             for part in partitions:
                 try:
                     partition_name = part["partition"].partition_name
                     bar = self.manager.counter(
-                        total=len(part["operations"]),
+                        total=sum(self.op_dst_bytes(op["operation"]) for op in part["operations"]),
                         desc=f"{partition_name}",
-                        unit="ops",
+                        unit="B",
                     )
 
-                    out_file = mtio.MTFile("%s/%s.img" % (self.out, partition_name), "w")
+                    if "out_file" in part:
+                        # a sink of the caller's, see api.py
+                        out_file = part["out_file"]
+                    else:
+                        out_file = self.open_out_file(part["partition"], executor)
 
                     if self.diff:
                         old_file = mtio.MTFile("%s/%s.img" % (self.old, partition_name), "rb")
                     else:
                         old_file = None
 
-                    ops = part['operations']
-                    tasks = []
-                    for op in ops:
-                        tasks.append(
-                            executor.submit(
-                                self.do_op,
-                                partition_name,
-                                op,
-                                out_file, old_file, bar
+                    with tracing.span(partition_name, "partition", ops=len(part['operations'])):
+                        ops = part['operations']
+                        ordered = isinstance(out_file, streamio.OrderedWriter)
+                        prefetch = self.fetcher is not None
+                        if ordered:
+                            # emit in dst order, queue ops the way the stream consumes them
+                            ops = sorted(ops, key=self.op_dst_start)
+                        else:
+                            # in payload order, reads are sequential and adjacent ops share them
+                            ops = sorted(ops, key=lambda op: op["offset"])
+                        builder = None
+                        if self.verity is not None and verity.has_verity(part["partition"]):
+                            builder = verity.VerityBuilder(
+                                part["partition"], self.block_size, out_file, executor,
+                                verify=self.verity == "verify", fec=self.fec
                             )
-                        )
+                            builder.start(ops)
+                        tasks = []
+                        for batch in self.batch_ops(ops):
+                            if ordered and not out_file.reserve(sum(self.op_out_bytes(op["operation"]) for op in batch)):
+                                break
+                            runs = self.batch_runs(batch)
+                            submit_args = {}
+                            if self.job is not None:
+                                # memory the task holds while running: its data and the largest decoded output
+                                submit_args["cost"] = sum(run[2] for run in runs) + max(
+                                    self.op_out_bytes(op["operation"]) for op in batch
+                                )
+                            if prefetch and runs:
+                                # the fetch engine reads ahead, the pool only decodes and writes
+                                fetched = gather(self.fetcher.fetch_batch([(src, length) for src, _, length, _ in runs]))
+                                task = submit_after(
+                                    fetched, executor,
+                                    self.do_batch, partition_name, batch, runs, out_file, old_file, bar,
+                                    **submit_args
+                                )
+                                task.add_done_callback(partial(self.release_prefetched, sum(run[2] for run in runs)))
+                            else:
+                                task = executor.submit(
+                                    self.do_batch,
+                                    None,
+                                    partition_name,
+                                    batch,
+                                    runs,
+                                    out_file, old_file, bar,
+                                    **submit_args
+                                )
+                            if ordered:
+                                task.add_done_callback(out_file.op_done)
+                            if builder is not None:
+                                task.add_done_callback(partial(builder.batch_done, batch))
+                            tasks.append(task)
+
+                        dones, _ = wait_interruptible(tasks, return_when=futures.FIRST_EXCEPTION)
+                        for t in dones:
+                            e = t.exception(0)
+                            if e is not None:
+                                # batches still queued would only run into the same failure
+                                for task in tasks:
+                                    task.cancel()
+                                raise e
 
-                    dones, _ = wait_interruptible(tasks, return_when=futures.FIRST_EXCEPTION)
-                    for t in dones:
-                        e = t.exception(0)
-                        if e is not None:
-                            raise e
+                        if builder is not None:
+                            self.finish_verity(builder)
 
                     out_file.close()
+                    if self.update:
+                        self.save_update_sidecar(part["partition"])
+                    if self.tar is not None:
+                        self.tar.end_entry()
                     if old_file is not None:
                         old_file.close()
                     bar.close()
                 except KeyboardInterrupt:
                     try:
                         bar.close()
-                        self.manager.stop()
+                        self.stop_manager()
                     except:
                         pass
-                    print('Stopping ...')
-                    if sys.platform == 'win32':
-                        os.kill(os.getpid(), signal.CTRL_BREAK_EVENT)
-                    else:
-                        os.kill(os.getpid(), signal.SIGKILL)
-                    sys.exit(1)
+                    log.info('Stopping ...')
+                    # the CLI ends the process, workers blocked in reads don't see the interrupt
+                    raise
+
+
+    def finish_verity(self, builder):
+        name = builder.partition.partition_name
+        with tracing.span("verity", "partition", partition=name):
+            try:
+                root, problems = builder.finish()
+            except ValueError as e:
+                root, problems = None, [str(e)]
+        if root is not None:
+            log.info(f"{name}: verity root {root.hex()}")
+        for problem in problems:
+            log.warning(f"{name}: {problem}")
+        self.verity_problems += len(problems)
+
+    def open_super(self, partitions):
+        dpm = self.dam.dynamic_partition_metadata
+        if len(dpm.groups) == 0:
+            print("Payload has no dynamic partition metadata")
+            return None
+        sizes = {p.partition_name: self.partition_size(p) for p in partitions}
+        path = os.path.join(self.out, "super.img")
+        from .super_image import SuperImage
+        sup = SuperImage(path, dpm, sizes, size=self.super_size, slot_suffix=self.slot_suffix)
+        print(f"Writing {len(sup.layout)} dynamic partitions to {path} ({sup.size} bytes)")
+        return sup
+
+    def open_out_file(self, partition, executor) -> mtio.MTIOBase:
+        name = partition.partition_name
+        if self.super is not None and name in self.super:
+            return self.super.open_partition(name)
+        path = self.out_path(partition)
+        if self.stream is None and self.out_format == "raw" and not self.s3_out:
+            # --verity reads the data back
+            readable = "r" if self.verity is not None else ""
+            if self.shard is not None or (self.update and self.digests.get(name)):
+                # other shards write to the same file, an update keeps unchanged ops, never truncate it
+                out_file = self.io_policy.open(path, readable + "+")
+                out_file.set_size(self.partition_size(partition))
+                return out_file
+            return self.io_policy.open(path, readable + "w")
+
+        size = self.partition_size(partition)
+        if self.out_format == "sparse":
+            chunks = sparse.plan_chunks(partition, self.block_size, size)
+            out_size = sparse.image_size(chunks, self.block_size)
+        else:
+            out_size = size
 
+        close_fp = False
+        if self.tar is not None:
+            self.tar.add(f"{name}.img", out_size)
+            fp = self.tar
+        elif self.stream is not None:
+            fp = self.stream
+        elif self.s3_out:
+            # compressed, the object size is only known at the end
+            fp = self.open_upload(path, None if self.out_format == "zst" else out_size)
+            close_fp = True
+        else:
+            fp = open(path, "wb")
+            close_fp = True
+
+        if self.out_format == "sparse":
+            return sparse.SparseWriter(fp, self.block_size, chunks, close_fp=close_fp)
+        if self.out_format == "zst":
+            from . import seekable
+            return seekable.SeekableZstdWriter(fp, size, self.zero_extents(partition), executor, close_fp=close_fp)
+        return streamio.OrderedWriter(fp, size, self.zero_extents(partition), close_fp=close_fp)
+
+    def open_upload(self, url: str, size):
+        from . import s3
+        if self.s3_client is None:
+            self.s3_client = s3.S3Client()
+        upload = s3.S3Upload(self.s3_client, url, size)
+        self.uploads.append(upload)
+        return upload
+
+    def save_output(self, name: str, data: bytes) -> str:
+        """write a small file `name` of the output, uploaded with an s3:// one; returns where it went"""
+        if self.s3_out:
+            path = f"{self.out}/{name}"
+            upload = self.open_upload(path, len(data))
+            upload.write(data)
+            upload.close()
+            return path
+        path = os.path.join(self.out, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def out_path(self, partition) -> str:
+        path = "%s/%s.img" % (self.out, partition.partition_name)
+        if self.out_format == "zst":
+            path += ".zst"
+        return path
+
+    def save_update_sidecar(self, partition):
+        """
+        the sidecar of an image --update rewrote; the partition hash is only
+        recorded once the image is checked against it, an image that doesn't
+        match keeps no op digests and is rewritten from scratch next time
+        """
+        path = self.out_path(partition)
+        size = self.partition_size(partition)
+        expected = partition.new_partition_info.hash
+        digests = self.digests[partition.partition_name]
+        if not expected:
+            checked = b""
+        elif os.path.getsize(path) == size and shard.hash_file(path, size) == expected:
+            checked = expected
+        else:
+            print(f"{partition.partition_name}: image doesn't match the manifest hash, the next --update rewrites it")
+            checked = b""
+            digests = {}
+        incremental.save_sidecar(path, self.block_size, checked, digests)
+
+    def plan_update(self, partitions):
+        """the partitions whose images need writing, their unchanged ops go to self.digests"""
+        def plan(partition):
+            return incremental.plan_partition(
+                self.out_path(partition), partition, self.block_size, self.partition_size(partition)
+            )
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            plans = list(executor.map(plan, partitions))
+        changed = []
+        for partition, (skip, kept) in zip(partitions, plans):
+            name = partition.partition_name
+            if skip:
+                print(f"{name}: unchanged")
+                continue
+            print(f"{name}: {len(partition.operations) - len(kept)} of {len(partition.operations)} ops changed")
+            self.digests[name] = dict(kept)
+            changed.append(partition)
+        return changed
+
+    def partition_size(self, partition) -> int:
+        if partition.new_partition_info.size:
+            return partition.new_partition_info.size
+        return max(
+            (ext.start_block + ext.num_blocks for op in partition.operations for ext in op.dst_extents),
+            default=0
+        ) * self.block_size
+
+    def zero_extents(self, partition):
+        # everything not produced by an op carrying data reads back as zeros
+        data_extents = [
+            (ext.start_block * self.block_size, ext.num_blocks * self.block_size)
+            for op in partition.operations
+            if op.type not in (InstallOperation.ZERO, InstallOperation.DISCARD)
+            for ext in op.dst_extents
+        ]
+        return streamio.complement_extents(data_extents, self.partition_size(partition))
+
+    def op_dst_start(self, op):
+        dst_extents = op["operation"].dst_extents
+        return dst_extents[0].start_block if dst_extents else 0
+
+    def op_dst_bytes(self, op: InstallOperation) -> int:
+        return sum(ext.num_blocks for ext in op.dst_extents) * self.block_size
+
+    def batch_ops(self, ops):
+        """
+        consecutive ops grouped into tasks of about the same cost, partitions of
+        many tiny ops don't pay executor and future overhead for every op
+        """
+        costs = [shard.op_cost(op["operation"], self.block_size) for op in ops]
+        target = min(MAX_BATCH_COST, max(1, sum(costs) // (self.workers * BATCHES_PER_WORKER)))
+        if self.fetcher is not None:
+            # a batch reserves the data of all its reads at once, keep a few in the fetch window
+            target = min(target, max(1, self.fetcher.window // 4))
+        batches = []
+        batch = []
+        batch_cost = 0
+        for op, cost in zip(ops, costs):
+            batch.append(op)
+            batch_cost += cost
+            if batch_cost >= target:
+                batches.append(batch)
+                batch = []
+                batch_cost = 0
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def planned_reads(self, partition) -> int:
+        """payload reads extracting all of `partition` makes, one per run of batch_runs()"""
+        ops = sorted((self.op_entry(op) for op in partition.operations), key=lambda op: op["offset"])
+        return sum(len(self.batch_runs(batch)) for batch in self.batch_ops(ops))
+
+    def batch_runs(self, batch):
+        """the data of a batch as (offset, _, length, [(offset, _, length, op index)]) reads, adjacent ops share one"""
+        ranges = [
+            (self.base_off + op["offset"], self.base_off + op["offset"], op["length"], i)
+            for i, op in enumerate(batch) if op["length"] > 0
+        ]
+        return payload.coalesce_ranges(ranges, MAX_BATCH_COST)
+
+    def op_out_bytes(self, op: InstallOperation) -> int:
+        if op.type in (InstallOperation.ZERO, InstallOperation.DISCARD):
+            return 0
+        return sum(ext.num_blocks for ext in op.dst_extents) * self.block_size
+
+    def export_partitions(self, partitions):
+        dam = um.DeltaArchiveManifest()
+        dam.CopyFrom(self.dam)
+        del dam.partitions[:]
+        # the original signatures don't cover the new payload
+        dam.ClearField("signatures_offset")
+        dam.ClearField("signatures_size")
+        dam.partial_update = True
+
+        copies = []
+        data_size = 0
+        for partition in partitions:
+            new_part = dam.partitions.add()
+            new_part.CopyFrom(partition)
+            for op in new_part.operations:
+                if op.data_length == 0:
+                    continue
+                copies.append((self.base_off + self.data_offset + op.data_offset, data_size, op.data_length, op.data_sha256_hash))
+                op.data_offset = data_size
+                data_size += op.data_length
+
+        names = set(p.partition_name for p in partitions)
+        for group in dam.dynamic_partition_metadata.groups:
+            kept = [name for name in group.partition_names if name in names]
+            del group.partition_names[:]
+            group.partition_names.extend(kept)
+
+        out_file = mtio.MTFile(self.export_payload, "w")
+        data_start = payload.write_payload_metadata(out_file, dam.SerializeToString())
+        out_file.set_size(data_start + data_size)
+
+        bar = self.manager.counter(total=data_size, desc="export", unit="B")
+        runs = payload.coalesce_ranges(copies, EXPORT_MAX_REQUEST)
+        try:
+            with self.new_executor() as executor:
+                tasks = [executor.submit(self.copy_run, run, out_file, data_start, bar) for run in runs]
+                dones, _ = wait_interruptible(tasks, return_when=futures.FIRST_EXCEPTION)
+                for t in dones:
+                    e = t.exception(0)
+                    if e is not None:
+                        raise e
+        finally:
+            out_file.close()
+            bar.close()
+        print(f"Exported {len(partitions)} partitions ({data_size} bytes of operation data) to {self.export_payload}")
+
+    def copy_run(self, run, out_file: mtio.MTIOBase, data_start: int, bar):
+        src_off, dst_off, length, members = run
+        data = self.payloadfile.read(src_off, length)
+        assert len(data) == length, 'short read'
+        for op_src, _, op_len, op_hash in members:
+            if op_hash:
+                op_data = memoryview(data)[op_src - src_off:op_src - src_off + op_len]
+                assert hashlib.sha256(op_data).digest() == op_hash, 'operation data hash mismatch'
+        out_file.write(data_start + dst_off, data)
+        bar.update(length)
 
     def parse_metadata(self):
         head_len = 4 + 8 + 8 + 4
@@ -240,114 +784,288 @@ class Dumper:
         self.dam.ParseFromString(manifest)
         self.block_size = self.dam.block_size
 
-    def data_for_op(self, operation, out_file: mtio.MTIOBase, old_file: mtio.MTIOBase):
+        if self.cache is not None:
+            self.index = cache.build_index(self.dam)
+            self.cache.save_manifest(self.base_off, self.data_offset, manifest, self.metadata_signature, self.index)
+
+    def load_cached_metadata(self) -> bool:
+        if self.cache is None:
+            return False
+        entry = self.cache.load_manifest()
+        if entry is None:
+            return False
+        self.base_off = entry["base_off"]
+        self.data_offset = entry["data_offset"]
+        self.metadata_signature = entry["metadata_signature"]
+        self.dam = um.DeltaArchiveManifest()
+        self.dam.ParseFromString(entry["manifest"])
+        self.block_size = self.dam.block_size
+        self.index = entry["index"]
+        return True
+
+    def data_for_op(self, operation, out_file: mtio.MTIOBase, old_file: mtio.MTIOBase, data=None):
+        """apply one op, returns the bytes it wrote (None for ZERO and DISCARD)"""
         offset = operation["offset"]
         length = operation["length"]
         op = operation["operation"]
         op: InstallOperation
 
-        data = self.payloadfile.read(self.base_off + offset, length)
+        if op.type in (InstallOperation.ZERO, InstallOperation.DISCARD):
+            # DISCARD contents are undefined, leave the destination untouched
+            if op.type == InstallOperation.ZERO:
+                with tracing.span("write", "stage"):
+                    for ext in op.dst_extents:
+                        out_file.write(ext.start_block * self.block_size, b"\x00" * ext.num_blocks * self.block_size)
+            return None
+
+        # `data` is passed in when the fetch engine already downloaded it
+        if data is None:
+            data = b""
+            if length > 0:
+                with self.fetch_slot(length), tracing.span("fetch", "stage", size=length):
+                    data = self.payloadfile.read(self.base_off + offset, length)
+
+        # the data, the source blocks of a diff op and the decoded output
+        held = len(data) + sum(ext.num_blocks for ext in op.src_extents) * self.block_size + self.op_out_bytes(op)
+        with self.decode_slot(held):
+            if op.data_sha256_hash:
+                with tracing.span("hash", "stage", size=len(data)):
+                    assert hashlib.sha256(data).digest() == op.data_sha256_hash, 'operation data hash mismatch'
 
-        if op.data_sha256_hash:
-            assert hashlib.sha256(data).digest() == op.data_sha256_hash, 'operation data hash mismatch'
+            with tracing.span("decode", "stage") as s:
+                data = self.decode_op(op, data, old_file)
+                s.set(size=len(data))
 
+            with tracing.span("write", "stage", size=len(data)):
+                self.write_extents(out_file, op.dst_extents, data)
+        return data
+
+    def decode_op(self, op: InstallOperation, data, old_file: mtio.MTIOBase):
+        # codecs are imported by the first op that needs them
         if op.type == InstallOperation.REPLACE_XZ:
+            import lzma
             dec = lzma.LZMADecompressor()
             data = dec.decompress(data)
-            assert op.dst_extents[0].num_blocks * self.block_size == len(data)
-            out_file.write(op.dst_extents[0].start_block * self.block_size, data)
+            assert self.op_out_bytes(op) == len(data)
         elif op.type == InstallOperation.REPLACE_BZ:
+            import bz2
             dec = bz2.BZ2Decompressor()
             data = dec.decompress(data)
-            assert op.dst_extents[0].num_blocks * self.block_size == len(data)
-            out_file.write(op.dst_extents[0].start_block * self.block_size, data)
+            assert self.op_out_bytes(op) == len(data)
         elif op.type == InstallOperation.REPLACE:
-            out_file.write(op.dst_extents[0].start_block * self.block_size, data)
+            pass
         elif op.type == InstallOperation.SOURCE_COPY:
             if not self.diff:
-                print("SOURCE_COPY supported only for differential OTA")
-                sys.exit(-2)
-            for ext in op.src_extents:
-                data = old_file.read(ext.start_block * self.block_size, ext.num_blocks * self.block_size)
-                out_file.write(op.dst_extents[0].start_block * self.block_size, data)
+                raise ValueError("SOURCE_COPY supported only for differential OTA")
+            data = b"".join(
+                old_file.read(ext.start_block * self.block_size, ext.num_blocks * self.block_size)
+                for ext in op.src_extents
+            )
         elif op.type in (InstallOperation.SOURCE_BSDIFF, InstallOperation.BROTLI_BSDIFF):
             if not self.diff:
-                print("SOURCE_BSDIFF supported only for differential OTA")
-                sys.exit(-3)
+                raise ValueError("SOURCE_BSDIFF supported only for differential OTA")
             tmp_buff = io.BytesIO()
             for ext in op.src_extents:
                 old_data = old_file.read(ext.start_block * self.block_size, ext.num_blocks * self.block_size)
                 tmp_buff.write(old_data)
             tmp_buff.seek(0)
             old_data = tmp_buff.read()
-            tmp_buff.seek(0)
-            tmp_buff.write(bsdiff4.core.patch(old_data, *bsdf2_read_patch(io.BytesIO(data))))
-            n = 0
-            tmp_buff.seek(0)
-            for ext in InstallOperation.dst_extents:
-                tmp_buff.seek(n * self.block_size)
-                n += ext.num_blocks
-                data = tmp_buff.read(ext.num_blocks * self.block_size)
-                out_file.write(ext.start_block * self.block_size, data)
-        elif op.type == InstallOperation.ZERO:
-            for ext in op.dst_extents:
-                out_file.write(ext.start_block * self.block_size, b"\x00" * ext.num_blocks * self.block_size)
+            import bsdiff4.core
+            data = bsdiff4.core.patch(old_data, *bsdf2_read_patch(io.BytesIO(data)))
         elif op.type == InstallOperation.ZSTD:
-            data = ZSTD_uncompress(data)
-            assert op.dst_extents[0].num_blocks * self.block_size == len(data)
-            out_file.write(op.dst_extents[0].start_block * self.block_size, data)
+            # ZSTD_uncompress only takes read-only buffers, HTTP reads return a bytearray
+            from zstd import ZSTD_uncompress
+            data = ZSTD_uncompress(bytes(data))
+            assert self.op_out_bytes(op) == len(data)
         else:
             raise ValueError("Unsupported type = %d" % op.type)
+        return data
+
+    def write_extents(self, out_file: mtio.MTIOBase, extents, data):
+        n = 0
+        for ext in extents:
+            size = ext.num_blocks * self.block_size
+            out_file.write(ext.start_block * self.block_size, data[n:n + size])
+            n += size
+
+    def do_batch(self, fetched, partition_name, batch, runs, out_file, old_file, bar):
+        """apply the ops of a batch in order, `fetched` holds the data of `runs` when the fetch engine downloaded it"""
+        datas = [None] * len(batch)
+        for n, (src, _, length, members) in enumerate(runs):
+            if fetched is not None:
+                data = fetched[n]
+            else:
+                # a read serves several ops, the metrics split its time by their data length
+                shares = [
+                    (InstallOperation.Type.Name(batch[i]["operation"].type), op_len) for _, _, op_len, i in members
+                ]
+                with self.fetch_slot(length), tracing.span(
+                    "fetch", "stage", size=length, partition=partition_name, shares=shares
+                ):
+                    data = self.payloadfile.read(src, length)
+            assert len(data) == length, 'short read'
+            if len(members) == 1:
+                datas[members[0][3]] = data
+                continue
+            view = memoryview(data)
+            for op_src, _, op_len, i in members:
+                datas[i] = view[op_src - src:op_src - src + op_len]
+        for op, data in zip(batch, datas):
+            self.do_op(partition_name, op, out_file, old_file, data)
+        bar.update(sum(self.op_dst_bytes(op["operation"]) for op in batch))
 
-    def do_op(self, partition_name, op, out_file, old_file, bar):
+    def release_prefetched(self, size, task):
+        self.fetcher.release(size)
+
+    def do_op(self, partition_name, op, out_file, old_file, data=None):
         #print('do op', partition_name, op)
         try:
-            self.data_for_op(op, out_file, old_file)
-            bar.update(1)
+            operation = op["operation"]
+            with tracing.span(
+                InstallOperation.Type.Name(operation.type), "op",
+                partition=partition_name,
+                data_offset=operation.data_offset,
+                data_length=operation.data_length,
+                dst_bytes=sum(ext.num_blocks for ext in operation.dst_extents) * self.block_size,
+            ):
+                written = self.data_for_op(op, out_file, old_file, data)
+            if op.get("key") is not None:
+                self.record_digest(partition_name, op, written)
         except futures.CancelledError:
             pass
 
+    def record_digest(self, partition_name, op, written):
+        if written is None:
+            digest = incremental.zero_digest(sum(ext.num_blocks for ext in op["operation"].dst_extents) * self.block_size)
+        else:
+            digest = hashlib.sha256(written).hexdigest()
+        self.digests[partition_name][op["key"]] = digest
+
+    def verify_partitions(self, partitions) -> int:
+        problems = shard.check_markers(self.out, self.dam, partitions)
+        for problem in problems:
+            print(problem)
+
+        def check(partition):
+            path = os.path.join(self.out, f"{partition.partition_name}.img")
+            size = self.partition_size(partition)
+            if not os.path.exists(path):
+                return "missing"
+            if os.path.getsize(path) != size:
+                return f"size {os.path.getsize(path)}, expected {size}"
+            if not partition.new_partition_info.hash:
+                return "ok (no hash in manifest)"
+            if shard.hash_file(path, size) != partition.new_partition_info.hash:
+                return "hash mismatch"
+            return "ok"
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(check, partitions))
+            if self.verity is not None:
+                # the hash tree and FEC of the images on disk, whatever wrote them
+                for partition, result in zip(partitions, results):
+                    if result != "missing" and verity.has_verity(partition):
+                        f = mtio.MTFile(os.path.join(self.out, f"{partition.partition_name}.img"), "r")
+                        try:
+                            builder = verity.VerityBuilder(partition, self.block_size, f, executor, verify=True, fec=self.fec)
+                            builder.start([])
+                            self.finish_verity(builder)
+                        finally:
+                            f.close()
+        failed = len(problems) + self.verity_problems
+        for partition, result in zip(partitions, results):
+            print(f"{partition.partition_name}: {result}")
+            if not result.startswith("ok"):
+                failed += 1
+        self.payloadfile.close()
+        if failed:
+            print(f"Verification failed: {failed} problems")
+            return 1
+        print(f"Verified {len(partitions)} partitions")
+        return 0
+
     def list_partitions_info(self):
         partitions_info = []
         for partition in self.dam.partitions:
-            size_in_blocks = sum(ext.num_blocks for op in partition.operations for ext in op.dst_extents)
-            size_in_bytes = size_in_blocks * self.block_size
-            if size_in_bytes >= 1024**3:
-                size_str = f"{size_in_bytes / 1024**3:.1f}GB"
-            elif size_in_bytes >= 1024**2:
-                size_str = f"{size_in_bytes / 1024**2:.1f}MB"
+            if self.index is not None:
+                size_in_blocks = self.index[partition.partition_name]["size_in_blocks"]
             else:
-                size_str = f"{size_in_bytes / 1024:.1f}KB"
-            
+                size_in_blocks = sum(ext.num_blocks for op in partition.operations for ext in op.dst_extents)
+            size_in_bytes = size_in_blocks * self.block_size
             partitions_info.append({
                 "partition_name": partition.partition_name,
                 "size_in_blocks": size_in_blocks,
                 "size_in_bytes": size_in_bytes,
-                "size_readable": size_str,
+                "size_readable": format_size(size_in_bytes),
                 "hash": partition.new_partition_info.hash.hex()
             })
-        
-        # Output to JSON file
-        output_file = os.path.join(self.out, "partitions_info.json")
-        with open(output_file, "w") as f:
-            json.dump(partitions_info, f, indent=4)
 
         # Print to console in a compact format
         readable_info = '\n'.join(f"{info['partition_name']}({info['size_readable']})" for info in partitions_info)
         print(f'Total {len(partitions_info)} partitions')
         print(readable_info)
+
+        if self.out == "-":
+            return
+        # Output to JSON file
+        output_file = self.save_output("partitions_info.json", json.dumps(partitions_info, indent=4).encode())
         print(f"\nPartition information saved to {output_file}")
 
+    def estimate_partitions(self, partitions):
+        model = estimate.load_model(self.calibration)
+        remote = not isinstance(self.payloadfile, mtio.MTFile)
+        estimates = []
+        for partition in partitions:
+            est = estimate.estimate_partition(
+                partition, self.block_size, self.partition_size(partition), reads=self.planned_reads(partition)
+            )
+            est["predicted_s"] = round(estimate.predict_wall_time(est, model, self.workers, remote), 3)
+            estimates.append(est)
+
+        setup_s = estimate.SETUP_REQUESTS * model["latency_s"] if remote else 0.0
+        total = {
+            "data_bytes": sum(e["data_bytes"] for e in estimates),
+            # the GETs the run makes: one per coalesced read, and the setup ones
+            "requests": sum(e["coalesced_requests"] for e in estimates) + (estimate.SETUP_REQUESTS if remote else 0),
+            "coalesced_requests": sum(e["coalesced_requests"] for e in estimates),
+            "source_bytes": sum(e["source_bytes"] for e in estimates),
+            "predicted_s": round(setup_s + sum(e["predicted_s"] for e in estimates), 3),
+        }
+
+        for e in estimates:
+            types = ", ".join(f"{name} {t['ops']}" for name, t in sorted(e["op_types"].items(), key=lambda x: -x[1]["ops"]))
+            print(
+                f"{e['partition_name']}: download {format_size(e['data_bytes'])} in {e['coalesced_requests']} requests "
+                f"(coalesced from {e['requests']}), source {format_size(e['source_bytes'])}, "
+                f"zero {e['zero_fraction'] * 100:.1f}%, ~{e['predicted_s']:.1f}s [{types}]"
+            )
+        print(
+            f"\nTotal: download {format_size(total['data_bytes'])} in {total['requests']} requests, "
+            f"source {format_size(total['source_bytes'])}, predicted {total['predicted_s']:.1f}s "
+            f"with {self.workers} workers"
+        )
+
+        if self.out == "-":
+            return
+        output_file = self.save_output("estimate.json", json.dumps(
+            {"model": model, "workers": self.workers, "remote": remote, "total": total, "partitions": estimates}, indent=4
+        ).encode())
+        print(f"Estimate saved to {output_file}")
+
     def extract_and_display_metadata(self):
         # Try to extract and display the metadata file from the zip
         metadata_path = "META-INF/com/android/metadata"
         try:
-            off, sz = get_zip_stored_entry_offset(self.payloadfile, metadata_path)
-            data = self.payloadfile.read(off, sz)
-            output_file = os.path.join(self.out, "metadata")
-            with open(output_file, "wb") as f:
-                f.write(data)
+            data = self.cache.load_metadata() if self.cache is not None else None
+            if data is None:
+                off, sz = self.zip_entry_offset(self.payloadfile, metadata_path)
+                data = self.payloadfile.read(off, sz)
+                if self.cache is not None:
+                    self.cache.save_metadata(data)
             print(data.decode('utf-8'))
+            if self.out == "-":
+                return
+            output_file = self.save_output("metadata", data)
             print(f"\nMetadata saved to {output_file}")
         except Exception as e:
             print(f"Failed to extract {metadata_path}: {e}")
@@ -0,0 +1,165 @@
+"""
+Dry-run cost estimation from the manifest alone: bytes to download, request
+counts, op type breakdown, source bytes needed by diffs, zero fraction and a
+predicted wall time from a throughput model. The model can be calibrated
+with a --report JSON of a previous run.
+"""
+import json
+import os
+from collections import defaultdict
+
+from .update_metadata_pb2 import InstallOperation
+
+MIB = 1 << 20
+
+# rates in MiB/s of decompressed (decode, write) or compressed (hash, network) bytes
+DEFAULT_MODEL = {
+    "latency_s": 0.05,
+    "stream_mib_s": 20.0,
+    "link_mib_s": 0.0,
+    "local_read_mib_s": 500.0,
+    "hash_mib_s": 500.0,
+    "write_mib_s": 1000.0,
+    "decode_mib_s": {
+        "REPLACE": 4000.0,
+        "REPLACE_BZ": 25.0,
+        "REPLACE_XZ": 60.0,
+        "ZSTD": 800.0,
+        "SOURCE_COPY": 1000.0,
+        "SOURCE_BSDIFF": 30.0,
+        "BROTLI_BSDIFF": 40.0,
+        "ZERO": 4000.0,
+        "DISCARD": 0.0,
+    },
+}
+
+# manifest round trips before any op data: zip EOCD/central directory/local header, payload header, manifest
+SETUP_REQUESTS = 5
+
+
+def load_model(calibration=None):
+    """default model, with rates measured by a --report JSON when `calibration` is given"""
+    model = {**DEFAULT_MODEL, "decode_mib_s": dict(DEFAULT_MODEL["decode_mib_s"])}
+    if calibration is None:
+        return model
+    with open(calibration) as f:
+        report = json.load(f)
+
+    hash_s = write_s = fetch_s = 0.0
+    compressed = decompressed = 0
+    for op_type, b in report.get("op_types", {}).items():
+        stages = b["stages_s"]
+        if stages.get("decode", 0) > 0 and b["decompressed_bytes"] > 0:
+            model["decode_mib_s"][op_type] = b["decompressed_bytes"] / MIB / stages["decode"]
+        hash_s += stages.get("hash", 0)
+        write_s += stages.get("write", 0)
+        fetch_s += stages.get("fetch", 0)
+        compressed += b["compressed_bytes"]
+        decompressed += b["decompressed_bytes"]
+    if hash_s > 0:
+        model["hash_mib_s"] = compressed / MIB / hash_s
+    if write_s > 0:
+        model["write_mib_s"] = decompressed / MIB / write_s
+
+    http = report.get("http", {})
+    requests = http.get("requests", 0)
+    if requests > 0:
+        latency = http["latency_s"]["p50"]
+        model["latency_s"] = latency
+        transfer_s = fetch_s - requests * latency
+        if transfer_s > 0:
+            model["stream_mib_s"] = http["bytes"] / MIB / transfer_s
+    elif fetch_s > 0:
+        model["local_read_mib_s"] = compressed / MIB / fetch_s
+    return model
+
+
+def coalesce(ranges, max_gap: int, max_size: int):
+    """merge sorted (off, len) ranges separated by at most `max_gap` bytes into reads of at most `max_size`"""
+    merged = []
+    for off, length in sorted(ranges):
+        if merged:
+            m_off, m_len = merged[-1]
+            gap = off - (m_off + m_len)
+            if 0 <= gap <= max_gap and off + length - m_off <= max_size:
+                merged[-1] = (m_off, off + length - m_off)
+                continue
+        merged.append((off, length))
+    return merged
+
+
+def estimate_partition(partition, block_size: int, size: int, max_gap: int = 0, max_request: int = 16 * MIB,
+                       reads: int = None):
+    """
+    `reads` is the number of payload reads the extraction makes when the
+    caller knows how it batches ops (see Dumper.planned_reads), otherwise
+    ranges at most `max_gap` apart are merged into reads of `max_request`
+    """
+    types = defaultdict(lambda: {"ops": 0, "data_bytes": 0, "dst_bytes": 0})
+    ranges = []
+    source_bytes = 0
+    zero_bytes = 0
+    dst_bytes = 0
+    for op in partition.operations:
+        name = InstallOperation.Type.Name(op.type)
+        out = sum(ext.num_blocks for ext in op.dst_extents) * block_size
+        t = types[name]
+        t["ops"] += 1
+        t["data_bytes"] += op.data_length
+        t["dst_bytes"] += out
+        dst_bytes += out
+        if op.data_length > 0:
+            ranges.append((op.data_offset, op.data_length))
+        if op.type in (InstallOperation.ZERO, InstallOperation.DISCARD):
+            zero_bytes += out
+        source_bytes += sum(ext.num_blocks for ext in op.src_extents) * block_size
+
+    coalesced = coalesce(ranges, max_gap, max_request)
+    # blocks no op writes read back as zeros too
+    zero_bytes += max(0, size - dst_bytes)
+    return {
+        "partition_name": partition.partition_name,
+        "size": size,
+        "ops": len(partition.operations),
+        "data_bytes": sum(length for _, length in ranges),
+        "requests": len(ranges),
+        "coalesced_requests": len(coalesced) if reads is None else reads,
+        "coalesced_bytes": sum(length for _, length in coalesced),
+        "source_bytes": source_bytes,
+        "zero_fraction": round(zero_bytes / size, 4) if size else 0.0,
+        "op_types": dict(types),
+    }
+
+
+def predict_wall_time(est, model, workers: int, remote: bool, cpus: int = None) -> float:
+    """
+    per read a worker waits for the fetch (latency + transfer), then hashes,
+    decodes and writes; waiting overlaps across `workers`, the cpu bound
+    stages only across min(workers, cpus), and the shared link bounds the
+    transfer from below
+    """
+    if cpus is None:
+        cpus = os.cpu_count() or 1
+    if remote:
+        latency = model["latency_s"]
+        read_rate = model["stream_mib_s"]
+    else:
+        latency = 0.0
+        read_rate = model["local_read_mib_s"]
+    # adjacent ops of a batch share one read
+    io_work = est["coalesced_requests"] * latency + est["data_bytes"] / MIB / read_rate
+    cpu_work = est["data_bytes"] / MIB / model["hash_mib_s"]
+    for name, t in est["op_types"].items():
+        rate = model["decode_mib_s"].get(name, 0.0)
+        if rate > 0:
+            cpu_work += t["dst_bytes"] / MIB / rate
+        if name != "DISCARD":
+            cpu_work += t["dst_bytes"] / MIB / model["write_mib_s"]
+    workers = max(1, workers)
+    wall = max(
+        (io_work + cpu_work) / workers,
+        cpu_work / min(workers, cpus),
+    )
+    if remote and model["link_mib_s"] > 0:
+        wall = max(wall, est["data_bytes"] / MIB / model["link_mib_s"])
+    return wall
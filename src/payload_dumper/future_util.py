@@ -1,6 +1,8 @@
 import concurrent
 import sys
-from concurrent.futures import Future, FIRST_COMPLETED, FIRST_EXCEPTION, ALL_COMPLETED, wait
+import threading
+from concurrent.futures import Future, FIRST_COMPLETED, FIRST_EXCEPTION, ALL_COMPLETED, InvalidStateError, wait
+from functools import partial
 from typing import Any
 
 # https://gist.github.com/Klotzi111/9ab06b0380702cd5f4044c7529bdc096
@@ -97,6 +99,100 @@ class CombinedFuture(Future[Future | None]):
         if self.completed_futures == self.futures:
             self._set_result_safe(None)
 
+def completed_future(result: Any) -> Future:
+    f = Future()
+    f.set_result(result)
+    return f
+
+def completed_exception(e: BaseException) -> Future:
+    f = Future()
+    f.set_exception(e)
+    return f
+
+def copy_future_state(source: Future, dest: Future):
+    # `dest` may have been cancelled meanwhile, its consumer is gone
+    if dest.done():
+        return
+    try:
+        if source.cancelled():
+            dest.cancel()
+        elif source.exception() is not None:
+            dest.set_exception(source.exception())
+        else:
+            dest.set_result(source.result())
+    except InvalidStateError:
+        # cancelled between the check and here
+        pass
+
+def cancel_with(dest: Future, *sources):
+    """cancel the futures `sources` holds when `dest` is cancelled"""
+    def on_done(f: Future):
+        if f.cancelled():
+            for source in sources:
+                for future in source:
+                    future.cancel()
+
+    dest.add_done_callback(on_done)
+
+def submit_after(future: Future, executor, fn, *args, **kwargs) -> Future:
+    """
+    once `future` completes, submit fn(future.result(), *args, **kwargs) to
+    `executor`; the returned future completes with that task, cancelling it
+    cancels `future` and the task
+    """
+    out = Future()
+    tasks = []
+
+    def on_done(f: Future):
+        if out.done():
+            # cancelled while waiting for `future`
+            return
+        if f.cancelled() or f.exception() is not None:
+            copy_future_state(f, out)
+            return
+        try:
+            task = executor.submit(fn, f.result(), *args, **kwargs)
+        except BaseException as e:
+            copy_future_state(completed_exception(e), out)
+            return
+        tasks.append(task)
+        task.add_done_callback(lambda t: copy_future_state(t, out))
+        if out.cancelled():
+            # cancelled while submitting
+            task.cancel()
+
+    cancel_with(out, [future], tasks)
+    future.add_done_callback(on_done)
+    return out
+
+def gather(fs) -> Future:
+    """a future of the list of results of `fs`, it fails as soon as one of them fails"""
+    out = Future()
+    results = [None] * len(fs)
+    remaining = [len(fs)]
+    lock = threading.Lock()
+
+    def on_done(i: int, f: Future):
+        if f.cancelled() or f.exception() is not None:
+            with lock:
+                if out.done():
+                    return
+                copy_future_state(f, out)
+            return
+        with lock:
+            results[i] = f.result()
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                copy_future_state(completed_future(results), out)
+
+    if not fs:
+        out.set_result(results)
+    # the reads of a cancelled gather aren't needed anymore
+    cancel_with(out, fs)
+    for i, f in enumerate(fs):
+        f.add_done_callback(partial(on_done, i))
+    return out
+
 def wait_interruptible(fs, timeout=None, return_when=ALL_COMPLETED):
     # https://github.com/agronholm/anyio/discussions/533
     if sys.platform == 'win32' and timeout is None:
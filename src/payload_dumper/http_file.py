@@ -1,8 +1,36 @@
-import io
+import logging
+import time
+
 import httpx
-from threading import Lock
+from contextlib import nullcontext
+from threading import Lock, Semaphore
+from urllib.parse import urlsplit
 
 from . import mtio
+from . import retry
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """one client shared by many HttpRangeFileMTIO, with at most `per_host` requests in flight per host"""
+
+    def __init__(self, per_host: int = 8):
+        self.client = httpx.Client(limits=httpx.Limits(max_connections=None, max_keepalive_connections=None))
+        self.per_host = per_host
+        self.slots = {}
+        self.lock = Lock()
+
+    def slot(self, url: str) -> Semaphore:
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.slots:
+                self.slots[host] = Semaphore(self.per_host)
+            return self.slots[host]
+
+    def close(self):
+        self.client.close()
 
 
 class HttpRangeFileMTIO(mtio.MTIOBase):
@@ -23,23 +51,63 @@ class HttpRangeFileMTIO(mtio.MTIOBase):
         retry_count = 0
 
         while received < expected_size:
-            headers = {"Range": f"bytes={off+received}-{end_pos}"}
+            url = self.mirrors.choose()
+            start = off + received
+            headers = self.sign("GET", url, {**self.request_headers, "Range": f"bytes={start}-{end_pos}"})
+            got = 0
+            t0 = time.perf_counter()
             try:
-                with self.client.stream("GET", self.url, headers=headers) as r:
-                    if r.status_code != 206:
-                        raise io.UnsupportedOperation(f"Remote did not return partial content: {self.url} {r.status_code} {r.request.headers}")
+                with self.slot, tracing.span("GET", "http", off=start, size=expected_size - received, retry=retry_count) as s, \
+                        self.client.stream("GET", url, headers=headers) as r:
+                    s.set(status=r.status_code)
+                    length = retry.check_range_response(r, url, start, end_pos, self.size)
                     for chunk in r.iter_bytes(8192):
-                        buf[received : received + len(chunk)] = chunk
-                        received += len(chunk)
+                        # never past what Content-Range announced
+                        n = min(len(chunk), length - got)
+                        buf[received : received + n] = chunk[:n]
+                        received += n
+                        got += n
                         with self.lock:
                             self.transferred_bytes += len(chunk)
-            except httpx.ConnectTimeout as e:
-                retry_count += 1
-                print(f'connection timeout, {retry_count=} {e}')
-                if retry_count >= self.max_retry:
-                    raise e
+                    if got < length:
+                        raise retry.TransientError(f"short body from {url}: {got} of {length} bytes")
+                self.mirrors.record(url, got, time.perf_counter() - t0)
+            except retry.TRANSIENT_ERRORS as e:
+                self.mirrors.record(url, got, time.perf_counter() - t0, failed=True)
+                # consecutive attempts without progress
+                retry_count = retry_count + 1 if got == 0 else 1
+                if retry_count > self.backoff.max_retry:
+                    raise
+                delay = self.backoff.delay(retry_count)
+                log.warning(f"{type(e).__name__}: {e}, resuming at byte {off + received} in {delay:.1f}s ({retry_count=})")
+                time.sleep(delay)
         return received
 
+    def head(self, url: str):
+        retry_count = 0
+        while True:
+            try:
+                with self.slot, tracing.span("HEAD", "http"):
+                    h = self.client.head(url, headers=self.sign("HEAD", url, self.request_headers))
+                if h.status_code in retry.RETRY_STATUS:
+                    raise retry.TransientError(f"HTTP {h.status_code} from {url}")
+                break
+            except retry.TRANSIENT_ERRORS:
+                retry_count += 1
+                if retry_count > self.backoff.max_retry:
+                    raise
+                time.sleep(self.backoff.delay(retry_count))
+        if h.status_code >= 400:
+            # e.g. a missing object or a rejected S3 signature
+            raise ValueError(f"HTTP {h.status_code} from {url}")
+        if h.headers.get("Accept-Ranges", "none") != "bytes":
+            raise ValueError(f"Remote does not support ranges: {url} {h.status_code} {h.request.headers}")
+        return h
+
+    def sign(self, method: str, url: str, headers: dict) -> dict:
+        """the headers of a request, S3 adds its signature (see s3.py)"""
+        return headers
+
     def readinto(self, off: int, size: int, ba) -> int:
         if self.closed():
             raise ValueError('closed!')
@@ -54,20 +122,44 @@ class HttpRangeFileMTIO(mtio.MTIOBase):
         n = self.readinto1(off, size, ba)
         return ba[:n]
 
-    def __init__(self, url: str, max_retry = 10, headers=None):
-        client = httpx.Client()
+    def __init__(self, url: str, max_retry = 10, headers=None, pool=None, mirrors=()):
         self.url = url
+        self.backoff = retry.Backoff(max_retry)
+        self.is_closed = False
+        if pool is None:
+            client = httpx.Client()
+            if headers is not None:
+                client.headers = headers
+            self.request_headers = {}
+            self.slot = nullcontext()
+        else:
+            # connections are shared with the other files of the pool, sent per request
+            client = pool.client
+            self.request_headers = dict(headers or {})
+            self.slot = pool.slot(url)
         self.client = client
-        self.max_retry = max_retry
-        if headers is not None:
-            self.client.headers = headers
-        h = client.head(url)
-        if h.headers.get("Accept-Ranges", "none") != "bytes":
-            raise ValueError(f"Remote does not support ranges: {url} {h.status_code} {h.request.headers}")
+        self.own_client = pool is None
+        h = self.head(url)
         size = int(h.headers.get("Content-Length", 0))
         if size == 0:
             raise ValueError(f"Remote has no length: {url}")
         self.size = size
+        # validators identifying this version of the remote file
+        self.etag = h.headers.get("ETag")
+        self.last_modified = h.headers.get("Last-Modified")
+
+        urls = [url]
+        for mirror in mirrors:
+            try:
+                mirror_size = int(self.head(mirror).headers.get("Content-Length", 0))
+            except (ValueError, *retry.TRANSIENT_ERRORS) as e:
+                log.warning(f"Skipping mirror {mirror}: {e}")
+                continue
+            if mirror_size != size:
+                log.warning(f"Skipping mirror {mirror}: {mirror_size} bytes, expected {size}")
+                continue
+            urls.append(mirror)
+        self.mirrors = retry.Mirrors(urls)
         self.transferred_bytes = 0
         self.lock = Lock()
 
@@ -81,10 +173,12 @@ class HttpRangeFileMTIO(mtio.MTIOBase):
         raise NotImplementedError()
 
     def close(self):
-        self.client.close()
+        self.is_closed = True
+        if self.own_client:
+            self.client.close()
 
     def closed(self) -> bool:
-        return self.client.is_closed
+        return self.is_closed or self.client.is_closed
 
     def __enter__(self):
         return self
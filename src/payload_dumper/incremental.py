@@ -0,0 +1,147 @@
+"""
+Update-in-place (--update): re-extracting a new build into an output
+directory that already holds the images of an earlier one only rewrites what
+changed.
+
+A partition whose image already matches `new_partition_info.hash` is skipped.
+Otherwise each op is identified by a key over what determines its output (op
+type, data and source hashes, dst extents), and a sidecar next to the image,
+`<name>.img.digests`, records the digest of the bytes every op wrote. An op
+whose key is in the sidecar is skipped when the image is unchanged since the
+sidecar was written, or when its dst extents still hash to the recorded
+digest; only the remaining ops are fetched and decoded.
+
+The sidecar only records the partition hash once the updated image was hashed
+and matched it. An image that doesn't match (stale bytes no op rewrites, such
+as under a DISCARD) keeps no op digests, the next update rewrites it whole.
+"""
+import hashlib
+import json
+import os
+
+from . import cache
+from . import shard
+from .update_metadata_pb2 import InstallOperation
+
+SIDECAR_VERSION = 1
+SIDECAR_SUFFIX = ".digests"
+
+ZEROS = bytes(1 << 20)
+
+
+def op_key(op: InstallOperation):
+    """identity of the op's output, None when the manifest doesn't pin it down"""
+    if op.type == InstallOperation.DISCARD:
+        # leaves the destination undefined, there is nothing to compare
+        return None
+    if op.type in (InstallOperation.SOURCE_COPY, InstallOperation.SOURCE_BSDIFF, InstallOperation.BROTLI_BSDIFF):
+        if not op.src_sha256_hash:
+            return None
+    if op.data_length > 0 and not op.data_sha256_hash:
+        return None
+    h = hashlib.sha256()
+    h.update(op.type.to_bytes(4, "little"))
+    h.update(op.data_sha256_hash)
+    h.update(op.src_sha256_hash)
+    for ext in op.dst_extents:
+        h.update(ext.start_block.to_bytes(8, "little"))
+        h.update(ext.num_blocks.to_bytes(8, "little"))
+    return h.hexdigest()[:32]
+
+
+def zero_digest(size: int) -> str:
+    h = hashlib.sha256()
+    while size > 0:
+        n = min(size, len(ZEROS))
+        h.update(ZEROS[:n])
+        size -= n
+    return h.hexdigest()
+
+
+def hash_extents(f, extents, block_size: int) -> str:
+    h = hashlib.sha256()
+    for ext in extents:
+        f.seek(ext.start_block * block_size)
+        remain = ext.num_blocks * block_size
+        while remain > 0:
+            chunk = f.read(min(remain, 1 << 20))
+            if not chunk:
+                # past the end of the image, can't match
+                return ""
+            h.update(chunk)
+            remain -= len(chunk)
+    return h.hexdigest()
+
+
+def sidecar_path(path: str) -> str:
+    return path + SIDECAR_SUFFIX
+
+
+def load_sidecar(path: str, block_size: int):
+    try:
+        with open(sidecar_path(path)) as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if sidecar.get("version") != SIDECAR_VERSION or sidecar.get("block_size") != block_size:
+        return None
+    return sidecar
+
+
+def save_sidecar(path: str, block_size: int, partition_hash: bytes, digests):
+    st = os.stat(path)
+    sidecar = {
+        "version": SIDECAR_VERSION,
+        "block_size": block_size,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "partition_hash": partition_hash.hex(),
+        "ops": digests,
+    }
+    try:
+        cache.write_atomic(sidecar_path(path), json.dumps(sidecar).encode())
+    except OSError as e:
+        print(f"Failed to write {sidecar_path(path)}: {e}")
+
+
+def unchanged_since(sidecar, path: str) -> bool:
+    st = os.stat(path)
+    return sidecar["size"] == st.st_size and sidecar["mtime_ns"] == st.st_mtime_ns
+
+
+def plan_partition(path: str, partition, block_size: int, size: int):
+    """
+    (skip, digests): skip is True when the image already matches the manifest,
+    digests maps the key of every op that can be skipped to its output digest
+    """
+    if not os.path.exists(path):
+        return False, {}
+    sidecar = load_sidecar(path, block_size)
+    fresh = sidecar is not None and unchanged_since(sidecar, path)
+    expected = partition.new_partition_info.hash
+    keys = [op_key(op) for op in partition.operations]
+
+    if expected and os.path.getsize(path) == size:
+        if fresh and sidecar["partition_hash"] == expected.hex():
+            return True, {}
+        if shard.hash_file(path, size) == expected:
+            # recorded once so the next build can skip single ops
+            with open(path, "rb") as f:
+                digests = {
+                    key: hash_extents(f, op.dst_extents, block_size)
+                    for key, op in zip(keys, partition.operations) if key is not None
+                }
+            save_sidecar(path, block_size, expected, digests)
+            return True, {}
+
+    if sidecar is None:
+        return False, {}
+    recorded = sidecar["ops"]
+    if fresh:
+        return False, {key: recorded[key] for key in keys if key in recorded}
+    digests = {}
+    with open(path, "rb") as f:
+        for key, op in zip(keys, partition.operations):
+            if key in recorded and hash_extents(f, op.dst_extents, block_size) == recorded[key]:
+                digests[key] = recorded[key]
+    return False, digests
@@ -0,0 +1,210 @@
+"""
+Run metrics aggregated from the tracing spans: per partition and per op type
+counts, bytes and stage times, HTTP request statistics, throughput and peak
+memory. Written as a JSON report or a Prometheus textfile.
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+
+STAGES = ("fetch", "hash", "decode", "write")
+
+
+def percentile(values, p: float) -> float:
+    """nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+def peak_rss_kib() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+        import sys
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, KiB elsewhere
+        return rss // 1024 if sys.platform == "darwin" else rss
+    except ImportError:
+        return 0
+
+
+def new_bucket():
+    return {
+        "ops": 0,
+        "compressed_bytes": 0,
+        "decompressed_bytes": 0,
+        "stages_s": {stage: 0.0 for stage in STAGES},
+    }
+
+
+def rounded(bucket):
+    return {**bucket, "stages_s": {k: round(v, 6) for k, v in bucket["stages_s"].items()}}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = time.perf_counter()
+        self.partitions = defaultdict(new_bucket)
+        self.partition_types = defaultdict(lambda: defaultdict(new_bucket))
+        self.op_types = defaultdict(new_bucket)
+        self.partition_wall = {}
+        self.http_latencies = []
+        self.http_requests = 0
+        self.http_retries = 0
+        self.http_errors = 0
+        self.http_bytes = 0
+
+    # tracing recorder interface
+    def add(self, name: str, cat: str, start_ns: int, end_ns: int, args):
+        duration = (end_ns - start_ns) / 1e9
+        if cat == "stage" and "shares" in args:
+            # one read for the data of several ops, before any of their spans
+            total = sum(length for _, length in args["shares"]) or 1
+            partition = args.get("partition", "")
+            with self.lock:
+                for op_type, length in args["shares"]:
+                    t = duration * length / total
+                    for bucket in (
+                        self.partitions[partition],
+                        self.partition_types[partition][op_type],
+                        self.op_types[op_type],
+                    ):
+                        bucket["stages_s"][name] = bucket["stages_s"].get(name, 0.0) + t
+        elif cat == "stage":
+            # stages finish before the op span enclosing them on the same thread
+            stages = getattr(self.local, "stages", None)
+            if stages is None:
+                stages = self.local.stages = defaultdict(float)
+            stages[name] += duration
+        elif cat == "op":
+            stages = getattr(self.local, "stages", None) or {}
+            self.local.stages = None
+            partition = args.get("partition", "")
+            with self.lock:
+                for bucket in (
+                    self.partitions[partition],
+                    self.partition_types[partition][name],
+                    self.op_types[name],
+                ):
+                    bucket["ops"] += 1
+                    bucket["compressed_bytes"] += args.get("data_length", 0)
+                    bucket["decompressed_bytes"] += args.get("dst_bytes", 0)
+                    for stage, t in stages.items():
+                        bucket["stages_s"][stage] = bucket["stages_s"].get(stage, 0.0) + t
+        elif cat == "partition":
+            with self.lock:
+                self.partition_wall[name] = self.partition_wall.get(name, 0.0) + duration
+        elif cat == "http" and name != "HEAD":
+            with self.lock:
+                self.http_requests += 1
+                self.http_latencies.append(duration)
+                if args.get("retry", 0) > 0:
+                    self.http_retries += 1
+                if "error" in args:
+                    self.http_errors += 1
+                else:
+                    self.http_bytes += args.get("size", 0)
+
+    def report(self, network_bytes=None):
+        wall = time.perf_counter() - self.start
+        with self.lock:
+            partitions = {}
+            for name, bucket in self.partitions.items():
+                p = rounded(bucket)
+                p_wall = self.partition_wall.get(name, 0.0)
+                p["wall_s"] = round(p_wall, 6)
+                p["throughput_mib_s"] = round(bucket["decompressed_bytes"] / p_wall / (1 << 20), 3) if p_wall else 0.0
+                p["op_types"] = {t: rounded(b) for t, b in self.partition_types[name].items()}
+                partitions[name] = p
+            latencies = sorted(self.http_latencies)
+            decompressed = sum(b["decompressed_bytes"] for b in self.partitions.values())
+            compressed = sum(b["compressed_bytes"] for b in self.partitions.values())
+            report = {
+                "wall_s": round(wall, 6),
+                "ops": sum(b["ops"] for b in self.partitions.values()),
+                "compressed_bytes": compressed,
+                "decompressed_bytes": decompressed,
+                "throughput_mib_s": round(decompressed / wall / (1 << 20), 3) if wall else 0.0,
+                "peak_rss_kib": peak_rss_kib(),
+                "partitions": partitions,
+                "op_types": {t: rounded(b) for t, b in self.op_types.items()},
+                "http": {
+                    "requests": self.http_requests,
+                    "retries": self.http_retries,
+                    "errors": self.http_errors,
+                    "bytes": self.http_bytes if network_bytes is None else network_bytes,
+                    "latency_s": {
+                        "p50": percentile(latencies, 50),
+                        "p90": percentile(latencies, 90),
+                        "p99": percentile(latencies, 99),
+                        "max": latencies[-1] if latencies else 0.0,
+                        "sum": round(sum(latencies), 6),
+                        "count": len(latencies),
+                    },
+                },
+            }
+        return report
+
+    def save_json(self, path: str, report):
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    def save_prometheus(self, path: str, report):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP payload_dumper_{name} {help_text}")
+            lines.append(f"# TYPE payload_dumper_{name} {kind}")
+            for labels, value in samples:
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"payload_dumper_{name}{{{label_str}}} {value}" if label_str else f"payload_dumper_{name} {value}")
+
+        per_type = [
+            (name, t, b)
+            for name, p in report["partitions"].items()
+            for t, b in p["op_types"].items()
+        ]
+        metric("ops_total", "counter", "Operations applied.",
+               [({"partition": n, "type": t}, b["ops"]) for n, t, b in per_type])
+        metric("compressed_bytes_total", "counter", "Operation data bytes read from the payload.",
+               [({"partition": n, "type": t}, b["compressed_bytes"]) for n, t, b in per_type])
+        metric("decompressed_bytes_total", "counter", "Bytes written to partitions.",
+               [({"partition": n, "type": t}, b["decompressed_bytes"]) for n, t, b in per_type])
+        metric("stage_seconds_total", "counter", "Worker time spent per stage.",
+               [({"partition": n, "type": t, "stage": s}, round(v, 6))
+                for n, t, b in per_type for s, v in b["stages_s"].items()])
+        metric("partition_wall_seconds", "gauge", "Wall time per partition.",
+               [({"partition": n}, p["wall_s"]) for n, p in report["partitions"].items()])
+        http = report["http"]
+        metric("http_requests_total", "counter", "HTTP range requests.", [({}, http["requests"])])
+        metric("http_retries_total", "counter", "Retried HTTP range requests.", [({}, http["retries"])])
+        metric("http_errors_total", "counter", "Failed HTTP range requests.", [({}, http["errors"])])
+        metric("http_bytes_total", "counter", "Bytes received over HTTP.", [({}, http["bytes"])])
+        metric("http_request_duration_seconds", "summary", "HTTP range request latency.",
+               [({"quantile": q}, http["latency_s"][k]) for q, k in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"))])
+        # a summary's _sum and _count go with its quantiles, under the same TYPE line
+        lines.append(f"payload_dumper_http_request_duration_seconds_sum {http['latency_s']['sum']}")
+        lines.append(f"payload_dumper_http_request_duration_seconds_count {http['latency_s']['count']}")
+        metric("wall_seconds", "gauge", "Wall time of the run.", [({}, report["wall_s"])])
+        metric("throughput_bytes_per_second", "gauge", "Decompressed bytes per second of wall time.",
+               [({}, round(report["throughput_mib_s"] * (1 << 20)))])
+        metric("peak_rss_bytes", "gauge", "Peak resident set size.", [({}, report["peak_rss_kib"] * 1024)])
+
+        # textfile collectors may read at any time, replace the file atomically
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
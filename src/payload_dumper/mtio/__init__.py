@@ -31,6 +31,51 @@ class MTIOBase:
         pass
 
 
+# a window of `size` bytes at `offset` in another MTIOBase, closing it leaves the base open
+class MTIOSlice(MTIOBase):
+    def __init__(self, base: MTIOBase, offset: int, size: int):
+        self.base = base
+        self.offset = offset
+        self.size = size
+        self.is_closed = False
+
+    def check_range(self, off: int, size: int):
+        if off < 0 or off + size > self.size:
+            raise ValueError(f'out of range: {off=} {size=}, slice size is {self.size}')
+
+    def read(self, off: int, size: int) -> bytes:
+        size = max(0, min(size, self.size - off))
+        self.check_range(off, size)
+        return self.base.read(self.offset + off, size)
+
+    def readinto(self, off: int, size: int, ba) -> int:
+        size = max(0, min(size, self.size - off))
+        self.check_range(off, size)
+        return self.base.readinto(self.offset + off, size, ba)
+
+    def write(self, off: int, content: bytes) -> int:
+        self.check_range(off, len(content))
+        return self.base.write(self.offset + off, content)
+
+    def get_size(self) -> int:
+        return self.size
+
+    def set_size(self, size: int):
+        raise NotImplementedError()
+
+    def readable(self) -> bool:
+        return self.base.readable()
+
+    def writable(self) -> bool:
+        return self.base.writable()
+
+    def close(self):
+        self.is_closed = True
+
+    def closed(self) -> bool:
+        return self.is_closed
+
+
 USE_MMAP = False
 if USE_MMAP:
     import mmap
@@ -28,6 +28,9 @@ class UnixMTFile(MTIOBase):
         self.closed = False
 
     def close(self):
+        # the fd number may already belong to another file, close only once
+        if self.closed:
+            return
         os.close(self.fd)
         self.closed = True
 
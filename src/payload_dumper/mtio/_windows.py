@@ -35,6 +35,8 @@ class WindowsMTFile(MTIOBase):
         self.closed = False
 
     def close(self):
+        if self.closed:
+            return
         self.handle.Close()
         self.closed = True
 
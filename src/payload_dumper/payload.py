@@ -0,0 +1,44 @@
+import struct
+
+from . import mtio
+
+PAYLOAD_MAGIC = b"CrAU"
+BRILLO_MAJOR_PAYLOAD_VERSION = 2
+payload_header_struct = ">4sQQI"
+payload_header_size = struct.calcsize(payload_header_struct)
+
+
+def payload_header(manifest_size: int, metadata_signature_size: int = 0) -> bytes:
+    return struct.pack(
+        payload_header_struct, PAYLOAD_MAGIC, BRILLO_MAJOR_PAYLOAD_VERSION,
+        manifest_size, metadata_signature_size
+    )
+
+
+def write_payload_metadata(file: mtio.MTIOBase, manifest: bytes, metadata_signature: bytes = b"", off: int = 0) -> int:
+    """write header, manifest and metadata signature at `off`, return the offset op data starts at"""
+    data = payload_header(len(manifest), len(metadata_signature)) + manifest + metadata_signature
+    file.write(off, data)
+    return off + len(data)
+
+
+def coalesce_ranges(ranges, max_size: int):
+    """
+    merge (src_off, dst_off, length) copies that are contiguous on both sides into
+    runs of at most `max_size` bytes, returns [(src_off, dst_off, length, [ranges])]
+    """
+    runs = []
+    for r in ranges:
+        src_off, dst_off, length = r[:3]
+        if runs:
+            run_src, run_dst, run_len, members = runs[-1]
+            if (
+                run_src + run_len == src_off
+                and run_dst + run_len == dst_off
+                and run_len + length <= max_size
+            ):
+                members.append(r)
+                runs[-1] = (run_src, run_dst, run_len + length, members)
+                continue
+        runs.append((src_off, dst_off, length, [r]))
+    return runs
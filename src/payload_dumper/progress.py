@@ -0,0 +1,81 @@
+"""
+Progress bars. enlighten (and the terminal libraries it pulls in) is only
+imported when the bars are actually drawn on a terminal; redirected output
+(or --no-progress) gets a manager whose counters do nothing.
+
+Workers report progress in bytes from many threads, the counters add them up
+and redraw at most every FLUSH_INTERVAL seconds.
+"""
+import sys
+import time
+from threading import Lock
+
+FLUSH_INTERVAL = 0.1
+
+
+class NullCounter:
+    def update(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullManager:
+    def counter(self, **kwargs):
+        return NullCounter()
+
+    def status_bar(self, *args, **kwargs):
+        return NullCounter()
+
+    def stop(self):
+        pass
+
+
+class ThrottledCounter:
+    def __init__(self, counter):
+        self.counter = counter
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.lock = Lock()
+
+    def update(self, incr=1):
+        with self.lock:
+            self.pending += incr
+            now = time.monotonic()
+            if now - self.last_flush >= FLUSH_INTERVAL:
+                self.counter.update(self.pending)
+                self.pending = 0
+                self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            if self.pending:
+                self.counter.update(self.pending)
+                self.pending = 0
+            self.counter.close()
+
+
+class Manager:
+    """an enlighten manager whose counters are throttled"""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def counter(self, **kwargs):
+        return ThrottledCounter(self.manager.counter(**kwargs))
+
+    def status_bar(self, *args, **kwargs):
+        return self.manager.status_bar(*args, **kwargs)
+
+    def stop(self):
+        self.manager.stop()
+
+
+def get_manager(stream=None, enabled=True):
+    if stream is None:
+        stream = sys.stdout
+    if not enabled or not stream.isatty():
+        return NullManager()
+    from enlighten import get_manager as enlighten_manager
+    return Manager(enlighten_manager(stream=stream))
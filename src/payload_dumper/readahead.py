@@ -0,0 +1,165 @@
+"""
+Read-ahead for local payloads: one thread reads the payload sequentially in
+large chunks and hands out the op data from them, so a spinning disk or a
+network filesystem sees a sequential read instead of a random one from every
+worker. It implements the fetch()/release() interface of the async HTTP
+engine, the dumper queues the data of its ops in payload order and the
+fetched but unconsumed bytes are bounded by `window`.
+
+The file is opened with POSIX_FADV_SEQUENTIAL and the chunk after the one
+being served is announced with POSIX_FADV_WILLNEED, the kernel reads it while
+the workers decode.
+
+On an SSD or a payload in the page cache parallel reads are as fast and the
+extra thread only costs CPU, so by default (`--readahead auto`) it is used
+for payloads on network filesystems and spinning disks only.
+"""
+import os
+import sys
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+
+from . import mtio
+from . import tracing
+
+DEFAULT_WINDOW = 64 << 20
+DEFAULT_CHUNK = 8 << 20
+
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs", "fuse.sshfs")
+
+
+def network_fs(dev: int) -> bool:
+    # mountinfo: id parent major:minor root mountpoint options... - fstype source options
+    key = f"{os.major(dev)}:{os.minor(dev)}"
+    try:
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields, _, rest = line.partition(" - ")
+                fields = fields.split()
+                if len(fields) > 2 and fields[2] == key and rest.split()[0] in NETWORK_FILESYSTEMS:
+                    return True
+    except (OSError, IndexError):
+        pass
+    return False
+
+
+def rotational(dev: int) -> bool:
+    # a partition has no queue/ of its own, its disk is the parent directory
+    block = os.path.realpath(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}")
+    for path in (block, os.path.dirname(block)):
+        try:
+            with open(os.path.join(path, "queue", "rotational")) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+
+def worthwhile(path: str) -> bool:
+    """True when `path` is on a network filesystem or a spinning disk, where random reads are slow"""
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        dev = os.stat(path).st_dev
+    except OSError:
+        return False
+    return network_fs(dev) or rotational(dev)
+
+
+class ReadAhead:
+    def __init__(self, base: mtio.MTIOBase, window: int = DEFAULT_WINDOW, chunk: int = DEFAULT_CHUNK):
+        self.base = base
+        self.size = base.get_size()
+        self.window = window
+        self.chunk = min(chunk, window)
+        self.buffered = 0
+        self.requests = deque()
+        self.cond = Condition()
+        self.stopped = False
+        self.transferred_bytes = 0
+        # only the unix MTFile has a plain fd to give hints on
+        self.fd = getattr(base, "fd", None) if hasattr(os, "posix_fadvise") else None
+        self.advise(0, 0, "POSIX_FADV_SEQUENTIAL")
+        self.thread = Thread(target=self.run, name="readahead", daemon=True)
+        self.thread.start()
+
+    def advise(self, off: int, size: int, advice: str):
+        if self.fd is None:
+            return
+        try:
+            os.posix_fadvise(self.fd, off, size, getattr(os, advice))
+        except OSError:
+            pass
+
+    def fetch(self, off: int, size: int) -> Future:
+        """
+        queue a read of `size` bytes at `off`, blocks while `window` bytes are
+        fetched or queued; call release(size) once the data is consumed
+        """
+        return self.fetch_batch([(off, size)])[0]
+
+    def fetch_batch(self, reads):
+        """
+        fetch() of all the (off, size) `reads` of one task at once: their bytes
+        are reserved together, a task never waits for the window on the bytes
+        of its own earlier reads
+        """
+        futures = [Future() for _ in reads]
+        total = sum(size for _, size in reads)
+        with self.cond:
+            # a batch larger than the window still goes through alone
+            while not self.stopped and self.buffered > 0 and self.buffered + total > self.window:
+                self.cond.wait()
+            if self.stopped:
+                raise ValueError('closed!')
+            self.buffered += total
+            self.requests.extend((off, size, future) for (off, size), future in zip(reads, futures))
+            self.cond.notify_all()
+        return futures
+
+    def release(self, size: int):
+        with self.cond:
+            self.buffered -= size
+            self.cond.notify_all()
+
+    def run(self):
+        chunk_off = 0
+        chunk = memoryview(b"")
+        while True:
+            with self.cond:
+                while not self.requests and not self.stopped:
+                    self.cond.wait()
+                if not self.requests:
+                    return
+                off, size, future = self.requests.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if off < chunk_off or off + size > chunk_off + len(chunk):
+                    # a read straddling the end of the chunk continues from
+                    # there, a stream (see streaminput.py) can't go back
+                    keep = chunk[off - chunk_off:] if chunk_off <= off < chunk_off + len(chunk) else b""
+                    read_off = off + len(keep)
+                    length = max(size, self.chunk) if self.size is None else max(size, min(self.chunk, self.size - off))
+                    length -= len(keep)
+                    with tracing.span("read", "io", off=read_off, size=length):
+                        # slices handed out keep the chunk alive, not copies of it
+                        data = self.base.read(read_off, length)
+                    chunk = memoryview(bytes(keep) + data if keep else data)
+                    chunk_off = off
+                    self.transferred_bytes += len(data)
+                    self.advise(off + len(chunk), self.chunk, "POSIX_FADV_WILLNEED")
+                future.set_result(chunk[off - chunk_off:off - chunk_off + size])
+            except BaseException as e:
+                future.set_exception(e)
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            pending = list(self.requests)
+            self.requests.clear()
+            self.cond.notify_all()
+        for _, _, future in pending:
+            future.cancel()
+        self.thread.join()
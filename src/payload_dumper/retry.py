@@ -0,0 +1,115 @@
+"""
+Failure handling shared by the HTTP engines: which errors are transient,
+exponential backoff with full jitter, validation of range responses, and
+mirror selection by measured throughput with failover.
+
+A range read that fails part way resumes from the last byte received, on the
+same or another mirror, after a backoff delay; the attempt count restarts
+whenever a request made progress, so a long read over a flaky link only gives
+up after `max_retry` attempts in a row without a single byte.
+"""
+import io
+import random
+import re
+import time
+from threading import Lock
+
+import httpx
+
+# worth retrying, possibly on another mirror
+RETRY_STATUS = frozenset((408, 425, 429, 500, 502, 503, 504))
+
+content_range_re = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)$")
+
+
+class TransientError(IOError):
+    pass
+
+
+# errors after which the read is resumed
+TRANSIENT_ERRORS = (httpx.TransportError, TransientError)
+
+
+class Backoff:
+    def __init__(self, max_retry: int = 10, base: float = 0.5, cap: float = 30.0):
+        self.max_retry = max_retry
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int) -> float:
+        # full jitter, concurrent readers hitting the same outage don't retry in lockstep
+        return random.uniform(0, min(self.cap, self.base * (1 << min(attempt, 30))))
+
+
+def parse_content_range(value):
+    """(first, last, total or None) of a Content-Range header, None if malformed"""
+    m = content_range_re.match(value or "")
+    if m is None:
+        return None
+    total = None if m.group(3) == "*" else int(m.group(3))
+    return int(m.group(1)), int(m.group(2)), total
+
+
+def check_range_response(r, url: str, start: int, end: int, size: int):
+    """raise unless `r` is a 206 for bytes `start`..(at most)`end` of a `size` bytes file"""
+    if r.status_code in RETRY_STATUS:
+        raise TransientError(f"HTTP {r.status_code} from {url}")
+    if r.status_code != 206:
+        raise io.UnsupportedOperation(f"Remote did not return partial content: {url} {r.status_code}")
+    content_range = parse_content_range(r.headers.get("Content-Range"))
+    if content_range is None:
+        raise TransientError(f"bad Content-Range {r.headers.get('Content-Range')!r} from {url}")
+    first, last, total = content_range
+    if total is not None and total != size:
+        raise ValueError(f"Remote file changed size: {url} is {total} bytes, expected {size}")
+    if first != start or last > end or last < first:
+        raise TransientError(f"Content-Range {first}-{last} from {url} doesn't match requested {start}-{end}")
+    return last - first + 1
+
+
+class Mirror:
+    __slots__ = ("url", "rate", "failures", "retry_at")
+
+    def __init__(self, url: str):
+        self.url = url
+        # bytes per second of recent requests, None until measured
+        self.rate = None
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class Mirrors:
+    """URLs serving the same file; reads go to the fastest one that isn't cooling down after an error"""
+
+    def __init__(self, urls):
+        self.mirrors = [Mirror(url) for url in urls]
+        self.lock = Lock()
+
+    @property
+    def urls(self):
+        return [m.url for m in self.mirrors]
+
+    def choose(self) -> str:
+        now = time.monotonic()
+        with self.lock:
+            available = [m for m in self.mirrors if m.retry_at <= now]
+            if not available:
+                return min(self.mirrors, key=lambda m: m.retry_at).url
+            # measure every mirror once before trusting the rates
+            for m in available:
+                if m.rate is None:
+                    return m.url
+            return max(available, key=lambda m: m.rate).url
+
+    def record(self, url: str, nbytes: int, seconds: float, failed: bool = False):
+        with self.lock:
+            m = next(m for m in self.mirrors if m.url == url)
+            if nbytes > 0 and seconds > 0:
+                rate = nbytes / seconds
+                m.rate = rate if m.rate is None else 0.7 * m.rate + 0.3 * rate
+            if failed:
+                m.failures += 1
+                if len(self.mirrors) > 1:
+                    m.retry_at = time.monotonic() + min(60.0, 2.0 ** m.failures)
+            else:
+                m.failures = 0
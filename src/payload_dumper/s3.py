@@ -0,0 +1,335 @@
+"""
+s3:// payloads and outputs on S3 and S3-compatible object stores.
+
+A payload s3://bucket/key is read like an http(s) one (see http_file.py),
+with ranged GETs signed with AWS Signature Version 4 over a pooled client.
+With --out s3://bucket/prefix every image is uploaded to prefix/name.img
+while it is decoded: its ordered stream (see streamio.OrderedWriter) is cut
+into parts uploaded in parallel as a multipart upload, nothing is staged on
+local disk. An upload that doesn't get all of its bytes is aborted, never
+completed, so a failed run leaves no truncated image behind.
+
+Credentials and endpoint come from the usual environment: AWS_ACCESS_KEY_ID,
+AWS_SECRET_ACCESS_KEY and AWS_SESSION_TOKEN (or the AWS_PROFILE / default
+profile of ~/.aws/credentials), AWS_REGION or AWS_DEFAULT_REGION, and
+AWS_ENDPOINT_URL_S3 or AWS_ENDPOINT_URL for other stores, which are
+addressed path-style (http://host:port/bucket/key).
+"""
+import configparser
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import time
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from threading import Semaphore
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+
+from . import http_file
+from . import retry
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+DEFAULT_REGION = "us-east-1"
+
+# every part but the last must be at least 5 MiB, an upload has at most 10000
+MIN_PART_SIZE = 5 << 20
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = 16 << 20
+# parts uploading at once, all uploads of a run together; each holds its data
+UPLOAD_CONCURRENCY = 8
+# requests in flight to the store, reads and uploads
+MAX_REQUESTS = 64
+
+
+def is_s3(name) -> bool:
+    return isinstance(name, str) and name.startswith("s3://")
+
+
+def parse_s3_url(url: str):
+    """(bucket, key) of s3://bucket/key"""
+    parts = urlsplit(url)
+    if parts.scheme != "s3" or not parts.netloc:
+        raise ValueError(f"not an s3://bucket/key URL: {url}")
+    return parts.netloc, parts.path.lstrip("/")
+
+
+def uri_encode(s: str, safe: str = "-_.~") -> str:
+    return quote(s, safe=safe)
+
+
+class Credentials:
+    def __init__(self, access_key: str, secret_key: str, token: str = None):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.token = token
+
+
+def load_credentials() -> Credentials:
+    access_key = os.environ.get("AWS_ACCESS_KEY_ID")
+    secret_key = os.environ.get("AWS_SECRET_ACCESS_KEY")
+    if access_key and secret_key:
+        return Credentials(access_key, secret_key, os.environ.get("AWS_SESSION_TOKEN"))
+    path = os.environ.get("AWS_SHARED_CREDENTIALS_FILE", os.path.expanduser("~/.aws/credentials"))
+    profile = os.environ.get("AWS_PROFILE", "default")
+    config = configparser.ConfigParser()
+    config.read(path)
+    if config.has_option(profile, "aws_access_key_id") and config.has_option(profile, "aws_secret_access_key"):
+        return Credentials(
+            config.get(profile, "aws_access_key_id"),
+            config.get(profile, "aws_secret_access_key"),
+            config.get(profile, "aws_session_token", fallback=None),
+        )
+    raise ValueError("no S3 credentials: set AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY")
+
+
+def signing_key(secret_key: str, date: str, region: str, service: str = "s3") -> bytes:
+    key = ("AWS4" + secret_key).encode()
+    for part in (date, region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return key
+
+
+def sign(method: str, url: str, headers: dict, credentials: Credentials, region: str,
+         payload_hash: str = EMPTY_SHA256, now=None) -> dict:
+    """
+    `headers` with the SigV4 Authorization of a request to `url`, whose path
+    and query are already URI encoded; every header given is signed
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date = amz_date[:8]
+    parts = urlsplit(url)
+    headers = {**headers, "host": parts.netloc, "x-amz-date": amz_date, "x-amz-content-sha256": payload_hash}
+    if credentials.token:
+        headers["x-amz-security-token"] = credentials.token
+    canonical_headers = sorted((k.lower(), " ".join(str(v).split())) for k, v in headers.items())
+    signed_headers = ";".join(k for k, _ in canonical_headers)
+    query = sorted(item.partition("=")[::2] for item in parts.query.split("&") if item)
+    canonical_request = "\n".join([
+        method,
+        parts.path or "/",
+        "&".join(f"{k}={v}" for k, v in query),
+        "".join(f"{k}:{v}\n" for k, v in canonical_headers),
+        signed_headers,
+        payload_hash,
+    ])
+    scope = f"{date}/{region}/s3/aws4_request"
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()
+    ])
+    signature = hmac.new(
+        signing_key(credentials.secret_key, date, region), string_to_sign.encode(), hashlib.sha256
+    ).hexdigest()
+    headers["Authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={credentials.access_key}/{scope}, "
+        f"SignedHeaders={signed_headers}, Signature={signature}"
+    )
+    return headers
+
+
+def xml_text(content: bytes, name: str):
+    """text of the first element called `name` of an S3 response, namespaces ignored"""
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError:
+        return None
+    for el in root.iter():
+        if el.tag.rsplit("}", 1)[-1] == name:
+            return el.text
+    return None
+
+
+def round_up(n: int, size: int) -> int:
+    return (n + size - 1) // size * size
+
+
+def part_size_for(size) -> int:
+    """parts of an object of `size` bytes (None if unknown) fit in MAX_PARTS"""
+    if size is None:
+        return DEFAULT_PART_SIZE
+    return max(DEFAULT_PART_SIZE, round_up(-(-size // MAX_PARTS), 1 << 20))
+
+
+class S3Client:
+    """endpoint, region, credentials and connections shared by the objects of a run"""
+
+    def __init__(self, endpoint: str = None, region: str = None, credentials: Credentials = None, max_retry: int = 10):
+        self.region = region or os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or DEFAULT_REGION
+        endpoint = endpoint or os.environ.get("AWS_ENDPOINT_URL_S3") or os.environ.get("AWS_ENDPOINT_URL")
+        self.endpoint = endpoint.rstrip("/") if endpoint else None
+        self.credentials = credentials or load_credentials()
+        self.pool = http_file.ConnectionPool(per_host=MAX_REQUESTS)
+        self.backoff = retry.Backoff(max_retry)
+        self.executor = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="s3-upload")
+        # a writer waits for one before cutting another part
+        self.part_slots = Semaphore(UPLOAD_CONCURRENCY)
+
+    def url(self, bucket: str, key: str, query: str = "") -> str:
+        path = "/" + uri_encode(key, safe="-_.~/")
+        if self.endpoint is not None:
+            base = f"{self.endpoint}/{bucket}"
+        else:
+            base = f"https://{bucket}.s3.{self.region}.amazonaws.com"
+        return base + path + (f"?{query}" if query else "")
+
+    def sign(self, method: str, url: str, headers: dict, payload_hash: str = EMPTY_SHA256) -> dict:
+        return sign(method, url, headers, self.credentials, self.region, payload_hash)
+
+    def request(self, method: str, url: str, content: bytes = b""):
+        """one request, retried on transient failures; raises ValueError on an error status"""
+        payload_hash = hashlib.sha256(content).hexdigest() if content else EMPTY_SHA256
+        retry_count = 0
+        while True:
+            try:
+                # signed per attempt, a signature is only valid for a while
+                headers = self.sign(method, url, {}, payload_hash)
+                with self.pool.slot(url), tracing.span(method, "s3", size=len(content)) as s:
+                    r = self.pool.client.request(method, url, content=content, headers=headers)
+                    s.set(status=r.status_code)
+                if r.status_code in retry.RETRY_STATUS:
+                    raise retry.TransientError(f"HTTP {r.status_code} from {url}")
+                break
+            except retry.TRANSIENT_ERRORS as e:
+                retry_count += 1
+                if retry_count > self.backoff.max_retry:
+                    raise
+                delay = self.backoff.delay(retry_count)
+                log.warning(f"{type(e).__name__}: {e}, retrying {method} in {delay:.1f}s ({retry_count=})")
+                time.sleep(delay)
+        if r.status_code >= 300:
+            raise ValueError(f"S3 {method} {url}: HTTP {r.status_code} {xml_text(r.content, 'Code') or ''}".rstrip())
+        return r
+
+    def put_object(self, bucket: str, key: str, data: bytes):
+        self.request("PUT", self.url(bucket, key), data)
+
+    def create_multipart_upload(self, bucket: str, key: str) -> str:
+        r = self.request("POST", self.url(bucket, key, "uploads"))
+        upload_id = xml_text(r.content, "UploadId")
+        if not upload_id:
+            raise ValueError(f"S3 CreateMultipartUpload of {key}: no UploadId in the response")
+        return upload_id
+
+    def upload_part(self, bucket: str, key: str, upload_id: str, number: int, data: bytes) -> str:
+        query = f"partNumber={number}&uploadId={uri_encode(upload_id)}"
+        r = self.request("PUT", self.url(bucket, key, query), data)
+        return r.headers["ETag"]
+
+    def complete_multipart_upload(self, bucket: str, key: str, upload_id: str, etags):
+        parts = "".join(
+            f"<Part><PartNumber>{i}</PartNumber><ETag>{etag}</ETag></Part>" for i, etag in enumerate(etags, 1)
+        )
+        body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode()
+        r = self.request("POST", self.url(bucket, key, f"uploadId={uri_encode(upload_id)}"), body)
+        # the store may fail it after answering 200
+        if xml_text(r.content, "Code") is not None:
+            raise ValueError(f"S3 CompleteMultipartUpload of {key}: {xml_text(r.content, 'Code')}")
+
+    def abort_multipart_upload(self, bucket: str, key: str, upload_id: str):
+        self.request("DELETE", self.url(bucket, key, f"uploadId={uri_encode(upload_id)}"))
+
+
+class S3RangeFile(http_file.HttpRangeFileMTIO):
+    """a payload on S3, HttpRangeFileMTIO with signed requests"""
+
+    def __init__(self, url: str, client: S3Client = None, max_retry: int = 10):
+        self.s3 = client or S3Client(max_retry=max_retry)
+        bucket, key = parse_s3_url(url)
+        super().__init__(self.s3.url(bucket, key), max_retry=max_retry, pool=self.s3.pool)
+
+    def sign(self, method: str, url: str, headers: dict) -> dict:
+        return self.s3.sign(method, url, headers)
+
+
+class S3Upload:
+    """
+    the sequential sink writing one object: what is written is cut into parts
+    uploaded in parallel, an object smaller than a part is put whole. `size`
+    is how many bytes will be written, when known; closing after any other
+    amount aborts the upload.
+    """
+
+    def __init__(self, client: S3Client, url: str, size: int = None):
+        self.client = client
+        self.url = url
+        self.bucket, self.key = parse_s3_url(url)
+        self.size = size
+        self.part_size = part_size_for(size)
+        self.buffer = bytearray()
+        self.written = 0
+        self.upload_id = None
+        self.parts = []
+        self.error = None
+        self.state = "open"
+
+    def write(self, data) -> int:
+        if self.error is not None:
+            # a failed part fails the image now rather than at the end
+            raise self.error
+        self.buffer += data
+        self.written += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self.submit(part)
+        return len(data)
+
+    def submit(self, part: bytes):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(self.bucket, self.key)
+        self.client.part_slots.acquire()
+        task = self.client.executor.submit(
+            self.client.upload_part, self.bucket, self.key, self.upload_id, len(self.parts) + 1, part
+        )
+        task.add_done_callback(self.part_done)
+        self.parts.append(task)
+
+    def part_done(self, task):
+        self.client.part_slots.release()
+        if not task.cancelled() and task.exception() is not None and self.error is None:
+            self.error = task.exception()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.state != "open":
+            return
+        try:
+            if self.size is not None and self.written != self.size:
+                raise ValueError(f"{self.url}: {self.written} of {self.size} bytes written")
+            with tracing.span("upload", "s3", parts=len(self.parts)):
+                if self.upload_id is None:
+                    self.client.put_object(self.bucket, self.key, bytes(self.buffer))
+                else:
+                    if self.buffer:
+                        self.submit(bytes(self.buffer))
+                    etags = [task.result() for task in self.parts]
+                    self.client.complete_multipart_upload(self.bucket, self.key, self.upload_id, etags)
+            self.buffer = bytearray()
+            self.state = "completed"
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        if self.state != "open":
+            return
+        self.state = "aborted"
+        self.buffer = bytearray()
+        for task in self.parts:
+            task.cancel()
+        if self.upload_id is None:
+            return
+        # a part finishing after the abort would be kept by the store
+        futures.wait(self.parts)
+        try:
+            self.client.abort_multipart_upload(self.bucket, self.key, self.upload_id)
+        except (ValueError, *retry.TRANSIENT_ERRORS) as e:
+            log.warning(f"Couldn't abort the upload of {self.url}: {e}")
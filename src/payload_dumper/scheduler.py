@@ -0,0 +1,110 @@
+"""
+A worker pool shared by several concurrent extractions (see batch.py).
+
+Every job submits to its own queue; idle workers take the next task from the
+jobs in round robin, so a job with thousands of queued ops doesn't hold the
+pool while another waits, and a job at a partition tail leaves its share to
+the others. Tasks carry a memory cost (the bytes an op holds while it runs);
+a task only starts while the running tasks stay within the budget, a single
+task larger than the budget runs alone.
+"""
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+
+
+class Job:
+    """the executor handed to one Dumper, it only knows submit()"""
+
+    def __init__(self, scheduler, name: str):
+        self.scheduler = scheduler
+        self.name = name
+        self.queue = deque()
+
+    def submit(self, fn, *args, cost: int = 0, **kwargs) -> Future:
+        future = Future()
+        with self.scheduler.cond:
+            if self.scheduler.stopped:
+                raise RuntimeError("scheduler is shut down")
+            if not self.queue:
+                self.scheduler.ready.append(self)
+            self.queue.append((future, cost, fn, args, kwargs))
+            self.scheduler.cond.notify()
+        return future
+
+    def cancel_pending(self):
+        with self.scheduler.cond:
+            pending = list(self.queue)
+            self.queue.clear()
+            if self in self.scheduler.ready:
+                self.scheduler.ready.remove(self)
+        for future, *_ in pending:
+            future.cancel()
+
+    # used like a ThreadPoolExecutor, but the pool outlives the job
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class Scheduler:
+    def __init__(self, workers: int, memory_budget: int = 0):
+        self.cond = Condition()
+        # jobs with queued tasks, in the order they get their next turn
+        self.ready = deque()
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.running = 0
+        self.stopped = False
+        self.threads = [Thread(target=self.work, name=f"scheduler-{i}", daemon=True) for i in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def job(self, name: str) -> Job:
+        return Job(self, name)
+
+    def fits(self, cost: int) -> bool:
+        return self.memory_budget <= 0 or self.running == 0 or self.memory_used + cost <= self.memory_budget
+
+    def next_task(self):
+        with self.cond:
+            while True:
+                if self.ready and self.fits(self.ready[0].queue[0][1]):
+                    job = self.ready.popleft()
+                    task = job.queue.popleft()
+                    if job.queue:
+                        # back of the line, the other jobs go first
+                        self.ready.append(job)
+                    self.memory_used += task[1]
+                    self.running += 1
+                    return task
+                if self.stopped and not self.ready:
+                    return None
+                self.cond.wait()
+
+    def work(self):
+        while True:
+            task = self.next_task()
+            if task is None:
+                return
+            future, cost, fn, args, kwargs = task
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self.cond:
+                    self.memory_used -= cost
+                    self.running -= 1
+                    self.cond.notify_all()
+
+    def shutdown(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
@@ -0,0 +1,86 @@
+import struct
+from collections import deque
+
+from zstd import ZSTD_compress
+
+from . import streamio
+from .future_util import completed_future
+
+# https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+seek_table_entry_struct = "<2I"
+seek_table_footer_struct = "<IBI"
+
+DEFAULT_FRAME_SIZE = 4 << 20
+DEFAULT_LEVEL = 3
+
+
+def seek_table(frames) -> bytes:
+    """build the skippable frame indexing `frames`, a list of (compressed, decompressed) sizes"""
+    entries = b"".join(struct.pack(seek_table_entry_struct, c, d) for c, d in frames)
+    # no per-frame checksums
+    footer = struct.pack(seek_table_footer_struct, len(frames), 0, SEEKABLE_MAGIC)
+    return struct.pack("<2I", SKIPPABLE_MAGIC, len(entries) + len(footer)) + entries + footer
+
+
+class SeekableZstdWriter(streamio.OrderedWriter):
+    """
+    Writes the ordered stream as independent zstd frames of `frame_size` bytes,
+    compressed in parallel on `executor` and appended in order, followed by a
+    seek table so the output stays random-access.
+    """
+
+    def __init__(self, fp, size: int, zero_extents, executor, frame_size=DEFAULT_FRAME_SIZE, level=DEFAULT_LEVEL, **kwargs):
+        super().__init__(fp, size, zero_extents, **kwargs)
+        self.executor = executor
+        self.frame_size = frame_size
+        self.level = level
+        self.buf = bytearray()
+        self.queued = deque()
+        self.frames = []
+        self.zero_frame = None
+
+    def compress(self, data) -> bytes:
+        return ZSTD_compress(data, self.level, 1)
+
+    def queue_frame(self, data):
+        self.queued.append((self.executor.submit(self.compress, data), len(data)))
+        self.drain(False)
+
+    def drain(self, wait: bool):
+        while self.queued and (wait or self.queued[0][0].done()):
+            fut, n = self.queued.popleft()
+            compressed = fut.result()
+            self.fp.write(compressed)
+            self.frames.append((len(compressed), n))
+
+    def emit_data(self, data):
+        self.buf += data
+        while len(self.buf) >= self.frame_size:
+            self.queue_frame(bytes(self.buf[:self.frame_size]))
+            del self.buf[:self.frame_size]
+
+    def emit_zero(self, size: int):
+        if len(self.buf) > 0:
+            n = min(size, self.frame_size - len(self.buf))
+            self.emit_data(bytes(n))
+            size -= n
+        if size >= self.frame_size:
+            # every full zero frame compresses to the same bytes
+            if self.zero_frame is None:
+                self.zero_frame = self.compress(bytes(self.frame_size))
+            done = completed_future(self.zero_frame)
+            while size >= self.frame_size:
+                self.queued.append((done, self.frame_size))
+                size -= self.frame_size
+            self.drain(False)
+        if size > 0:
+            self.emit_data(bytes(size))
+
+    def finish(self):
+        if len(self.buf) > 0:
+            self.queue_frame(bytes(self.buf))
+            self.buf = bytearray()
+        self.drain(True)
+        self.fp.write(seek_table(self.frames))
@@ -0,0 +1,120 @@
+"""
+Sharded extraction: `--shard i/N` makes a process apply only its slice of the
+operations of the selected partitions, writing into preallocated images that
+N processes (on one host or on several sharing the output directory) fill
+together. The slices come from the manifest alone, so every shard computes
+the same split. Each shard leaves a marker in the output directory when it is
+done, `--verify` checks the markers and the image hashes.
+"""
+import hashlib
+import json
+import os
+
+MARKER_PREFIX = "shard-"
+
+
+def parse_shard(spec: str):
+    """'i/N' with 1 <= i <= N to a 0-based (index, count)"""
+    try:
+        i, n = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"shard must be i/N, got {spec!r}")
+    if n < 1 or not 1 <= i <= n:
+        raise ValueError(f"shard index must be between 1 and {n}, got {spec!r}")
+    return i - 1, n
+
+
+def op_cost(op, block_size: int) -> int:
+    # bytes downloaded plus bytes written, a ZERO op still costs its writes
+    return op.data_length + sum(ext.num_blocks for ext in op.dst_extents) * block_size
+
+
+def assign(partitions, block_size: int, count: int):
+    """
+    {partition name: [shard of each op]}: ops are split in manifest order into
+    `count` contiguous runs of about the same cost, which keeps each shard's
+    reads close together in the payload
+    """
+    costs = [[op_cost(op, block_size) for op in p.operations] for p in partitions]
+    total = sum(sum(c) for c in costs)
+    ops = sum(len(c) for c in costs)
+    shards = {}
+    done = 0
+    n = 0
+    for partition, partition_costs in zip(partitions, costs):
+        owners = []
+        for cost in partition_costs:
+            if total > 0:
+                # the shard whose share contains the middle of this op
+                owner = (2 * done + cost) * count // (2 * total)
+            else:
+                owner = n * count // ops
+            owners.append(min(owner, count - 1))
+            done += cost
+            n += 1
+        shards[partition.partition_name] = owners
+    return shards
+
+
+def manifest_digest(dam) -> str:
+    return hashlib.sha256(dam.SerializeToString()).hexdigest()
+
+
+def marker_path(out: str, index: int, count: int) -> str:
+    return os.path.join(out, f"{MARKER_PREFIX}{index + 1}-of-{count}.json")
+
+
+def write_marker(out: str, index: int, count: int, dam, partitions, ops: int):
+    marker = {
+        "shard": index + 1,
+        "shards": count,
+        "manifest_sha256": manifest_digest(dam),
+        "partitions": [p.partition_name for p in partitions],
+        "ops": ops,
+    }
+    with open(marker_path(out, index, count), "w") as f:
+        json.dump(marker, f, indent=4)
+
+
+def check_markers(out: str, dam, partitions):
+    """
+    problems found in the shard markers of `out`, an empty list when the
+    output was not sharded or all shards finished on the same manifest
+    """
+    markers = []
+    for name in sorted(os.listdir(out)):
+        if name.startswith(MARKER_PREFIX) and name.endswith(".json"):
+            with open(os.path.join(out, name)) as f:
+                markers.append(json.load(f))
+    if not markers:
+        return []
+
+    problems = []
+    counts = set(m["shards"] for m in markers)
+    if len(counts) > 1:
+        return [f"markers of different shard counts: {sorted(counts)}"]
+    count = counts.pop()
+    missing = sorted(set(range(1, count + 1)) - set(m["shard"] for m in markers))
+    if missing:
+        problems.append(f"shards not finished: {', '.join(f'{i}/{count}' for i in missing)}")
+    digest = manifest_digest(dam)
+    names = [p.partition_name for p in partitions]
+    for m in markers:
+        if m["manifest_sha256"] != digest:
+            problems.append(f"shard {m['shard']}/{count} was extracted from a different payload")
+        elif m["partitions"] != names:
+            problems.append(f"shard {m['shard']}/{count} extracted other partitions: {','.join(m['partitions'])}")
+    return problems
+
+
+def hash_file(path: str, size: int) -> bytes:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        remain = size
+        while remain > 0:
+            chunk = f.read(min(remain, 1 << 20))
+            if not chunk:
+                break
+            h.update(chunk)
+            remain -= len(chunk)
+    return h.digest()
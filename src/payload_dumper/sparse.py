@@ -0,0 +1,137 @@
+import struct
+
+from . import streamio
+from .update_metadata_pb2 import InstallOperation
+
+# https://android.googlesource.com/platform/system/core/+/refs/heads/main/libsparse/sparse_format.h
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+sparse_header_struct = "<I4H4I"
+sparse_header_size = struct.calcsize(sparse_header_struct)
+chunk_header_struct = "<2H2I"
+chunk_header_size = struct.calcsize(chunk_header_struct)
+
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+
+# total_sz of a chunk is an u32 including its header
+MAX_CHUNK_BYTES = 0xFFFFFFFF - chunk_header_size
+
+
+def plan_chunks(partition, block_size: int, size: int):
+    """
+    build the chunk list of a sparse image from the dst extents of the operations,
+    returns [(start_block, num_blocks, chunk_type)] covering the whole partition
+    """
+    extents = []
+    for op in partition.operations:
+        if op.type == InstallOperation.DISCARD:
+            chunk_type = CHUNK_TYPE_DONT_CARE
+        elif op.type == InstallOperation.ZERO:
+            chunk_type = CHUNK_TYPE_FILL
+        else:
+            chunk_type = CHUNK_TYPE_RAW
+        for ext in op.dst_extents:
+            extents.append((ext.start_block, ext.num_blocks, chunk_type))
+    extents.sort()
+
+    total_blocks = (size + block_size - 1) // block_size
+    max_raw_blocks = MAX_CHUNK_BYTES // block_size
+    chunks = []
+
+    def add(start, num, chunk_type):
+        if num == 0:
+            return
+        if chunks:
+            last_start, last_num, last_type = chunks[-1]
+            if last_type == chunk_type and last_start + last_num == start:
+                chunks[-1] = (last_start, last_num + num, chunk_type)
+                return
+        chunks.append((start, num, chunk_type))
+
+    pos = 0
+    for start, num, chunk_type in extents:
+        # blocks no operation touches read back as zeros in a raw image
+        add(pos, start - pos, CHUNK_TYPE_FILL)
+        add(start, num, chunk_type)
+        pos = start + num
+    add(pos, total_blocks - pos, CHUNK_TYPE_FILL)
+
+    split = []
+    for start, num, chunk_type in chunks:
+        while chunk_type == CHUNK_TYPE_RAW and num > max_raw_blocks:
+            split.append((start, max_raw_blocks, chunk_type))
+            start += max_raw_blocks
+            num -= max_raw_blocks
+        split.append((start, num, chunk_type))
+    return split
+
+
+def chunk_size(num_blocks: int, chunk_type: int, block_size: int) -> int:
+    if chunk_type == CHUNK_TYPE_RAW:
+        return chunk_header_size + num_blocks * block_size
+    elif chunk_type == CHUNK_TYPE_FILL:
+        return chunk_header_size + 4
+    return chunk_header_size
+
+
+def image_size(chunks, block_size: int) -> int:
+    return sparse_header_size + sum(chunk_size(num, t, block_size) for _, num, t in chunks)
+
+
+class SparseWriter(streamio.OrderedWriter):
+    """
+    Writes an Android sparse image in one pass, chunk headers are emitted as the
+    ordered stream reaches them, FILL and DONT_CARE chunks need no data.
+    """
+
+    def __init__(self, fp, block_size: int, chunks, close_fp=False, **kwargs):
+        total_blocks = sum(num for _, num, _ in chunks)
+        self.block_size = block_size
+        self.chunk_at = {}
+        zero_extents = []
+        for start, num, chunk_type in chunks:
+            off = start * block_size
+            length = num * block_size
+            self.chunk_at[off] = (length, chunk_type)
+            if chunk_type != CHUNK_TYPE_RAW:
+                zero_extents.append((off, length))
+        super().__init__(fp, total_blocks * block_size, zero_extents, close_fp=close_fp, **kwargs)
+        self.raw_end = 0
+        self.fp.write(struct.pack(
+            sparse_header_struct,
+            SPARSE_HEADER_MAGIC,
+            1, 0,
+            sparse_header_size, chunk_header_size,
+            block_size, total_blocks, len(chunks),
+            0
+        ))
+
+    def write_chunk_header(self, chunk_type: int, length: int):
+        self.fp.write(struct.pack(
+            chunk_header_struct,
+            chunk_type, 0,
+            length // self.block_size,
+            chunk_size(length // self.block_size, chunk_type, self.block_size)
+        ))
+
+    def emit_zero(self, size: int):
+        length, chunk_type = self.chunk_at[self.pos]
+        assert length == size and chunk_type != CHUNK_TYPE_RAW
+        self.write_chunk_header(chunk_type, length)
+        if chunk_type == CHUNK_TYPE_FILL:
+            self.fp.write(b"\x00" * 4)
+
+    def emit_data(self, data):
+        pos = self.pos
+        mem = memoryview(data)
+        while len(mem) > 0:
+            if pos in self.chunk_at:
+                length, chunk_type = self.chunk_at[pos]
+                assert chunk_type == CHUNK_TYPE_RAW
+                self.write_chunk_header(chunk_type, length)
+                self.raw_end = pos + length
+            n = min(len(mem), self.raw_end - pos)
+            self.fp.write(mem[:n])
+            mem = mem[n:]
+            pos += n
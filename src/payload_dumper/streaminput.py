@@ -0,0 +1,92 @@
+"""
+A payload read once from a pipe (`payload_dumper -`): `curl ... |`,
+`unzip -p ... |` or a decompressor. Reads must go forward, the bytes between
+two reads are skipped; the header and the manifest are read first, then the
+read-ahead thread (see readahead.py) consumes the op data in increasing
+payload offset and hands it to the workers as it arrives. A zip is walked
+through its local file headers, payload.bin has to be stored.
+"""
+from threading import Lock
+
+from . import mtio
+
+# bytes kept behind the read position, enough to look at the start of the
+# stream again while telling a zip from a bare payload
+BACKLOG = 64 << 10
+
+SKIP_CHUNK = 1 << 20
+
+
+class StreamPayload(mtio.MTIOBase):
+    def __init__(self, fp):
+        self.fp = fp
+        self.pos = 0
+        self.backlog = b""
+        self.lock = Lock()
+        self.transferred_bytes = 0
+        self.is_closed = False
+
+    def fill(self, size: int) -> bytes:
+        chunks = []
+        remain = size
+        while remain > 0:
+            chunk = self.fp.read(remain)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remain -= len(chunk)
+        data = b"".join(chunks)
+        self.pos += len(data)
+        self.transferred_bytes += len(data)
+        return data
+
+    def skip(self, size: int):
+        while size > 0:
+            n = len(self.fill(min(size, SKIP_CHUNK)))
+            if n == 0:
+                break
+            size -= n
+        self.backlog = b""
+
+    def read(self, off: int, size: int) -> bytes:
+        if self.is_closed:
+            raise ValueError('closed!')
+        with self.lock:
+            start = self.pos - len(self.backlog)
+            if off < start:
+                raise ValueError(f"can't read at {off} from a stream already at {self.pos}")
+            if off > self.pos:
+                self.skip(off - self.pos)
+            data = self.backlog[off - start:off - start + size] if off < self.pos else b""
+            if len(data) < size:
+                new = self.fill(size - len(data))
+                data += new
+                self.backlog = new[-BACKLOG:] if len(new) >= BACKLOG else (self.backlog + new)[-BACKLOG:]
+            return data
+
+    def readinto(self, off: int, size: int, ba) -> int:
+        data = self.read(off, size)
+        ba[:len(data)] = data
+        return len(data)
+
+    def get_size(self):
+        # unknown until the stream ends
+        return None
+
+    def set_size(self, size: int):
+        raise NotImplementedError()
+
+    def write(self, off: int, content: bytes) -> int:
+        raise NotImplementedError()
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    def close(self):
+        self.is_closed = True
+
+    def closed(self) -> bool:
+        return self.is_closed
@@ -0,0 +1,203 @@
+import bisect
+import tarfile
+import time
+from threading import Condition
+
+from . import mtio
+
+ZERO_CHUNK = 1 << 20
+DEFAULT_MAX_BUFFERED = 64 << 20
+
+
+def complement_extents(extents, size):
+    """return the (off, len) ranges of [0, size) not covered by `extents`"""
+    holes = []
+    pos = 0
+    for off, length in sorted(extents):
+        if off > pos:
+            holes.append((pos, off - pos))
+        pos = max(pos, off + length)
+    if pos < size:
+        holes.append((pos, size - pos))
+    return holes
+
+
+class OrderedWriter(mtio.MTIOBase):
+    """
+    Accepts positional writes in any order and emits them to a sequential
+    stream strictly in offset order. `zero_extents` are the (off, len) ranges
+    no operation will provide data for; they are emitted as zeros when the
+    cursor reaches them and writes falling inside them are dropped.
+
+    The reorder buffer is bounded by `max_buffered` bytes: the submitter calls
+    `reserve()` before queueing an operation and `op_done()` once it finished.
+    The bound is soft, a reservation never blocks while nothing is in flight,
+    otherwise scattered dst extents could stall the stream forever.
+
+    `fp` is closed together with the writer only if `close_fp` is set.
+    """
+
+    def __init__(self, fp, size: int, zero_extents=(), max_buffered=DEFAULT_MAX_BUFFERED, close_fp=False):
+        self.fp = fp
+        self.close_fp = close_fp
+        self.size = size
+        self.zeros = sorted(zero_extents)
+        self.zero_starts = [off for off, _ in self.zeros]
+        self.zero_idx = 0
+        self.max_buffered = max_buffered
+        self.pos = 0
+        self.pending = {}
+        self.reserved = 0
+        self.inflight = 0
+        self.aborted = False
+        self.cond = Condition()
+        self.is_closed = False
+
+    # sequential sink hooks, subclasses may encode the stream differently
+    def emit_data(self, data):
+        self.fp.write(data)
+
+    def emit_zero(self, size: int):
+        while size > 0:
+            n = min(size, ZERO_CHUNK)
+            self.fp.write(bytes(n))
+            size -= n
+
+    # called once all data has been emitted, before fp is closed
+    def finish(self):
+        pass
+
+    def reserve(self, size: int) -> bool:
+        with self.cond:
+            while (
+                not self.aborted
+                and self.inflight > 0
+                and self.reserved + size > self.max_buffered
+            ):
+                self.cond.wait()
+            if self.aborted:
+                return False
+            self.reserved += size
+            self.inflight += 1
+            return True
+
+    def op_done(self, fut=None):
+        with self.cond:
+            self.inflight -= 1
+            if fut is not None and (fut.cancelled() or fut.exception(0) is not None):
+                self.aborted = True
+            self.cond.notify_all()
+
+    def in_zero_extent(self, off: int, size: int) -> bool:
+        i = bisect.bisect_right(self.zero_starts, off) - 1
+        if i < 0:
+            return False
+        z_off, z_len = self.zeros[i]
+        return off + size <= z_off + z_len
+
+    def write(self, off: int, content: bytes) -> int:
+        size = len(content)
+        if size == 0 or self.in_zero_extent(off, size):
+            return size
+        with self.cond:
+            if off < self.pos or off in self.pending:
+                raise ValueError(f"overlapping write at {off}, stream is at {self.pos}")
+            self.pending[off] = bytes(content)
+            self.flush()
+        return size
+
+    def flush(self):
+        while True:
+            if self.zero_idx < len(self.zeros) and self.zeros[self.zero_idx][0] == self.pos:
+                _, length = self.zeros[self.zero_idx]
+                self.emit_zero(length)
+                self.pos += length
+                self.zero_idx += 1
+            elif self.pos in self.pending:
+                data = self.pending.pop(self.pos)
+                self.emit_data(data)
+                self.pos += len(data)
+                self.reserved -= len(data)
+                self.cond.notify_all()
+            else:
+                break
+
+    def get_size(self) -> int:
+        return self.size
+
+    def readable(self) -> bool:
+        return False
+
+    def writable(self) -> bool:
+        return True
+
+    def close(self):
+        if self.is_closed:
+            return
+        with self.cond:
+            self.flush()
+            self.is_closed = True
+            complete = self.pos == self.size
+            if complete:
+                self.finish()
+            if self.close_fp:
+                self.fp.close()
+            if not complete:
+                raise ValueError(f"incomplete stream: {self.pos} of {self.size} bytes written")
+
+    def closed(self) -> bool:
+        return self.is_closed
+
+
+class LazyFile:
+    """a file created on the first write, runs that never write one leave nothing behind"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fp = None
+
+    def write(self, data):
+        if self.fp is None:
+            self.fp = open(self.path, "wb")
+        return self.fp.write(data)
+
+    def flush(self):
+        if self.fp is not None:
+            self.fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+
+
+class TarStream:
+    """minimal streaming tar writer, entry sizes must be known in advance"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.written = 0
+        self.entry_size = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        self.written += len(data)
+
+    def add(self, name: str, size: int):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = int(time.time())
+        self.write(info.tobuf(format=tarfile.GNU_FORMAT))
+        self.entry_size = size
+
+    def end_entry(self):
+        _, rem = divmod(self.entry_size, tarfile.BLOCKSIZE)
+        if rem:
+            self.write(bytes(tarfile.BLOCKSIZE - rem))
+
+    def close(self):
+        self.write(bytes(tarfile.BLOCKSIZE * 2))
+        _, rem = divmod(self.written, tarfile.RECORDSIZE)
+        if rem:
+            self.write(bytes(tarfile.RECORDSIZE - rem))
+        self.fp.flush()
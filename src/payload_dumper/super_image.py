@@ -0,0 +1,174 @@
+import hashlib
+import struct
+
+from . import mtio
+
+# https://android.googlesource.com/platform/system/core/+/refs/heads/main/fs_mgr/liblp/include/liblp/metadata_format.h
+LP_PARTITION_RESERVED_BYTES = 4096
+LP_METADATA_GEOMETRY_MAGIC = 0x616C4467
+LP_METADATA_GEOMETRY_SIZE = 4096
+LP_METADATA_HEADER_MAGIC = 0x414C5030
+LP_METADATA_MAJOR_VERSION = 10
+LP_METADATA_MINOR_VERSION = 0
+LP_SECTOR_SIZE = 512
+
+LP_PARTITION_ATTR_READONLY = 1 << 0
+LP_TARGET_TYPE_LINEAR = 0
+
+geometry_struct = "<2I32s3I"
+geometry_size = struct.calcsize(geometry_struct)
+table_descriptor_struct = "<3I"
+header_struct = "<I2HI32sI32s12I"
+header_size = struct.calcsize(header_struct)
+partition_struct = "<36s4I"
+partition_size = struct.calcsize(partition_struct)
+extent_struct = "<QIQI"
+extent_size = struct.calcsize(extent_struct)
+group_struct = "<36sIQ"
+group_size = struct.calcsize(group_struct)
+block_device_struct = "<Q2IQ36sI"
+block_device_size = struct.calcsize(block_device_struct)
+
+DEFAULT_METADATA_MAX_SIZE = 65536
+DEFAULT_METADATA_SLOTS = 2
+DEFAULT_ALIGNMENT = 1024 * 1024
+LOGICAL_BLOCK_SIZE = 4096
+
+
+def align(x: int, a: int) -> int:
+    return (x + a - 1) // a * a
+
+
+def lp_name(name: str) -> bytes:
+    b = name.encode("utf-8")
+    if len(b) > 36:
+        raise ValueError(f"name too long for LP metadata: {name}")
+    return b
+
+
+def build_geometry(metadata_max_size: int, metadata_slots: int) -> bytes:
+    geometry = struct.pack(
+        geometry_struct, LP_METADATA_GEOMETRY_MAGIC, geometry_size, b"",
+        metadata_max_size, metadata_slots, LOGICAL_BLOCK_SIZE
+    )
+    checksum = hashlib.sha256(geometry).digest()
+    geometry = struct.pack(
+        geometry_struct, LP_METADATA_GEOMETRY_MAGIC, geometry_size, checksum,
+        metadata_max_size, metadata_slots, LOGICAL_BLOCK_SIZE
+    )
+    return geometry.ljust(LP_METADATA_GEOMETRY_SIZE, b"\0")
+
+
+def build_metadata(partitions, groups, block_device) -> bytes:
+    """
+    `partitions` is [(name, group_index, first_sector, num_sectors)],
+    `groups` is [(name, maximum_size)], `block_device` is (first_logical_sector, alignment, size)
+    """
+    partition_table = b""
+    extent_table = b""
+    num_extents = 0
+    for name, group_index, first_sector, num_sectors in partitions:
+        n = 1 if num_sectors > 0 else 0
+        partition_table += struct.pack(
+            partition_struct, lp_name(name), LP_PARTITION_ATTR_READONLY, num_extents, n, group_index
+        )
+        if n:
+            extent_table += struct.pack(extent_struct, num_sectors, LP_TARGET_TYPE_LINEAR, first_sector, 0)
+            num_extents += 1
+    group_table = b"".join(
+        struct.pack(group_struct, lp_name(name), 0, maximum_size) for name, maximum_size in groups
+    )
+    first_logical_sector, alignment, size = block_device
+    block_device_table = struct.pack(
+        block_device_struct, first_logical_sector, alignment, 0, size, lp_name("super"), 0
+    )
+    tables = partition_table + extent_table + group_table + block_device_table
+
+    descriptors = [
+        0, len(partitions), partition_size,
+        len(partition_table), num_extents, extent_size,
+        len(partition_table) + len(extent_table), len(groups), group_size,
+        len(partition_table) + len(extent_table) + len(group_table), 1, block_device_size,
+    ]
+    tables_checksum = hashlib.sha256(tables).digest()
+
+    def pack_header(checksum):
+        return struct.pack(
+            header_struct, LP_METADATA_HEADER_MAGIC,
+            LP_METADATA_MAJOR_VERSION, LP_METADATA_MINOR_VERSION,
+            header_size, checksum, len(tables), tables_checksum, *descriptors
+        )
+
+    header = pack_header(hashlib.sha256(pack_header(b"")).digest())
+    return header + tables
+
+
+class SuperImage:
+    """
+    Lays out the logical partitions of `dynamic_partition_metadata` in a single
+    super image, like lpmake does, and hands out writable views at their final
+    offsets so operations land in place.
+    """
+
+    def __init__(
+        self, path, dynamic_partition_metadata, partition_sizes, size=None, slot_suffix="",
+        metadata_max_size=DEFAULT_METADATA_MAX_SIZE, metadata_slots=DEFAULT_METADATA_SLOTS,
+        alignment=DEFAULT_ALIGNMENT
+    ):
+        groups = [("default", 0)]
+        partitions = []
+        self.layout = {}
+
+        metadata_end = (
+            LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE * 2
+            + metadata_max_size * metadata_slots * 2
+        )
+        first_logical_sector = align(metadata_end, alignment) // LP_SECTOR_SIZE
+        offset = first_logical_sector * LP_SECTOR_SIZE
+
+        for group in dynamic_partition_metadata.groups:
+            group_index = len(groups)
+            groups.append((group.name + slot_suffix, group.size))
+            used = 0
+            for name in group.partition_names:
+                if name not in partition_sizes:
+                    continue
+                part_size = align(partition_sizes[name], LOGICAL_BLOCK_SIZE)
+                offset = align(offset, alignment)
+                partitions.append((name + slot_suffix, group_index, offset // LP_SECTOR_SIZE, part_size // LP_SECTOR_SIZE))
+                self.layout[name] = (offset, part_size)
+                offset += part_size
+                used += part_size
+            if group.size and used > group.size:
+                raise ValueError(f"partitions of group {group.name} need {used} bytes, group size is {group.size}")
+
+        if size is None:
+            size = align(offset, alignment)
+        elif size < offset:
+            raise ValueError(f"super size {size} is too small, {offset} bytes are needed")
+        self.size = size
+
+        metadata = build_metadata(partitions, groups, (first_logical_sector, alignment, size))
+        if len(metadata) > metadata_max_size:
+            raise ValueError(f"LP metadata needs {len(metadata)} bytes, exceeds {metadata_max_size}")
+        geometry = build_geometry(metadata_max_size, metadata_slots)
+
+        # readable for --verity
+        self.file = mtio.MTFile(path, "rw")
+        self.file.set_size(size)
+        self.file.write(LP_PARTITION_RESERVED_BYTES, geometry)
+        self.file.write(LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE, geometry)
+        metadata_off = LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE * 2
+        # primary slots followed by backup slots, all carrying the same metadata
+        for slot in range(metadata_slots * 2):
+            self.file.write(metadata_off + slot * metadata_max_size, metadata)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.layout
+
+    def open_partition(self, name: str) -> mtio.MTIOBase:
+        offset, size = self.layout[name]
+        return mtio.MTIOSlice(self.file, offset, size)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,113 @@
+"""
+Opt-in span tracing, saved as Chrome trace event JSON (open it in Perfetto or
+chrome://tracing). Finished spans are handed to every installed recorder
+(the Tracer, the metrics collector), with none installed `span()` costs a
+single global lookup.
+"""
+import json
+import os
+import threading
+import time
+
+_recorders = []
+
+
+class Span:
+    __slots__ = ("name", "cat", "args", "start")
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    # extra args known only once the work is done, e.g. the decoded size
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        end = time.perf_counter_ns()
+        for recorder in _recorders:
+            recorder.add(self.name, self.cat, self.start, end, self.args)
+
+
+class NullSpan:
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_span = NullSpan()
+
+
+class Tracer:
+    def __init__(self):
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter_ns()
+        self.pid = os.getpid()
+
+    def add(self, name: str, cat: str, start_ns: int, end_ns: int, args):
+        tid = threading.get_ident()
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": (start_ns - self.t0) / 1000,
+            "dur": (end_ns - start_ns) / 1000,
+            "pid": self.pid,
+            "tid": tid,
+            "args": args,
+        }
+        with self.lock:
+            if tid not in self.thread_names:
+                self.thread_names[tid] = threading.current_thread().name
+            self.events.append(event)
+
+    def save(self, path: str):
+        with self.lock:
+            meta = [
+                {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self.thread_names.items()
+            ]
+            events = meta + self.events
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# a recorder has add(name, cat, start_ns, end_ns, args), called from any thread
+def install(recorder):
+    _recorders.append(recorder)
+    return recorder
+
+
+def uninstall(recorder):
+    _recorders.remove(recorder)
+
+
+def enable() -> Tracer:
+    return install(Tracer())
+
+
+def get_tracer():
+    for recorder in _recorders:
+        if isinstance(recorder, Tracer):
+            return recorder
+    return None
+
+
+def span(name: str, cat: str, **args):
+    if not _recorders:
+        return _null_span
+    return Span(name, cat, args)
@@ -0,0 +1,232 @@
+"""
+Adaptive concurrency (--autotune): instead of a fixed --workers, a
+controller thread adjusts how many range reads run at once and how many ops
+decode at once, separately and within configured bounds.
+
+Every interval it looks at the download rate, the mean request latency (from
+the tracing spans, the tuner is installed as a recorder), the bytes fetched
+but not yet written, and the CPU time used:
+
+- fetch: while reads queue for a slot, the limit doubles as long as the rate
+  keeps improving (slow start) and then grows by one; it is cut by a quarter
+  when latency climbs without a rate gain, and halved when in-flight bytes
+  exceed the memory budget.
+- decode: grows by one while ops wait for a slot and the CPUs have headroom,
+  cut by a quarter when the machine is oversubscribed (load average above the
+  CPU count) or the data held by decoding ops exceeds the memory budget.
+
+Decisions are printed and shown in a status bar under the progress bars.
+"""
+import os
+import time
+from threading import Condition, Event, Lock, Thread
+
+from . import tracing
+
+
+class Limiter:
+    """a semaphore whose limit can change while it is held"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        # acquisitions that had to wait, tells a saturated limit from an idle one
+        self.waits = 0
+        self.cond = Condition()
+
+    def acquire(self):
+        with self.cond:
+            if self.active >= self.limit:
+                self.waits += 1
+                while self.active >= self.limit:
+                    self.cond.wait()
+            self.active += 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def set_limit(self, limit: int):
+        with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+
+class Slot:
+    def __init__(self, limiter: Limiter, counter, size: int):
+        self.limiter = limiter
+        self.counter = counter
+        self.size = size
+
+    def __enter__(self):
+        self.limiter.acquire()
+        self.counter.add(self.size)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.counter.add(-self.size)
+        self.limiter.release()
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.total = 0
+        self.lock = Lock()
+
+    def add(self, n: int):
+        with self.lock:
+            self.value += n
+            if n > 0:
+                self.total += n
+
+
+class Autotuner:
+    def __init__(self, payloadfile, max_fetch: int = 64, max_decode: int = None, min_fetch: int = 1,
+                 min_decode: int = 1, memory_budget: int = 1 << 30, interval: float = 1.0):
+        self.payloadfile = payloadfile
+        self.cpus = os.cpu_count() or 1
+        self.min_fetch = min_fetch
+        self.max_fetch = max_fetch
+        self.min_decode = min_decode
+        self.max_decode = max_decode or self.cpus
+        self.memory_budget = memory_budget
+        self.interval = interval
+
+        start_fetch = max(min_fetch, min(4, max_fetch))
+        # the async engine limits its own requests, the thread engine reads through fetch_slot()
+        self.fetch = getattr(payloadfile, "slots", None)
+        if self.fetch is None:
+            self.fetch = Limiter(start_fetch)
+        else:
+            self.fetch.set_limit(start_fetch)
+        self.decode = Limiter(max(min_decode, min(self.cpus, self.max_decode)))
+        self.fetching = Counter()
+        self.decoding = Counter()
+        self.slow_start = True
+
+        self.latency_lock = Lock()
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.min_latency = None
+        self.last_rate = 0.0
+
+        self.status = None
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, name="autotune", daemon=True)
+
+    @property
+    def workers(self) -> int:
+        """threads the op pool needs so neither limit is starved by the other"""
+        if hasattr(self.payloadfile, "slots"):
+            return self.max_decode
+        return self.max_fetch + self.max_decode
+
+    def fetch_slot(self, size: int) -> Slot:
+        return Slot(self.fetch, self.fetching, size)
+
+    def decode_slot(self, size: int) -> Slot:
+        return Slot(self.decode, self.decoding, size)
+
+    # tracing recorder, request latency comes from the GET (or local fetch) spans
+    def add(self, name: str, cat: str, start_ns: int, end_ns: int, args):
+        if (cat == "http" and name == "GET") or (cat == "stage" and name == "fetch"):
+            with self.latency_lock:
+                self.latency_sum += (end_ns - start_ns) / 1e9
+                self.latency_count += 1
+
+    def start(self, manager):
+        self.status = manager.status_bar(
+            status_format="autotune: fetch {fetch} decode {decode}  {rate:.1f} MiB/s  cpu {cpu:.1f}",
+            fetch=self.fetch.limit, decode=self.decode.limit, rate=0.0, cpu=0.0,
+        )
+        tracing.install(self)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        tracing.uninstall(self)
+        self.status.close()
+
+    def fetched_bytes(self) -> int:
+        if hasattr(self.payloadfile, "transferred_bytes"):
+            return self.payloadfile.transferred_bytes
+        return self.fetching.total
+
+    def in_flight(self) -> int:
+        # the async engine accounts for what it downloaded ahead of the workers
+        return getattr(self.payloadfile, "buffered", self.fetching.value) + self.decoding.value
+
+    def run(self):
+        last_t = time.perf_counter()
+        last_cpu = time.process_time()
+        last_bytes = self.fetched_bytes()
+        last_fetch_waits = self.fetch.waits
+        last_decode_waits = self.decode.waits
+        while not self.stopped.wait(self.interval):
+            t = time.perf_counter()
+            cpu_time = time.process_time()
+            nbytes = self.fetched_bytes()
+            wall = t - last_t
+            rate = (nbytes - last_bytes) / wall
+            cpu = (cpu_time - last_cpu) / wall
+            with self.latency_lock:
+                latency = self.latency_sum / self.latency_count if self.latency_count else None
+                self.latency_sum = 0.0
+                self.latency_count = 0
+            fetch_waits = self.fetch.waits - last_fetch_waits
+            decode_waits = self.decode.waits - last_decode_waits
+            last_t, last_cpu, last_bytes = t, cpu_time, nbytes
+            last_fetch_waits, last_decode_waits = self.fetch.waits, self.decode.waits
+
+            self.tune_fetch(rate, latency, fetch_waits > 0)
+            self.tune_decode(cpu, decode_waits > 0)
+            if latency is not None:
+                self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+            self.last_rate = rate
+            self.status.update(fetch=self.fetch.limit, decode=self.decode.limit, rate=rate / (1 << 20), cpu=cpu)
+
+    def tune_fetch(self, rate: float, latency, saturated: bool):
+        limit = self.fetch.limit
+        if self.in_flight() > self.memory_budget:
+            self.slow_start = False
+            self.set_fetch(limit // 2, "in-flight data over the memory budget")
+        elif not saturated:
+            # reads don't queue, more slots wouldn't be used
+            return
+        elif rate > self.last_rate * 1.05:
+            if self.slow_start:
+                self.set_fetch(limit * 2, f"rate up to {rate / (1 << 20):.1f} MiB/s")
+            else:
+                self.set_fetch(limit + 1, f"rate up to {rate / (1 << 20):.1f} MiB/s")
+        elif latency is not None and self.min_latency is not None and latency > 1.5 * self.min_latency:
+            self.slow_start = False
+            self.set_fetch(limit * 3 // 4, f"latency {latency * 1000:.0f} ms without a rate gain")
+        else:
+            self.slow_start = False
+
+    def tune_decode(self, cpu: float, waiting: bool):
+        limit = self.decode.limit
+        load = os.getloadavg()[0] if hasattr(os, "getloadavg") else 0.0
+        if self.decoding.value > self.memory_budget:
+            self.set_decode(limit * 3 // 4, "decoding ops over the memory budget")
+        elif load > self.cpus * 1.25 and cpu < limit:
+            # other processes take the CPUs, our threads only queue behind them
+            self.set_decode(limit * 3 // 4, f"load average {load:.1f} on {self.cpus} CPUs")
+        elif waiting and cpu < self.cpus * 0.9:
+            self.set_decode(limit + 1, f"ops waiting, {cpu:.1f} CPUs busy")
+
+    def set_fetch(self, limit: int, reason: str):
+        limit = max(self.min_fetch, min(self.max_fetch, limit))
+        if limit != self.fetch.limit:
+            print(f"autotune: fetch {self.fetch.limit} -> {limit} ({reason})")
+            self.fetch.set_limit(limit)
+
+    def set_decode(self, limit: int, reason: str):
+        limit = max(self.min_decode, min(self.max_decode, limit))
+        if limit != self.decode.limit:
+            print(f"autotune: decode {self.decode.limit} -> {limit} ({reason})")
+            self.decode.set_limit(limit)
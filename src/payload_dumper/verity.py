@@ -0,0 +1,284 @@
+"""
+dm-verity hash tree and FEC (--verity): payloads leave the
+`hash_tree_extent` and `fec_extent` of a partition to the device, which
+computes them from `hash_tree_data_extent` / `fec_data_extent` after
+applying the ops. Without them an extracted image neither boots with
+verification nor matches `new_partition_info.hash`.
+
+The tree is built as avbtool and update_engine do it: level 0 holds the
+salted digest of every data block, each level above the digests of the
+blocks of the one below, every level padded to whole blocks, stored top
+level first. Level 0 is hashed in chunks of CHUNK_BLOCKS blocks on the op
+pool as soon as every op writing into a chunk has finished; the small upper
+levels follow once the data is complete.
+
+The FEC is libfec's Reed-Solomon code, RS(255, 255 - fec_roots) over
+GF(2^8), interleaved so that the codewords of round i take byte k of the
+blocks i, i + rounds, i + 2 * rounds, ... Parity is linear in the data, so a
+round is the XOR of every data block mapped through a multiplication table
+(bytes.translate) per parity byte, 4096 codewords at a time.
+"""
+import hashlib
+from threading import Lock
+
+from . import tracing
+
+CHUNK_BLOCKS = 256
+# rounds of FEC encoded by one task
+FEC_TASK_ROUNDS = 16
+FEC_RSM = 255
+
+# GF(2^8) with the field polynomial of libfec
+GF_POLY = 0x11d
+
+
+def gf_tables():
+    """(EXP, LOG): powers of the primitive element and their inverse, LOG[0] stands for log(0)"""
+    exp = [0] * 255
+    log = [FEC_RSM] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= GF_POLY
+    return exp, log
+
+
+EXP, LOG = gf_tables()
+
+
+def gf_mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return EXP[(LOG[a] + LOG[b]) % 255]
+
+
+MUL_TABLES = None
+
+
+def mul_tables():
+    """MUL_TABLES[c] maps every byte to its product with c, for bytes.translate"""
+    global MUL_TABLES
+    if MUL_TABLES is None:
+        MUL_TABLES = [bytes(gf_mul(c, v) for v in range(256)) for c in range(256)]
+    return MUL_TABLES
+
+
+def rs_genpoly(nroots: int, fcr: int = 0, prim: int = 1):
+    """generator polynomial in index form, as init_rs_char() builds it"""
+    g = [1] + [0] * nroots
+    root = fcr * prim
+    for i in range(nroots):
+        g[i + 1] = 1
+        for j in range(i, 0, -1):
+            if g[j] != 0:
+                g[j] = g[j - 1] ^ EXP[(LOG[g[j]] + root) % 255]
+            else:
+                g[j] = g[j - 1]
+        g[0] = EXP[(LOG[g[0]] + root) % 255]
+        root += prim
+    return [LOG[c] for c in g]
+
+
+def rs_encode(data, genpoly, nroots: int):
+    """parity of one codeword, encode_rs_char()"""
+    parity = [0] * nroots
+    for d in data:
+        feedback = LOG[d ^ parity[0]]
+        if feedback != FEC_RSM:
+            for j in range(1, nroots):
+                parity[j] ^= EXP[(feedback + genpoly[nroots - j]) % 255]
+        parity = parity[1:] + [EXP[(feedback + genpoly[0]) % 255] if feedback != FEC_RSM else 0]
+    return parity
+
+
+def rs_coefficients(nroots: int):
+    """coefficients[j][r]: what data byte j contributes to parity byte r"""
+    genpoly = rs_genpoly(nroots)
+    rs_n = FEC_RSM - nroots
+    return [rs_encode([0] * j + [1] + [0] * (rs_n - j - 1), genpoly, nroots) for j in range(rs_n)]
+
+
+def round_up(n: int, size: int) -> int:
+    return (n + size - 1) // size * size
+
+
+def has_verity(partition) -> bool:
+    return partition.hash_tree_extent.num_blocks > 0 and partition.hash_tree_data_extent.num_blocks > 0
+
+
+class VerityBuilder:
+    """
+    computes the hash tree and FEC of `partition` in `file`, an MTIOBase that
+    can be read back; with `verify` the extents already in the file are
+    compared instead of written
+    """
+
+    def __init__(self, partition, block_size: int, file, executor, verify=False, fec=True):
+        self.partition = partition
+        self.block_size = block_size
+        self.file = file
+        self.executor = executor
+        self.verify = verify
+        self.fec = fec and partition.fec_extent.num_blocks > 0 and partition.fec_data_extent.num_blocks > 0
+        self.algorithm = partition.hash_tree_algorithm or "sha256"
+        self.salt = partition.hash_tree_salt
+        self.digest_size = hashlib.new(self.algorithm).digest_size
+        # digests are padded to a power of two
+        self.hash_size = 1 << (self.digest_size - 1).bit_length()
+        self.data_off = partition.hash_tree_data_extent.start_block * block_size
+        self.data_blocks = partition.hash_tree_data_extent.num_blocks
+        self.level0 = bytearray(self.data_blocks * self.hash_size)
+        chunks = (self.data_blocks + CHUNK_BLOCKS - 1) // CHUNK_BLOCKS
+        # ops still to land in each chunk of the data
+        self.pending = [0] * chunks
+        self.lock = Lock()
+        self.tasks = []
+
+    def chunks_of(self, extents):
+        first_block = self.partition.hash_tree_data_extent.start_block
+        chunks = set()
+        for ext in extents:
+            start = max(ext.start_block, first_block) - first_block
+            end = min(ext.start_block + ext.num_blocks, first_block + self.data_blocks) - first_block
+            if start < end:
+                chunks.update(range(start // CHUNK_BLOCKS, (end - 1) // CHUNK_BLOCKS + 1))
+        return chunks
+
+    def start(self, ops):
+        """`ops` are the op dicts about to be applied, chunks none of them write are hashed right away"""
+        for op in ops:
+            for chunk in self.chunks_of(op["operation"].dst_extents):
+                self.pending[chunk] += 1
+        for chunk, count in enumerate(self.pending):
+            if count == 0:
+                self.submit(chunk)
+
+    def batch_done(self, batch, task):
+        if task.cancelled() or task.exception(0) is not None:
+            return
+        ready = []
+        with self.lock:
+            for op in batch:
+                for chunk in self.chunks_of(op["operation"].dst_extents):
+                    self.pending[chunk] -= 1
+                    if self.pending[chunk] == 0:
+                        ready.append(chunk)
+        for chunk in ready:
+            self.submit(chunk)
+
+    def submit(self, chunk: int):
+        task = self.executor.submit(self.hash_chunk, chunk)
+        with self.lock:
+            self.tasks.append(task)
+
+    def hash_blocks(self, data) -> bytes:
+        base = hashlib.new(self.algorithm)
+        base.update(self.salt)
+        pad = bytes(self.hash_size - self.digest_size)
+        view = memoryview(data)
+        digests = []
+        for off in range(0, len(data), self.block_size):
+            h = base.copy()
+            h.update(view[off:off + self.block_size])
+            digests.append(h.digest())
+            if pad:
+                digests.append(pad)
+        return b"".join(digests)
+
+    def read_blocks(self, off: int, size: int) -> bytes:
+        data = self.file.read(off, size)
+        # a file not extended to its full size yet reads back short
+        return data + bytes(size - len(data)) if len(data) < size else data
+
+    def hash_chunk(self, chunk: int):
+        first = chunk * CHUNK_BLOCKS
+        n = min(CHUNK_BLOCKS, self.data_blocks - first)
+        with tracing.span("verity", "stage", size=n * self.block_size):
+            data = self.read_blocks(self.data_off + first * self.block_size, n * self.block_size)
+            self.level0[first * self.hash_size:(first + n) * self.hash_size] = self.hash_blocks(data)
+
+    def pad_level(self, level) -> bytes:
+        return bytes(level) + bytes(round_up(len(level), self.block_size) - len(level))
+
+    def build_tree(self):
+        """(root digest, tree bytes)"""
+        for task in self.tasks:
+            task.result()
+        level = self.pad_level(self.level0)
+        levels = [level]
+        step = CHUNK_BLOCKS * self.block_size
+        while len(level) > self.block_size:
+            tasks = [self.executor.submit(self.hash_blocks, level[off:off + step]) for off in range(0, len(level), step)]
+            level = self.pad_level(b"".join(task.result() for task in tasks))
+            levels.append(level)
+        h = hashlib.new(self.algorithm)
+        h.update(self.salt)
+        h.update(level)
+        return h.digest(), b"".join(reversed(levels))
+
+    def fec_rounds(self, first: int, last: int, rounds: int, coefficients) -> bytes:
+        roots = self.partition.fec_roots
+        tables = mul_tables()
+        bs = self.block_size
+        data_off = self.partition.fec_data_extent.start_block * bs
+        data_blocks = self.partition.fec_data_extent.num_blocks
+        out = bytearray((last - first) * roots * bs)
+        for i in range(first, last):
+            parity = [0] * roots
+            for j, coefficient in enumerate(coefficients):
+                block = j * rounds + i
+                if block >= data_blocks:
+                    # past the data, zeros
+                    break
+                data = self.read_blocks(data_off + block * bs, bs)
+                for r, c in enumerate(coefficient):
+                    if c:
+                        parity[r] ^= int.from_bytes(data.translate(tables[c]), "little")
+            # codeword k of the round stores its parity at k * roots
+            base = (i - first) * roots * bs
+            for r in range(roots):
+                out[base + r:base + roots * bs:roots] = parity[r].to_bytes(bs, "little")
+        return bytes(out)
+
+    def build_fec(self) -> bytes:
+        roots = self.partition.fec_roots
+        if not 0 < roots < FEC_RSM:
+            raise ValueError(f"unsupported fec_roots {roots}")
+        rs_n = FEC_RSM - roots
+        rounds = (self.partition.fec_data_extent.num_blocks + rs_n - 1) // rs_n
+        if rounds * roots > self.partition.fec_extent.num_blocks:
+            raise ValueError(f"fec_extent of {self.partition.fec_extent.num_blocks} blocks can't hold {rounds * roots}")
+        coefficients = rs_coefficients(roots)
+        starts = range(0, rounds, FEC_TASK_ROUNDS)
+        with tracing.span("fec", "stage", rounds=rounds):
+            tasks = [
+                self.executor.submit(self.fec_rounds, first, min(first + FEC_TASK_ROUNDS, rounds), rounds, coefficients)
+                for first in starts
+            ]
+            return b"".join(task.result() for task in tasks)
+
+    def apply(self, extent, data: bytes) -> bool:
+        """write `data` at `extent`, or compare it with what is there"""
+        off = extent.start_block * self.block_size
+        if len(data) > extent.num_blocks * self.block_size:
+            raise ValueError(f"{len(data)} bytes don't fit in an extent of {extent.num_blocks} blocks")
+        if self.verify:
+            return self.read_blocks(off, len(data)) == data
+        self.file.write(off, data)
+        return True
+
+    def finish(self):
+        """
+        once every op is applied: (root digest, problems), problems is empty
+        unless verifying found a mismatch
+        """
+        problems = []
+        root, tree = self.build_tree()
+        if not self.apply(self.partition.hash_tree_extent, tree):
+            problems.append("hash tree mismatch")
+        if self.fec and not self.apply(self.partition.fec_extent, self.build_fec()):
+            problems.append("FEC mismatch")
+        return root, problems
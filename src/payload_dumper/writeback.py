@@ -0,0 +1,241 @@
+"""
+Output I/O policy of raw image files (--io-policy). A full OTA writes many
+GB; with plain pwrite() the kernel keeps it all as dirty pages until its
+writeback thresholds hit, then stalls every writer on the machine while it
+flushes, and the written images evict the page cache of other jobs.
+
+- default: plain pwrite()
+- sync: every `dirty_limit` bytes written to a file, wait for the writeback
+  started the previous time and start it for what is dirty now
+  (sync_file_range), the dirty pages of an image stay below about twice the
+  limit and the disk is kept busy all along
+- dontneed: like sync, and the pages whose writeback finished are dropped
+  (POSIX_FADV_DONTNEED), the extraction doesn't grow the page cache
+- direct: O_DIRECT writes through a pool of page-aligned buffers, bypassing
+  the page cache; unaligned writes and all reads go through a second,
+  buffered descriptor
+
+Linux only, elsewhere (and for O_DIRECT on filesystems without it) the
+default applies.
+"""
+import ctypes
+import mmap
+import os
+import sys
+from threading import Lock
+
+from . import mtio
+
+POLICIES = ("default", "sync", "dontneed", "direct")
+DEFAULT_DIRTY_LIMIT = 64 << 20
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# O_DIRECT needs offsets, sizes and buffers aligned to the logical block size
+DIRECT_ALIGN = 4096
+DIRECT_BUFFER = 1 << 20
+
+
+def supported() -> bool:
+    return sys.platform.startswith("linux") and hasattr(os, "posix_fadvise")
+
+
+libc_sync_file_range = None
+
+
+def sync_file_range(fd: int, flags: int, off: int = 0, size: int = 0):
+    """sync_file_range(2) through libc, fdatasync() where it is missing"""
+    global libc_sync_file_range
+    if libc_sync_file_range is None:
+        try:
+            f = ctypes.CDLL(None, use_errno=True).sync_file_range
+            f.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+            f.restype = ctypes.c_int
+            libc_sync_file_range = f
+        except (OSError, AttributeError):
+            libc_sync_file_range = False
+    if libc_sync_file_range is False:
+        if flags & (SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WAIT_AFTER):
+            os.fdatasync(fd)
+        return
+    if libc_sync_file_range(fd, off, size, flags) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+class WritebackFile(mtio.MTIOBase):
+    """`sync` and `dontneed`: an MTFile whose writes start writeback every `dirty_limit` bytes"""
+
+    def __init__(self, base, dirty_limit: int = DEFAULT_DIRTY_LIMIT, drop: bool = False):
+        self.base = base
+        self.fd = base.fd
+        self.dirty_limit = dirty_limit
+        self.drop = drop
+        self.dirty = 0
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.is_closed = False
+
+    def write(self, off: int, content: bytes) -> int:
+        n = self.base.write(off, content)
+        with self.lock:
+            self.dirty += n
+            if self.dirty < self.dirty_limit:
+                return n
+            self.dirty = 0
+        # the writers wait here while the disk is behind, that's the throttle
+        self.flush()
+        return n
+
+    def flush(self, wait: bool = False):
+        with self.flush_lock:
+            sync_file_range(self.fd, SYNC_FILE_RANGE_WAIT_BEFORE)
+            if self.drop:
+                # clean now, dirty pages are left alone
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            sync_file_range(self.fd, SYNC_FILE_RANGE_WRITE | (SYNC_FILE_RANGE_WAIT_AFTER if wait else 0))
+            if self.drop and wait:
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def read(self, off: int, size: int) -> bytes:
+        return self.base.read(off, size)
+
+    def readinto(self, off: int, size: int, ba) -> int:
+        return self.base.readinto(off, size, ba)
+
+    def get_size(self) -> int:
+        return self.base.get_size()
+
+    def set_size(self, size: int):
+        self.base.set_size(size)
+
+    def readable(self) -> bool:
+        return self.base.readable()
+
+    def writable(self) -> bool:
+        return self.base.writable()
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        try:
+            # dontneed leaves nothing of the image behind in the cache
+            self.flush(wait=self.drop)
+        finally:
+            self.base.close()
+
+    def closed(self) -> bool:
+        return self.is_closed
+
+
+class BufferPool:
+    """page-aligned buffers for O_DIRECT, one per concurrent writer"""
+
+    def __init__(self, size: int = DIRECT_BUFFER):
+        self.size = size
+        self.free = []
+        self.lock = Lock()
+
+    def get(self) -> mmap.mmap:
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        # anonymous mappings start on a page boundary
+        return mmap.mmap(-1, self.size)
+
+    def put(self, buf: mmap.mmap):
+        with self.lock:
+            self.free.append(buf)
+
+
+class DirectFile(mtio.MTIOBase):
+    """`direct`: aligned writes with O_DIRECT, the rest through the buffered MTFile `base`"""
+
+    def __init__(self, base, path: str, pool: BufferPool):
+        self.base = base
+        self.fd = base.fd
+        # raises EINVAL where the filesystem has no O_DIRECT
+        self.direct_fd = os.open(path, os.O_WRONLY | os.O_DIRECT | os.O_CLOEXEC)
+        self.pool = pool
+        self.is_closed = False
+
+    def write(self, off: int, content: bytes) -> int:
+        size = len(content)
+        if off % DIRECT_ALIGN or size % DIRECT_ALIGN:
+            return self.base.write(off, content)
+        mem = memoryview(content).cast("B")
+        buf = self.pool.get()
+        try:
+            with memoryview(buf) as view:
+                pos = 0
+                while pos < size:
+                    n = min(len(view), size - pos)
+                    view[:n] = mem[pos:pos + n]
+                    written = os.pwrite(self.direct_fd, view[:n], off + pos)
+                    if written != n:
+                        # the rest of a short direct write isn't aligned anymore
+                        self.base.write(off + pos + written, mem[pos + written:pos + n])
+                    pos += n
+        finally:
+            self.pool.put(buf)
+        return size
+
+    def read(self, off: int, size: int) -> bytes:
+        return self.base.read(off, size)
+
+    def readinto(self, off: int, size: int, ba) -> int:
+        return self.base.readinto(off, size, ba)
+
+    def get_size(self) -> int:
+        return self.base.get_size()
+
+    def set_size(self, size: int):
+        self.base.set_size(size)
+
+    def readable(self) -> bool:
+        return self.base.readable()
+
+    def writable(self) -> bool:
+        return True
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        try:
+            os.close(self.direct_fd)
+        finally:
+            self.base.close()
+
+    def closed(self) -> bool:
+        return self.is_closed
+
+
+class Policy:
+    """opens the raw images of one run with the chosen policy"""
+
+    def __init__(self, name: str = "default", dirty_limit: int = DEFAULT_DIRTY_LIMIT):
+        if name not in POLICIES:
+            raise ValueError(f"unknown I/O policy {name}")
+        if name != "default" and not supported():
+            print(f"--io-policy {name} needs Linux, writing with the default policy")
+            name = "default"
+        self.name = name
+        self.dirty_limit = dirty_limit
+        self.pool = BufferPool() if name == "direct" else None
+        self.direct_failed = False
+
+    def open(self, path: str, mode: str) -> mtio.MTIOBase:
+        f = mtio.MTFile(path, mode)
+        if self.name in ("sync", "dontneed"):
+            return WritebackFile(f, self.dirty_limit, drop=self.name == "dontneed")
+        if self.name == "direct" and not self.direct_failed:
+            try:
+                return DirectFile(f, path, self.pool)
+            except OSError as e:
+                self.direct_failed = True
+                print(f"O_DIRECT not available for {path} ({e.strerror}), writing through the page cache")
+        return f
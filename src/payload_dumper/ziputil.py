@@ -158,3 +158,44 @@ def get_zip_stored_entry_offset(file: mtio.MTIOBase, name: str):
     real_off = lfh_offset + zip_fh_size + file_name_length + extra_field_length
 
     return real_off, entry_size
+
+
+def get_zip_stored_entry_offset_sequential(file: mtio.MTIOBase, name: str):
+    """
+    like get_zip_stored_entry_offset, but walks the local file headers from the
+    start instead of reading the central directory at the end, for a zip read
+    from a stream
+    """
+    name_utf8 = name.encode('utf-8')
+    off = 0
+    while True:
+        data = file.read(off, zip_fh_size)
+        if len(data) != zip_fh_size or data[0:4] != zip_fh_magic:
+            raise ValueError(f'target not found: {name}')
+        file_header = struct.unpack(zip_fh_struct, data)
+        flags = file_header[2]
+        compression_method = file_header[3]
+        file_compressed_size = file_header[7]
+        file_uncompressed_size = file_header[8]
+        file_name_length = file_header[9]
+        extra_field_length = file_header[10]
+        file_name = file.read(off + zip_fh_size, file_name_length)
+        extra = file.read(off + zip_fh_size + file_name_length, extra_field_length)
+        real_off = off + zip_fh_size + file_name_length + extra_field_length
+
+        ep = 0
+        while len(extra) - ep >= 4:
+            header_id, field_size = struct.unpack('<HH', extra[ep:ep+4])
+            # ZIP64 ext, the local header has both sizes
+            if header_id == 1 and field_size >= 16:
+                file_uncompressed_size, file_compressed_size = struct.unpack('<2Q', extra[ep+4:ep+20])
+            ep += field_size + 4
+
+        if file_name == name_utf8:
+            if compression_method != ZIP_STORED:
+                raise ValueError(f'target not stored: {compression_method=}')
+            return real_off, file_uncompressed_size
+        if flags & 0x8:
+            # sizes follow the data, there's no telling where the next header is
+            raise ValueError(f'can\'t skip {file_name!r}: sizes are in a data descriptor')
+        off = real_off + file_compressed_size
@@ -0,0 +1,54 @@
+import os
+import time
+
+from payload_dumper import cache
+
+
+def save(directory, identity, size=1000):
+    c = cache.PayloadCache(str(directory), identity)
+    c.save_manifest(0, 0, bytes(size), b"", {})
+    return c
+
+
+def age(c, seconds):
+    t = time.time() - seconds
+    for ext in (".json", ".manifest"):
+        os.utime(c.prefix + ext, (t, t))
+
+
+def test_prune_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "MAX_ENTRIES", 3)
+    entries = []
+    for i in range(3):
+        entries.append(save(tmp_path, f"url:https://example.com/{i}:1000:etag:"))
+        age(entries[-1], 100 - i)
+    # used now, the oldest one apart from it goes
+    assert entries[0].load_manifest() is not None
+    save(tmp_path, "url:https://example.com/3:1000:etag:")
+    assert entries[0].load_manifest() is not None
+    assert entries[1].load_manifest() is None
+    assert entries[2].load_manifest() is not None
+    assert len(os.listdir(tmp_path)) == 6
+
+
+def test_prune_size_cap(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "MAX_BYTES", 2500)
+    first = save(tmp_path, "url:https://example.com/a:1000:etag:")
+    age(first, 10)
+    second = save(tmp_path, "url:https://example.com/b:1000:etag:")
+    age(second, 5)
+    last = save(tmp_path, "url:https://example.com/c:1000:etag:")
+    assert first.load_manifest() is None
+    assert second.load_manifest() is not None
+    assert last.load_manifest() is not None
+
+
+def test_prune_stale_local_entries(tmp_path):
+    payload = tmp_path / "payload.bin"
+    payload.write_bytes(b"x")
+    directory = tmp_path / "cache"
+    old = save(directory, cache.file_identity(str(payload)))
+    payload.write_bytes(b"changed")
+    save(directory, cache.file_identity(str(payload)))
+    assert old.load_manifest() is None
+    assert not os.path.exists(old.prefix + ".manifest")
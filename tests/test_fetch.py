@@ -0,0 +1,82 @@
+import io
+import os
+import threading
+
+import pytest
+
+from payload_dumper import mtio
+from payload_dumper.readahead import ReadAhead
+from payload_dumper.streaminput import StreamPayload
+
+DATA = os.urandom(1 << 20)
+
+
+def check_batches(fetcher, window):
+    # each batch is a few scattered reads adding up to more than the window
+    batches = [[(off, 96 << 10), (off + (200 << 10), 96 << 10)] for off in range(0, len(DATA) - (300 << 10), 300 << 10)]
+    assert all(sum(size for _, size in reads) > window for reads in batches)
+    for reads in batches:
+        futures = fetcher.fetch_batch(reads)
+        for (off, size), future in zip(reads, futures):
+            assert bytes(future.result(timeout=10)) == DATA[off:off + size]
+        fetcher.release(sum(size for _, size in reads))
+
+
+def test_readahead_batch_larger_than_window(tmp_path):
+    path = tmp_path / "payload.bin"
+    path.write_bytes(DATA)
+    ra = ReadAhead(mtio.MTFile(str(path), "r"), window=128 << 10, chunk=64 << 10)
+    try:
+        check_batches(ra, ra.window)
+    finally:
+        ra.close()
+        ra.base.close()
+
+
+def test_readahead_stream_batch_larger_than_window():
+    # `payload_dumper -` always reads through ReadAhead
+    ra = ReadAhead(StreamPayload(io.BytesIO(DATA)), window=128 << 10, chunk=64 << 10)
+    try:
+        check_batches(ra, ra.window)
+    finally:
+        ra.close()
+
+
+def test_readahead_waits_for_release(tmp_path):
+    path = tmp_path / "payload.bin"
+    path.write_bytes(DATA)
+    ra = ReadAhead(mtio.MTFile(str(path), "r"), window=128 << 10, chunk=64 << 10)
+    try:
+        ra.fetch_batch([(0, 100 << 10)])[0].result(timeout=10)
+        started = threading.Event()
+        done = threading.Event()
+
+        def second():
+            started.set()
+            ra.fetch_batch([(100 << 10, 100 << 10)])
+            done.set()
+
+        t = threading.Thread(target=second, daemon=True)
+        t.start()
+        started.wait()
+        # over the window while the first batch holds its bytes
+        assert not done.wait(0.2)
+        ra.release(100 << 10)
+        assert done.wait(10)
+        t.join()
+    finally:
+        ra.close()
+        ra.base.close()
+
+
+def test_async_http_batch_larger_than_window(tmp_path):
+    async_http = pytest.importorskip("payload_dumper.async_http")
+    from payload_dumper.bench.server import RangeServer
+
+    (tmp_path / "payload.bin").write_bytes(DATA)
+    with RangeServer(str(tmp_path)) as server:
+        f = async_http.AsyncHttpRangeFile(server.url + "/payload.bin", max_buffered=128 << 10, http2=False)
+        try:
+            check_batches(f, f.window)
+        finally:
+            f.close()
@@ -0,0 +1,129 @@
+import hashlib
+import os
+
+from payload_dumper import incremental
+from payload_dumper import mtio
+from payload_dumper import progress
+from payload_dumper import update_metadata_pb2 as um
+from payload_dumper.bench.synth import build_payload
+from payload_dumper.dumper import Dumper
+
+BLOCK_SIZE = 4096
+
+
+def spec(seed):
+    return {"seed": seed, "partitions": [{"name": "system", "size": "1M", "op_blocks": [1, 16]}]}
+
+
+def extract(path, out, update=True):
+    dumper = Dumper(mtio.MTFile(path, "r"), out, workers=2, update=update, manager=progress.NullManager())
+    dumper.run()
+    return dumper
+
+
+def image_hash(out):
+    with open(os.path.join(out, "system.img"), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_op_key():
+    op = um.InstallOperation(type=um.InstallOperation.REPLACE, data_length=10, data_sha256_hash=b"h" * 32)
+    op.dst_extents.add(start_block=1, num_blocks=2)
+    key = incremental.op_key(op)
+    assert key is not None
+    moved = um.InstallOperation()
+    moved.CopyFrom(op)
+    moved.dst_extents[0].start_block = 2
+    assert incremental.op_key(moved) != key
+    assert incremental.op_key(um.InstallOperation(type=um.InstallOperation.DISCARD)) is None
+    # nothing pins down the data
+    assert incremental.op_key(um.InstallOperation(type=um.InstallOperation.REPLACE, data_length=10)) is None
+    source = um.InstallOperation(type=um.InstallOperation.SOURCE_COPY)
+    assert incremental.op_key(source) is None
+
+
+def test_plan_without_image(tmp_path):
+    path = str(tmp_path / "payload.bin")
+    build_payload(spec(1), path)
+    dumper = Dumper(mtio.MTFile(path, "r"), str(tmp_path), manager=progress.NullManager())
+    partition = dumper.dam.partitions[0]
+    size = dumper.partition_size(partition)
+    assert incremental.plan_partition(str(tmp_path / "missing.img"), partition, BLOCK_SIZE, size) == (False, {})
+
+
+def test_update_skips_unchanged_and_rewrites_changed(tmp_path):
+    out = str(tmp_path / "out")
+    os.makedirs(out)
+    first = str(tmp_path / "first.bin")
+    build_payload(spec(1), first)
+    dumper = extract(first, out)
+    partition = dumper.dam.partitions[0]
+    size = dumper.partition_size(partition)
+    path = os.path.join(out, "system.img")
+
+    skip, _ = incremental.plan_partition(path, partition, BLOCK_SIZE, size)
+    assert skip
+
+    second = str(tmp_path / "second.bin")
+    hashes = build_payload(spec(2), second)
+    dumper = extract(second, out)
+    assert image_hash(out) == hashes["system"]
+    skip, _ = incremental.plan_partition(path, dumper.dam.partitions[0], BLOCK_SIZE, size)
+    assert skip
+
+
+def test_ops_whose_extents_still_match_are_kept(tmp_path):
+    out = str(tmp_path / "out")
+    os.makedirs(out)
+    payload = str(tmp_path / "payload.bin")
+    hashes = build_payload(spec(1), payload)
+    dumper = extract(payload, out)
+    partition = dumper.dam.partitions[0]
+    size = dumper.partition_size(partition)
+    path = os.path.join(out, "system.img")
+
+    # damage the data of the first op that writes something
+    op = next(op for op in partition.operations if op.type != um.InstallOperation.ZERO)
+    with open(path, "r+b") as f:
+        f.seek(op.dst_extents[0].start_block * BLOCK_SIZE)
+        f.write(b"damaged")
+    skip, kept = incremental.plan_partition(path, partition, BLOCK_SIZE, size)
+    assert not skip
+    keys = [incremental.op_key(o) for o in partition.operations]
+    assert incremental.op_key(op) not in kept
+    assert len(kept) == len([k for k in keys if k is not None]) - 1
+
+    extract(payload, out)
+    assert image_hash(out) == hashes["system"]
+
+
+def test_mismatching_image_is_rewritten_whole(tmp_path):
+    out = str(tmp_path / "out")
+    os.makedirs(out)
+    payload = str(tmp_path / "payload.bin")
+    hashes = build_payload(spec(1), payload)
+    dumper = extract(payload, out)
+    partition = dumper.dam.partitions[0]
+    path = os.path.join(out, "system.img")
+
+    # stale bytes under an op the sidecar still vouches for, the image looks
+    # unchanged since the sidecar was written
+    st = os.stat(path)
+    sidecar = incremental.load_sidecar(path, BLOCK_SIZE)
+    op = next(op for op in partition.operations if op.type != um.InstallOperation.ZERO)
+    with open(path, "r+b") as f:
+        f.seek(op.dst_extents[0].start_block * BLOCK_SIZE)
+        f.write(b"stale")
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    incremental.save_sidecar(path, BLOCK_SIZE, b"", sidecar["ops"])
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    # every op is kept, the update finds the image still wrong and says so
+    extract(payload, out)
+    sidecar = incremental.load_sidecar(path, BLOCK_SIZE)
+    assert sidecar["partition_hash"] == ""
+    assert sidecar["ops"] == {}
+    # the next one rewrites it
+    extract(payload, out)
+    assert image_hash(out) == hashes["system"]
+    assert incremental.load_sidecar(path, BLOCK_SIZE)["partition_hash"] == partition.new_partition_info.hash.hex()
@@ -0,0 +1,14 @@
+from payload_dumper.metrics import percentile
+
+
+def test_percentile_nearest_rank():
+    assert percentile([], 50) == 0.0
+    assert percentile([1.0], 99) == 1.0
+    assert percentile([1.0, 2.0], 50) == 1.0
+    assert percentile([1.0, 2.0], 51) == 2.0
+    values = [float(i) for i in range(1, 11)]
+    assert percentile(values, 50) == 5.0
+    assert percentile(values, 90) == 9.0
+    assert percentile(values, 99) == 10.0
+    assert percentile(values, 0) == 1.0
+    assert percentile(values, 100) == 10.0
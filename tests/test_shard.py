@@ -0,0 +1,111 @@
+import hashlib
+import os
+
+import pytest
+
+from payload_dumper import mtio
+from payload_dumper import progress
+from payload_dumper import shard
+from payload_dumper import update_metadata_pb2 as um
+from payload_dumper.bench.synth import build_payload
+from payload_dumper.dumper import Dumper
+
+BLOCK_SIZE = 4096
+
+SPEC = {
+    "partitions": [
+        {"name": "system", "size": "2M", "op_blocks": [1, 32]},
+        {"name": "boot", "size": "512K", "ops": {"REPLACE": 1}, "op_blocks": [1, 8]},
+        {"name": "empty", "size": "64K", "sparsity": 1.0},
+    ],
+}
+
+
+def manifest(op_sizes):
+    """partitions of REPLACE ops, op_sizes is a list of (data bytes, blocks) per partition"""
+    dam = um.DeltaArchiveManifest()
+    dam.block_size = BLOCK_SIZE
+    for i, sizes in enumerate(op_sizes):
+        part = dam.partitions.add()
+        part.partition_name = f"p{i}"
+        block = 0
+        for data_length, blocks in sizes:
+            op = part.operations.add()
+            op.type = um.InstallOperation.REPLACE
+            op.data_length = data_length
+            ext = op.dst_extents.add()
+            ext.start_block = block
+            ext.num_blocks = blocks
+            block += blocks
+    return dam
+
+
+def test_parse_shard():
+    assert shard.parse_shard("1/1") == (0, 1)
+    assert shard.parse_shard("3/4") == (2, 4)
+    for spec in ("0/4", "5/4", "1/0", "a/b", "1", "1/2/3"):
+        with pytest.raises(ValueError):
+            shard.parse_shard(spec)
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7, 50])
+def test_assign_covers_every_op_once(count):
+    dam = manifest([
+        [(4096 * (i % 5 + 1), i % 3 + 1) for i in range(40)],
+        [(0, 8)] * 10,
+        [],
+        [(1 << 20, 256), (10, 1)],
+    ])
+    owners = shard.assign(dam.partitions, BLOCK_SIZE, count)
+    assert list(owners) == [p.partition_name for p in dam.partitions]
+    flat = [o for p in dam.partitions for o in owners[p.partition_name]]
+    assert len(flat) == sum(len(p.operations) for p in dam.partitions)
+    assert all(0 <= o < count for o in flat)
+    # contiguous in manifest order: each op goes to exactly one shard and a
+    # shard's ops form one run
+    assert flat == sorted(flat)
+
+
+def test_assign_balances_cost():
+    dam = manifest([[(4096, 1)] * 300, [(8192, 2)] * 100])
+    count = 4
+    owners = shard.assign(dam.partitions, BLOCK_SIZE, count)
+    costs = [0] * count
+    for p in dam.partitions:
+        for op, owner in zip(p.operations, owners[p.partition_name]):
+            costs[owner] += shard.op_cost(op, BLOCK_SIZE)
+    largest_op = max(shard.op_cost(op, BLOCK_SIZE) for p in dam.partitions for op in p.operations)
+    assert max(costs) - min(costs) <= 2 * largest_op
+
+
+def test_assign_without_cost_splits_by_count():
+    dam = manifest([[(0, 0)] * 10])
+    owners = shard.assign(dam.partitions, BLOCK_SIZE, 5)
+    assert owners["p0"] == [0, 0, 1, 1, 2, 2, 3, 3, 4, 4]
+
+
+def test_shards_build_the_images(tmp_path):
+    path = str(tmp_path / "payload.bin")
+    hashes = build_payload(SPEC, path)
+    out = str(tmp_path / "out")
+    os.makedirs(out)
+    count = 3
+    for i in range(count):
+        dumper = Dumper(mtio.MTFile(path, "r"), out, workers=2, shard=(i, count), manager=progress.NullManager())
+        dumper.run()
+    for name, digest in hashes.items():
+        with open(os.path.join(out, f"{name}.img"), "rb") as f:
+            assert hashlib.sha256(f.read()).hexdigest() == digest
+    dumper = Dumper(mtio.MTFile(path, "r"), out, workers=2, verify=True, manager=progress.NullManager())
+    assert dumper.run() == 0
+
+
+def test_check_markers(tmp_path):
+    path = str(tmp_path / "payload.bin")
+    build_payload(SPEC, path)
+    out = str(tmp_path / "out")
+    os.makedirs(out)
+    dumper = Dumper(mtio.MTFile(path, "r"), out, workers=2, shard=(0, 2), manager=progress.NullManager())
+    dumper.run()
+    problems = shard.check_markers(out, dumper.dam, dumper.dam.partitions)
+    assert problems == ["shards not finished: 2/2"]
@@ -0,0 +1,110 @@
+import threading
+
+from payload_dumper import tuner
+
+MIB = 1 << 20
+
+
+class LocalPayload:
+    pass
+
+
+def autotuner(**kwargs):
+    t = tuner.Autotuner(LocalPayload(), **kwargs)
+    t.cpus = 8
+    return t
+
+
+def test_limiter_follows_its_limit():
+    limiter = tuner.Limiter(1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def second():
+        limiter.acquire()
+        acquired.set()
+
+    t = threading.Thread(target=second, daemon=True)
+    t.start()
+    assert not acquired.wait(0.1)
+    # raising the limit lets the waiter in while the first slot is still held
+    limiter.set_limit(2)
+    assert acquired.wait(5)
+    t.join()
+    assert limiter.active == 2 and limiter.waits == 1
+    limiter.release()
+    limiter.release()
+    assert limiter.active == 0
+
+
+def test_fetch_slow_start_then_additive():
+    t = autotuner(max_fetch=64)
+    assert t.fetch.limit == 4
+    t.tune_fetch(10 * MIB, 0.05, saturated=True)
+    assert t.fetch.limit == 8
+    t.last_rate = 10 * MIB
+    t.min_latency = 0.05
+    t.tune_fetch(20 * MIB, 0.05, saturated=True)
+    assert t.fetch.limit == 16
+    t.last_rate = 20 * MIB
+    # no gain ends the slow start
+    t.tune_fetch(20 * MIB, 0.05, saturated=True)
+    assert t.fetch.limit == 16 and not t.slow_start
+    t.tune_fetch(30 * MIB, 0.05, saturated=True)
+    assert t.fetch.limit == 17
+
+
+def test_fetch_backs_off():
+    t = autotuner(max_fetch=64)
+    t.fetch.set_limit(16)
+    t.last_rate = 20 * MIB
+    t.min_latency = 0.05
+    # latency up without a rate gain
+    t.tune_fetch(20 * MIB, 0.1, saturated=True)
+    assert t.fetch.limit == 12
+    # idle slots are left alone
+    t.tune_fetch(40 * MIB, 0.05, saturated=False)
+    assert t.fetch.limit == 12
+    # over the memory budget halves whatever else happens
+    t.fetching.add(t.memory_budget + 1)
+    t.tune_fetch(40 * MIB, 0.05, saturated=True)
+    assert t.fetch.limit == 6
+
+
+def test_fetch_stays_within_bounds():
+    t = autotuner(min_fetch=2, max_fetch=5)
+    for _ in range(5):
+        t.tune_fetch(t.last_rate * 2 + MIB, None, saturated=True)
+        t.last_rate = t.last_rate * 2 + MIB
+    assert t.fetch.limit == 5
+    t.fetching.add(t.memory_budget + 1)
+    for _ in range(5):
+        t.tune_fetch(0.0, None, saturated=True)
+    assert t.fetch.limit == 2
+
+
+def test_decode(monkeypatch):
+    t = autotuner(max_decode=8)
+    t.decode.set_limit(4)
+    monkeypatch.setattr(tuner.os, "getloadavg", lambda: (1.0, 1.0, 1.0))
+    t.tune_decode(cpu=3.0, waiting=True)
+    assert t.decode.limit == 5
+    # CPUs busy, more threads wouldn't help
+    t.tune_decode(cpu=7.5, waiting=True)
+    assert t.decode.limit == 5
+    monkeypatch.setattr(tuner.os, "getloadavg", lambda: (20.0, 20.0, 20.0))
+    t.tune_decode(cpu=3.0, waiting=True)
+    assert t.decode.limit == 3
+    monkeypatch.setattr(tuner.os, "getloadavg", lambda: (1.0, 1.0, 1.0))
+    t.decoding.add(t.memory_budget + 1)
+    t.tune_decode(cpu=1.0, waiting=True)
+    assert t.decode.limit == 2
+
+
+def test_latency_from_spans():
+    t = autotuner()
+    t.add("GET", "http", 0, 100_000_000, {})
+    t.add("fetch", "stage", 0, 300_000_000, {})
+    t.add("decode", "stage", 0, 900_000_000, {})
+    assert t.latency_count == 2
+    assert abs(t.latency_sum - 0.4) < 1e-9
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from payload_dumper import mtio
+from payload_dumper import verity
+from payload_dumper.scheduler import Scheduler
+
+# GF(2^8) of libfec, kept apart from the code under test
+POLY = 0x11d
+
+
+def gf_mul(a, b):
+    p = 0
+    while b:
+        if b & 1:
+            p ^= a
+        a <<= 1
+        if a & 0x100:
+            a ^= POLY
+        b >>= 1
+    return p
+
+
+def gf_pow(a, n):
+    r = 1
+    for _ in range(n):
+        r = gf_mul(r, a)
+    return r
+
+
+def generator(nroots):
+    """prod (x - a^i) for i < nroots, highest coefficient first"""
+    g = [1]
+    for i in range(nroots):
+        root = gf_pow(2, i)
+        g = [a ^ gf_mul(b, root) for a, b in zip(g + [0], [0] + g)]
+    return g
+
+
+def reference_parity(data, nroots):
+    """remainder of data(x) * x^nroots divided by the generator"""
+    g = generator(nroots)
+    rem = list(data) + [0] * nroots
+    for i in range(len(data)):
+        c = rem[i]
+        if c:
+            for j in range(1, nroots + 1):
+                rem[i + j] ^= gf_mul(g[j], c)
+    return rem[len(data):]
+
+
+def evaluate(codeword, x):
+    y = 0
+    for c in codeword:
+        y = gf_mul(y, x) ^ c
+    return y
+
+
+@pytest.mark.parametrize("nroots", [2, 16, 24])
+def test_rs_encode_matches_polynomial_division(nroots):
+    rnd = random.Random(nroots)
+    genpoly = verity.rs_genpoly(nroots)
+    rs_n = verity.FEC_RSM - nroots
+    for _ in range(5):
+        data = [rnd.randrange(256) for _ in range(rs_n)]
+        parity = verity.rs_encode(data, genpoly, nroots)
+        assert parity == reference_parity(data, nroots)
+        # a codeword vanishes at every root of the generator
+        assert all(evaluate(data + parity, gf_pow(2, i)) == 0 for i in range(nroots))
+
+
+def partition(block_size, data_blocks, tree_blocks, fec_blocks, roots, salt=b"salt"):
+    ext = SimpleNamespace
+    return SimpleNamespace(
+        hash_tree_algorithm="sha256",
+        hash_tree_salt=salt,
+        hash_tree_data_extent=ext(start_block=0, num_blocks=data_blocks),
+        hash_tree_extent=ext(start_block=data_blocks, num_blocks=tree_blocks),
+        fec_roots=roots,
+        fec_data_extent=ext(start_block=0, num_blocks=data_blocks + tree_blocks),
+        fec_extent=ext(start_block=data_blocks + tree_blocks, num_blocks=fec_blocks),
+    )
+
+
+def reference_tree(data, block_size, salt):
+    def hash_level(level):
+        out = b"".join(hashlib.sha256(salt + level[i:i + block_size]).digest() for i in range(0, len(level), block_size))
+        return out + bytes(-len(out) % block_size)
+
+    levels = [hash_level(data)]
+    while len(levels[-1]) > block_size:
+        levels.append(hash_level(levels[-1]))
+    return hashlib.sha256(salt + levels[-1]).digest(), b"".join(reversed(levels))
+
+
+def reference_fec(image, block_size, data_blocks, roots):
+    """libfec's interleaving: codeword k of round i takes byte k of blocks i, i + rounds, ..."""
+    rs_n = verity.FEC_RSM - roots
+    rounds = (data_blocks + rs_n - 1) // rs_n
+    out = bytearray()
+    for i in range(rounds):
+        for k in range(block_size):
+            word = []
+            for j in range(rs_n):
+                block = j * rounds + i
+                word.append(image[block * block_size + k] if block < data_blocks else 0)
+            out += bytes(reference_parity(word, roots))
+    return bytes(out)
+
+
+def build(tmp_path, executor, block_size=512, data_blocks=300, roots=2, verify=False, image=None):
+    # a tree of 300 blocks of 512 bytes takes 19 + 2 + 1 blocks, the FEC 2 rounds
+    part = partition(block_size, data_blocks, 22, 4, roots)
+    path = str(tmp_path / "image.img")
+    if image is None:
+        image = os.urandom(data_blocks * block_size) + bytes(26 * block_size)
+    with open(path, "wb") as f:
+        f.write(image)
+    f = mtio.MTFile(path, "r+")
+    try:
+        builder = verity.VerityBuilder(part, block_size, f, executor, verify=verify)
+        builder.start([])
+        root, problems = builder.finish()
+    finally:
+        f.close()
+    with open(path, "rb") as f:
+        return part, image, root, problems, f.read()
+
+
+def test_tree_and_fec_match_the_references(tmp_path):
+    block_size, data_blocks, roots = 512, 300, 2
+    with ThreadPoolExecutor(4) as executor:
+        part, image, root, problems, written = build(tmp_path, executor, block_size, data_blocks, roots)
+    assert problems == []
+    data = image[:data_blocks * block_size]
+    expected_root, tree = reference_tree(data, block_size, part.hash_tree_salt)
+    assert root == expected_root
+    tree_off = data_blocks * block_size
+    assert written[tree_off:tree_off + len(tree)] == tree
+    fec = reference_fec(written, block_size, data_blocks + 22, roots)
+    fec_off = (data_blocks + 22) * block_size
+    assert written[fec_off:fec_off + len(fec)] == fec
+
+
+def test_batch_job_executor(tmp_path):
+    # a scheduler.Job only has submit(), as in batch runs
+    image = os.urandom(300 * 512) + bytes(26 * 512)
+    with ThreadPoolExecutor(4) as executor:
+        expected = build(tmp_path, executor, image=image)
+    scheduler = Scheduler(4)
+    assert build(tmp_path, scheduler.job("job"), image=image) == expected
+
+
+def test_verify_reports_mismatches(tmp_path):
+    with ThreadPoolExecutor(4) as executor:
+        _, _, root, problems, written = build(tmp_path, executor)
+        _, _, verified_root, problems, _ = build(tmp_path, executor, verify=True, image=written)
+        assert (verified_root, problems) == (root, [])
+        damaged = bytearray(written)
+        damaged[300 * 512 + 5] ^= 1
+        damaged[-1] ^= 1
+        _, _, _, problems, _ = build(tmp_path, executor, verify=True, image=bytes(damaged))
+    assert problems == ["hash tree mismatch", "FEC mismatch"]